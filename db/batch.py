@@ -0,0 +1,141 @@
+""" Columnar access to the records of a table
+A RecordBatch holds the values of the records column by column, in numpy arrays, for when all
+that's needed is column access (overviews, KPIs, exports) and building a Record per row would be
+wasteful. Records can still be built on demand """
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Type
+import numpy as np
+
+
+from db.objects import Field, Record, Table, BoolField, DateField, IntField, LengthField, \
+    format_epoch, format_timedelta_seconds, length_to_seconds
+from src.base_object import BaseObject
+
+
+sql_to_numpy_type_mapping = {
+    "INTEGER": np.int64, "BOOLEAN": np.bool_, "TEXT": object
+}
+
+
+class RecordBatch(BaseObject):
+    """ Records of a table, stored by column
+    Columns are typed from the SQL types of the fields:
+    - INTEGER as int64, or float64 with nan where values are missing
+    - BOOLEAN as bool
+    - TEXT as objects (python strings or None)
+    - lengths are converted to seconds, as INTEGER
+    - dates are kept as stored, text or, with numeric storage, epoch seconds as INTEGER
+    Records built from a batch get the same values as the ones read with get_records
+    Filtering, sorting and grouping return new batches and don't copy more than needed """
+
+    def __init__(self, table:Table, columns:Dict[Field, np.ndarray]) -> None:
+        super().__init__()
+        self.table = table
+        self.columns = columns
+        self.fields = list(columns)
+        self._length = len(next(iter(columns.values()))) if columns else 0
+
+    @classmethod
+    def from_rows(
+            cls, table:Table, fields:List[Field], rows:Sequence[Sequence[Any]],
+            sql_types:Dict[Type[Field], str]):
+        """ Build a batch from the results of a query, the values of each row being in the order of
+        the given fields; sql_types is the py_to_sql_type_mapping of the handler """
+        raw_columns = list(zip(*rows)) if rows else [() for _ in fields]
+        columns = {}
+        for field, values in zip(fields, raw_columns):
+            if type(field) is LengthField:
+                values = [length_to_seconds(value) for value in values]
+                sql_type = "INTEGER"
+            else:
+                sql_type = sql_types[type(field)]
+            if sql_type == "BOOLEAN":
+                # Stored as text by the handler, cf _parse_raw_data_into_record
+                values = [value in [True, 1, "True", "1"] for value in values]
+            if sql_type == "INTEGER" and None in values:
+                column = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+            elif sql_to_numpy_type_mapping[sql_type] is object:
+                column = np.empty(len(values), dtype=object)
+                column[:] = values
+            else:
+                column = np.array(values, dtype=sql_to_numpy_type_mapping[sql_type])
+            columns[field] = column
+        return cls(table, columns)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, field:Field|str) -> np.ndarray:
+        if type(field) is str: field = self.table.get_field(field)
+        return self.columns[field]
+
+    def take(self, indices:np.ndarray) -> "RecordBatch":
+        """ New batch with the rows at the given indices, in that order """
+        return RecordBatch(self.table, {f: column[indices] for f, column in self.columns.items()})
+
+    def filter(self, mask:np.ndarray) -> "RecordBatch":
+        """ New batch with the rows where mask is True, for ex batch.filter(batch["length"] > 60) """
+        return self.take(np.flatnonzero(mask))
+
+    def sort(self, by:Field|str, reverse:bool=False) -> "RecordBatch":
+        """ New batch sorted on one column, stable, missing values last """
+        column = self[by]
+        if column.dtype == object:
+            missing = np.array([value is None for value in column], dtype=bool)
+        elif column.dtype == np.float64:
+            missing = np.isnan(column)
+        else:
+            missing = np.zeros(len(column), dtype=bool)
+        present = np.flatnonzero(~missing)
+        if column.dtype == object:
+            order = present[np.array(
+                sorted(range(len(present)), key=lambda i: column[present[i]]), dtype=np.int64)]
+        else:
+            order = present[np.argsort(column[present], kind="stable")]
+        # Only the values are reversed, missing ones stay last
+        if reverse: order = order[::-1]
+        return self.take(np.concatenate([order, np.flatnonzero(missing)]))
+
+    def group_by(self, by:Field|str) -> Dict[Any, "RecordBatch"]:
+        """ Split the batch into {value: batch of the rows with that value}
+        Keys are sorted for typed columns, in order of appearance for text columns """
+        column = self[by]
+        if column.dtype != object:
+            keys, inverse = np.unique(column, return_inverse=True)
+            return {
+                key.item(): self.take(np.flatnonzero(inverse == i)) for i, key in enumerate(keys)}
+        indices = {}
+        for i, value in enumerate(column.tolist()):
+            indices.setdefault(value, []).append(i)
+        return {key: self.take(np.array(rows, dtype=np.int64)) for key, rows in indices.items()}
+
+    def _to_python(self, field:Field, column:np.ndarray) -> List[Any]:
+        """ Values of a column as the python values records use """
+        values = column.tolist()
+        if type(field) is LengthField:
+            return [None if v != v else format_timedelta_seconds(v) for v in values]
+        # Epoch seconds, with numeric storage
+        if type(field) is DateField and column.dtype != object:
+            return [None if v != v else format_epoch(v) for v in values]
+        if column.dtype == np.float64:
+            return [None if v != v else int(v) for v in values]
+        return values
+
+    def rows(self, fields:Optional[List[Field]]=None) -> Iterator[tuple]:
+        """ Iterate on the rows, as tuples of python values in the order of the given fields """
+        if fields is None: fields = self.fields
+        return zip(*[self._to_python(field, self.columns[field]) for field in fields])
+
+    def to_records(self) -> List[Record]:
+        """ Build the records of the batch
+        If the batch doesn't have all the fields of the table, the records won't either """
+        if self.fields == self.table.fields:
+            return [Record.from_row(self.table, row, validate=False) for row in self.rows()]
+        return [Record(self.table, dict(zip(self.fields, row)), validate=False) \
+            for row in self.rows()]
+
+    def get_record(self, ID:int) -> Record|None:
+        """ Build the record of the given ID, None if it isn't in the batch """
+        found = np.flatnonzero(self["ID"] == ID)
+        if len(found) == 0: return None
+        return self.take(found[:1]).to_records()[0]
@@ -1,15 +1,36 @@
 """ Database handlers """
 
-from sqlite3 import OperationalError, connect
-from typing import Any, Literal, Optional, List
-from pandas import ExcelWriter, ExcelFile, read_sql_query
+from sqlite3 import Connection, Cursor, IntegrityError, OperationalError, connect
+from threading import Lock, local
+from typing import TYPE_CHECKING, Any, Callable, Dict, Literal, Optional, List, Tuple
+from argparse import ArgumentError
 from os import remove
 from os.path import exists
 
 
-from db.objects import DataModel, Field, Record, Table, clean_df, TextField, BoolField, IntField, FilepathField, LengthField, DateField
+from db.objects import DataModel, Field, Record, Table, clean_df, TextField, BoolField, IntField, FilepathField, LengthField, DateField, \
+    datetime_to_epoch, format_epoch, format_timedelta_seconds, length_to_seconds
+from db.path_cache import PathCache
 from src.base_object import BaseObject, Singleton
 
+# pandas, numpy (through RecordBatch) and multiprocessing are slow to import and only needed for
+# spreadsheet import/export and columnar access, they are imported when needed
+if TYPE_CHECKING: from db.batch import RecordBatch
+
+
+def parse_spreadsheet(spreadsheet_path:str) -> Dict[str, Dict[str, List[Any]]]:
+    """ Parse all the tabs of a spreadsheet into {tab: {column: values}}
+    Module level so that it can be run in worker processes; columns are sent back as plain lists,
+    which are much cheaper to pickle than dataframes
+    NOTE the tabs of a file share the same odf document load, so files are the unit of work """
+    from pandas import ExcelFile
+    excel_file = ExcelFile(spreadsheet_path)
+    parsed = {}
+    for tab in excel_file.sheet_names:
+        df = clean_df(excel_file.parse(tab))
+        parsed[tab] = {column: df[column].tolist() for column in df.columns}
+    return parsed
+
 
 class DataHandler(BaseObject, metaclass=Singleton):
     """ Virtual class for Database handlers
@@ -60,6 +81,10 @@ class DataHandler(BaseObject, metaclass=Singleton):
         """ Add a record in the database, fail if it already exists """
         raise NotImplementedError
 
+    def create_records_or_fail(self, records:List[Record]) -> None:
+        """ Add records of a same table in the database, fail and add none if one already exists """
+        raise NotImplementedError
+
     def create_record_or_ignore(self, record:Record) -> None:
         """ Add a record in the database, pass if it already exists """
         raise NotImplementedError
@@ -67,6 +92,14 @@ class DataHandler(BaseObject, metaclass=Singleton):
     def update_record_or_fail(self, record:Record) -> None:
         """ Update a record in the database, fail if it doesn't exist """
         raise NotImplementedError
+
+    def update_records_or_fail(self, table:Table|str, IDs:List[int], values:Dict[Field, Any]) -> None:
+        """ Set the same values to several records, fail and update none if one can't be """
+        raise NotImplementedError
+
+    def write_record_updates(self, records:List[Record]) -> List[Exception|None]:
+        """ Update several records at once, return the error of each, None if it was written """
+        raise NotImplementedError
     
     def delete_record_or_ignore(self, record:Record) -> None:
         """ Delete a record in the database, pass if it doesn't exist """
@@ -80,7 +113,13 @@ class DataHandler(BaseObject, metaclass=Singleton):
 
 
 class SQLiteHandler(DataHandler):
-    """ SQLite database handler """
+    """ SQLite database handler
+    By default, lengths and dates are stored as text (HH:MM:SS and YYYY-MM-DD HH:MM:SS)
+    Databases can opt in to numeric storage instead (seconds and UTC epoch seconds), which allows
+    for sums, averages and indexed range queries in SQL, see migrate_to_numeric_storage
+    Either way, records always hold the text representation, conversion happens in the handler
+    sqlite3 connections can't be shared between threads, each thread gets its own connection to
+    the current database, so that records can be read in the background """
 
     # There are more data types in our application than in sqlite3
     py_to_sql_type_mapping = {
@@ -88,25 +127,128 @@ class SQLiteHandler(DataHandler):
         BoolField: "BOOLEAN", DateField: "TEXT",
         FilepathField: "TEXT", LengthField: "TEXT" 
     }
+    py_to_sql_numeric_type_mapping = {
+        **py_to_sql_type_mapping, DateField: "INTEGER", LengthField: "INTEGER"
+    }
+    # Value of PRAGMA user_version for databases using numeric storage
+    numeric_storage_version = 1
+    # Conversions at the handler boundary for numeric storage, (to sql, from sql)
+    numeric_storage_converters = {
+        DateField: (datetime_to_epoch, format_epoch),
+        LengthField: (length_to_seconds, format_timedelta_seconds)
+    }
+    # IDs per statement of the bulk updates, SQLite limits the number of bound parameters
+    max_IDs_per_query = 500
+    # Fields searched by get_search_condition, and by the tables that search in memory
+    searchable_field_types = (TextField, DateField, FilepathField, LengthField)
+    # {field type name: formatting}, for the numeric values searched
+    numeric_search_formatters = {
+        field_type.__name__: converters[1] for field_type, converters \
+        in numeric_storage_converters.items()}
 
     def __init__(
             self, database_path:str="db/podfics.db", datamodel_path:str="db/datamodel.ods"):
         super().__init__(database_path, datamodel_path)
-        self.con = connect(self.database_path)
-        self.cur = self.con.cursor()
+        # Connections of each thread, reopened when the database changes
+        self._connections = local()
+        self._connection_generation = 0
+        self._read_storage_mode()
+        # Versions of the data of the tables, {table name: version}, cf get_table_version
+        self._table_versions = {}
+        self._last_table_version = 0
+        # The write-behind writer bumps versions too, cf write_record_updates
+        self._versions_lock = Lock()
+        # Called with the table whenever its data changes, or None for all tables
+        self._change_listeners:List[Callable[[Table|None], None]] = []
 
     def change_db(self, database_path:str="db/podfics.db", datamodel_path:str="db/datamodel.ods"):
         """ Change which database the handler connects to
         A new handler cannot be created because it is a singleton """
         self.database_path = database_path
         self.data_model = DataModel(datamodel_path)
-        self.con.close()
-        self.con = connect(self.database_path)
-        self.cur = self.con.cursor()
+        self._reconnect()
+        self._read_storage_mode()
+        self._table_versions = {}
+        self._notify_change(None)
+
+    @property
+    def con(self) -> Connection:
+        """ Connection of the current thread to the database """
+        connections = self._connections
+        if getattr(connections, "generation", None) != self._connection_generation:
+            if getattr(connections, "con", None) is not None: connections.con.close()
+            connections.con = connect(self.database_path)
+            connections.con.create_function(
+                "search_text", -1, SQLiteHandler._to_search_text, deterministic=True)
+            connections.cur = connections.con.cursor()
+            connections.generation = self._connection_generation
+        return connections.con
+
+    @property
+    def cur(self) -> Cursor:
+        """ Cursor of the connection of the current thread """
+        self.con
+        return self._connections.cur
+
+    def _reconnect(self) -> None:
+        """ Make every thread open a new connection, to self.database_path """
+        self._connection_generation += 1
+
+    def get_table_version(self, table:Table) -> int:
+        """ Number that changes whenever the data of the table might have changed, through this
+        handler; versions are never reused, even across tables and databases """
+        if table.table_name not in self._table_versions: self._bump_table_version(table)
+        return self._table_versions[table.table_name]
+
+    def _bump_table_version(self, table:Table) -> None:
+        with self._versions_lock:
+            self._last_table_version += 1
+            self._table_versions[table.table_name] = self._last_table_version
+
+    def add_change_listener(self, listener:Callable[[Table|None], None]) -> None:
+        """ Call listener(table) after each write to a table through this handler, and
+        listener(None) when the whole database changes
+        Listeners are called from the thread that wrote, which isn't always the main loop, e.g.
+        for write_record_updates: those that touch widgets have to go through GLib.idle_add """
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener:Callable[[Table|None], None]) -> None:
+        self._change_listeners.remove(listener)
+
+    def _notify_change(self, table:Table|None) -> None:
+        """ Bump the version of the table and tell the listeners """
+        if table is not None: self._bump_table_version(table)
+        for listener in list(self._change_listeners):
+            try: listener(table)
+            except Exception as e: self.error(f"Change listener {listener} failed", exc_info=e)
+
+    def _read_storage_mode(self) -> None:
+        """ Check whether the database stores lengths and dates as numbers """
+        user_version = self.cur.execute("PRAGMA user_version").fetchone()[0]
+        self.numeric_storage = user_version == SQLiteHandler.numeric_storage_version
+
+    def _get_sql_type(self, field:Field) -> str:
+        if self.numeric_storage: return SQLiteHandler.py_to_sql_numeric_type_mapping[type(field)]
+        return SQLiteHandler.py_to_sql_type_mapping[type(field)]
+
+    def _to_sql_value(self, field:Field, value:Any) -> Any:
+        """ Convert a record value into the value to write in the database """
+        if self.numeric_storage and type(field) in SQLiteHandler.numeric_storage_converters:
+            return SQLiteHandler.numeric_storage_converters[type(field)][0](value)
+        # Text representation, as the values always have been written
+        return str(value)
+
+    def _from_sql_value(self, field:Field, value:Any) -> Any:
+        """ Convert a value read from the database into a record value """
+        if type(field) is BoolField: return eval(value)
+        if self.numeric_storage and value is not None \
+                and type(field) in SQLiteHandler.numeric_storage_converters:
+            return SQLiteHandler.numeric_storage_converters[type(field)][1](value)
+        return value
 
     def __del__(self) -> None:
         """ Close connection on deletion of object """
-        try: self.con.close()
+        try: self._connections.con.close()
         except AttributeError as e: pass
 
     def _run_query(self, query:str, parameters:List[Any]) -> List[List[Any]]:
@@ -132,42 +274,162 @@ class SQLiteHandler(DataHandler):
             self.debug(f"debug_schema for {debug_table}", exc_info=e)
 
     
-    def init_db_from_model(self) -> None:
-        """ Create/overwrite database based on model """
-        
-        def get_field_sql(field:Field) -> str:
-            sql = f"{field.field_name} {SQLiteHandler.py_to_sql_type_mapping[type(field)]}"
-            sql += " NOT NULL" if field.mandatory else ""
-            sql += f" DEFAULT {field.default_value}" if field.default_value else ""
-            sql += f" REFERENCES {field.foreign_key_table.display_name}(ID)" +\
-                " ON UPDATE CASCADE ON DELETE SET DEFAULT" \
-                if field.foreign_key_table else ""
-            return sql
-        
-        def get_table_sql(table:Table) -> str:
-            sql = f"CREATE TABLE IF NOT EXISTS {table.table_name}"
-            sql += "(ID INTEGER PRIMARY KEY AUTOINCREMENT,\n"
-            sql += "display_name STRING UNIQUE GENERATED ALWAYS AS ("
-            sql += ' || " - " || '.join([
-                    f.field_name for f in table.fields \
-                    if f.part_of_display_name])
-            sql += "),\n"
-            sql += ',\n'.join(
-                get_field_sql(field) for field in table.fields
-                if field.field_name not in ["ID", "display_name", "creation_date"]) + ",\n"
+    def _get_field_sql(self, field:Field) -> str:
+        sql = f"{field.field_name} {self._get_sql_type(field)}"
+        sql += " NOT NULL" if field.mandatory else ""
+        default_value = field.default_value
+        if default_value and self.numeric_storage \
+                and type(field) in SQLiteHandler.numeric_storage_converters:
+            default_value = SQLiteHandler.numeric_storage_converters[type(field)][0](default_value)
+        sql += f" DEFAULT {default_value}" if default_value else ""
+        sql += f" REFERENCES {field.foreign_key_table.display_name}(ID)" +\
+            " ON UPDATE CASCADE ON DELETE SET DEFAULT" \
+            if field.foreign_key_table else ""
+        return sql
+    
+    def _get_table_sql(self, table:Table) -> str:
+        sql = f"CREATE TABLE IF NOT EXISTS {table.table_name}"
+        sql += "(ID INTEGER PRIMARY KEY AUTOINCREMENT,\n"
+        sql += "display_name STRING UNIQUE GENERATED ALWAYS AS ("
+        sql += table.display_name_composer.sql_expression(self._get_display_name_part_sql)
+        sql += "),\n"
+        sql += ',\n'.join(
+            self._get_field_sql(field) for field in table.fields
+            if field.field_name not in ["ID", "display_name", "creation_date"]) + ",\n"
+        if self.numeric_storage:
+            sql += "creation_date INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))" + ")"
+        else:
             sql += "creation_date DATE DEFAULT (datetime(current_timestamp))" + ")"
-            return sql
+        return sql
+
+    def _get_display_name_part_sql(self, field:Field) -> str:
+        """ Text of a field as it appears in display names, the same as str() of the record value """
+        if not self.numeric_storage or type(field) not in SQLiteHandler.numeric_storage_converters:
+            return field.field_name
+        # Numeric lengths and dates are formatted back, and None is written as text values are
+        if type(field) is LengthField:
+            text = f"printf('%02d:%02d:%02d', {field.field_name} / 3600, " +\
+                f"{field.field_name} % 3600 / 60, {field.field_name} % 60)"
+        else:
+            text = f"datetime({field.field_name}, 'unixepoch')"
+        return f"IFNULL({text}, 'None')"
+
+    def recompute_display_names(self, table:Table|str) -> Dict[int, Tuple[str, str]]:
+        """ Check the stored display names of a table against the current rule, in one query
+        Return {ID: (stored display name, expected display name)} for the records that differ,
+        which happens when the display name fields of the model changed after the database was
+        created; display_name is a generated column, the table has to be recreated to fix it """
+        if type(table) == str: table = self.data_model.get_table(table)
+        expected = table.display_name_composer.sql_expression(self._get_display_name_part_sql)
+        mismatches = {ID: (stored, expected_name) for ID, stored, expected_name in self._run_query(
+            f"SELECT ID, display_name, {expected} AS expected FROM {table.table_name} " +\
+                f"WHERE display_name IS NOT expected;", []).fetchall()}
+        if mismatches:
+            self.error(f"{len(mismatches)} outdated display names in {table.table_name}")
+        return mismatches
+
+    def _get_numeric_index_sql(self, table:Table) -> List[str]:
+        """ Indexes on the numeric length and date columns, for range queries """
+        return [
+            f"CREATE INDEX IF NOT EXISTS {table.table_name}_{field.field_name}_index " +\
+                f"ON {table.table_name}({field.field_name})"
+            for field in table.fields
+            if type(field) in SQLiteHandler.numeric_storage_converters]
+
+    def init_db_from_model(self, numeric_storage:bool=False) -> None:
+        """ Create/overwrite database based on model
+        numeric_storage will store lengths and dates as numbers, see SQLiteHandler """
 
         # Delete and recreate database
-        remove(self.database_path)
-        self.con = connect(self.database_path)
-        self.cur = self.con.cursor()
+        if exists(self.database_path): remove(self.database_path)
+        self._reconnect()
+        self.numeric_storage = numeric_storage
+        self._table_versions = {}
 
         # Create tables
         for table in self.data_model.tables:
             self.cur.execute("DROP TABLE IF EXISTS "+table.table_name)
-            self.cur.execute(get_table_sql(table))
+            self.cur.execute(self._get_table_sql(table))
+            if numeric_storage:
+                for index_sql in self._get_numeric_index_sql(table): self.cur.execute(index_sql)
+        if numeric_storage:
+            self.cur.execute(f"PRAGMA user_version = {SQLiteHandler.numeric_storage_version}")
+        self.con.commit()
+        self._notify_change(None)
+
+    def migrate_to_numeric_storage(self) -> None:
+        """ Convert the database to numeric storage of lengths and dates, see SQLiteHandler
+        SQLite can't change the type of a column, so each table is recreated and its data copied
+        Done in a single transaction, nothing changes if a value can't be converted """
+        if self.numeric_storage:
+            self.info(f"{self.database_path} already uses numeric storage")
+            return
         self.con.commit()
+        # Keep the foreign keys of the other tables pointing to the original table names
+        self.cur.execute("PRAGMA legacy_alter_table = ON")
+        self._table_versions = {}
+        try:
+            self.cur.execute("BEGIN")
+            self.numeric_storage = True
+            for table in self.data_model.tables:
+                fields = [f for f in table.fields if f.field_name != "display_name"]
+                field_names = ', '.join(f.field_name for f in fields)
+                rows = self.cur.execute(f"SELECT {field_names} FROM {table.table_name}").fetchall()
+                converted_rows = []
+                for row in rows:
+                    converted_row = []
+                    for field, value in zip(fields, row):
+                        if type(field) in SQLiteHandler.numeric_storage_converters \
+                                and value is not None:
+                            converted = \
+                                SQLiteHandler.numeric_storage_converters[type(field)][0](value)
+                            if converted is None: raise ValueError(
+                                f"Couldn't convert {value} for {field} in {table}, row {row}")
+                            value = converted
+                        converted_row.append(value)
+                    converted_rows.append(converted_row)
+                self.cur.execute(
+                    f"ALTER TABLE {table.table_name} RENAME TO {table.table_name}_text_storage")
+                self.cur.execute(self._get_table_sql(table))
+                self.cur.executemany(
+                    f"INSERT INTO {table.table_name} ({field_names}) " +\
+                        f"VALUES ({', '.join('?' for _ in fields)})",
+                    converted_rows)
+                self.cur.execute(f"DROP TABLE {table.table_name}_text_storage")
+                for index_sql in self._get_numeric_index_sql(table): self.cur.execute(index_sql)
+            self.cur.execute(f"PRAGMA user_version = {SQLiteHandler.numeric_storage_version}")
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            self.numeric_storage = False
+            raise
+        finally:
+            self.cur.execute("PRAGMA legacy_alter_table = OFF")
+            self._notify_change(None)
+
+    def aggregate(
+            self, table:Table|str, field:Field|str,
+            function:Literal["SUM", "AVG", "MIN", "MAX", "COUNT"]="SUM",
+            where_condition:Optional[str]=None) -> int|float|None:
+        """ Aggregate the values of a field, lengths in seconds and dates in epoch seconds
+        Runs in SQL, except for lengths and dates that are stored as text, which are converted
+        and aggregated in python """
+        if type(table) == str: table = self.data_model.get_table(table)
+        if type(field) == str: field = table.get_field(field)
+        if type(field) in SQLiteHandler.numeric_storage_converters and not self.numeric_storage:
+            batch = self.get_frame(table, columns=[field], where=where_condition)
+            to_number = SQLiteHandler.numeric_storage_converters[type(field)][0]
+            values = [to_number(value) for value, in batch.rows([field])]
+            values = [value for value in values if value is not None]
+            if function == "COUNT": return len(values)
+            if not values: return None
+            if function == "SUM": return sum(values)
+            if function == "AVG": return sum(values) / len(values)
+            if function == "MIN": return min(values)
+            if function == "MAX": return max(values)
+        sql = f"SELECT {function}({field.field_name}) FROM {table.table_name}"
+        if where_condition: sql += f" WHERE {where_condition}"
+        return self._run_query(sql, []).fetchone()[0]
 
     def export_db_model_to_spreadsheet(self, spreadsheet_path:str="db/database.ods") -> None:
         """ Overwrite spreadsheet data model with database model
@@ -188,30 +450,67 @@ class SQLiteHandler(DataHandler):
         """ Populates database data with spreadsheet data
         WARNING add or fail mode will fail if a spreadsheet record's display name already exists
         WARNING delete and add mode will delete all prior records in the table """
-        # Load spreadsheet data
-        excel_file = ExcelFile(spreadsheet_path)
-        data = {tab:clean_df(excel_file.parse(tab)) for tab in excel_file.sheet_names}
+        self._load_parsed_spreadsheets([parse_spreadsheet(spreadsheet_path)], mode)
+
+    def load_db_from_spreadsheets(
+            self, spreadsheet_paths:List[str],
+            mode:Literal["add or fail", "add or ignore", "update or add", "delete and add"
+                ]="update or add",
+            max_workers:Optional[int]=None
+            ) -> None:
+        """ Populates database data with the data of several spreadsheets
+        Spreadsheets are parsed in parallel in a process pool, then written by this process only,
+        table by table in foreign key dependency order
+        Tabs found in several spreadsheets are loaded in the order of the given paths
+        WARNING add or fail mode will fail if a spreadsheet record's display name already exists
+        WARNING delete and add mode will delete all prior records in the table, which means that
+        a tab will overwrite the same tab from a previous spreadsheet """
+        if len(spreadsheet_paths) < 2:
+            parsed = [parse_spreadsheet(path) for path in spreadsheet_paths]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                parsed = list(executor.map(parse_spreadsheet, spreadsheet_paths))
+        self._load_parsed_spreadsheets(parsed, mode)
+
+    def _load_parsed_spreadsheets(
+            self, parsed:List[Dict[str, Dict[str, List[Any]]]],
+            mode:Literal["add or fail", "add or ignore", "update or add", "delete and add"]
+            ) -> None:
+        """ Write the results of parse_spreadsheet to the database, see load_db_from_spreadsheets """
+        # Check for unknown tables before writing anything
+        for data in parsed:
+            for table_name in data: self.data_model.get_table(table_name)
         # Fill tables
-        for table_name in data:
-            # Check for unknown table or fields and get the existing ones
-            table = self.data_model.get_table(table_name)
-            fields = table.get_fields(data[table_name].columns)
-            fields = [f for f in fields if not f.automatic]
-            rows = [[i for i in row] for row in data[table_name].itertuples(index=False)]
-            # Empty the database table if requested
-            if mode == "delete and add": self.clear_table(table)
-            # DataFrame.to_sql doesn't fill generated fields so it cannot be used
-            # data[table_name].to_sql(name=table_name, con=self.con, if_exists="replace", index=False)
-            for row in rows:
-                to_add = Record(table, values={field:value for field, value in zip(fields, row)})
-                if mode=="add or fail" or mode=="delete and add":
-                    self.create_record_or_fail(to_add) 
-                elif mode=="update or add":
-                    self.create_or_update_record(to_add)
-                elif mode=="add or ignore":
-                    self.create_record_or_ignore(to_add)
-                else: raise ArgumentError(None, message=
-                    "mode must be one of: add or fail, update or add, delete and add, add or ignore")
+        for table in self.data_model.get_tables_in_dependency_order():
+            for data in parsed:
+                if table.table_name not in data: continue
+                columns = data[table.table_name]
+                # Check for unknown fields and get the existing ones
+                fields = table.get_fields(list(columns))
+                columns = [values for field, values in zip(fields, columns.values()) \
+                    if not field.automatic]
+                fields = [f for f in fields if not f.automatic]
+                # Filepaths are checked when written, their directories are listed once for all
+                PathCache().prefetch([value for field, values in zip(fields, columns) \
+                    if type(field) is FilepathField for value in values if type(value) is str])
+                rows = zip(*columns)
+                # Empty the database table if requested
+                if mode == "delete and add": self.clear_table(table)
+                # DataFrame.to_sql doesn't fill generated fields so it cannot be used
+                for row in rows:
+                    # Validated when written
+                    to_add = Record(
+                        table, values={field:value for field, value in zip(fields, row)},
+                        validate=False)
+                    if mode=="add or fail" or mode=="delete and add":
+                        self.create_record_or_fail(to_add)
+                    elif mode=="update or add":
+                        self.create_or_update_record(to_add)
+                    elif mode=="add or ignore":
+                        self.create_record_or_ignore(to_add)
+                    else: raise ArgumentError(None, message=
+                        "mode must be one of: add or fail, update or add, delete and add, add or ignore")
 
     def export_db_to_spreadsheet(
             self, table_names:Optional[List[str]]=[], spreadsheet_path:str="db/database_out.ods",
@@ -220,6 +519,7 @@ class SQLiteHandler(DataHandler):
         """ Create/overwrite spreadsheet data with database data
         It is recommended to specify which tables to export
         WARNING will delete the previous file if it exists """
+        from pandas import ExcelWriter, read_sql_query
 
         if table_names:
             # Double check tables
@@ -234,6 +534,16 @@ class SQLiteHandler(DataHandler):
         data = {
             table.table_name: read_sql_query(f"SELECT * from {table.table_name}", self.con)
             for table in tables}
+        # Export lengths and dates as text, whatever the storage
+        if self.numeric_storage:
+            for table in tables:
+                for field in table.fields:
+                    if type(field) in SQLiteHandler.numeric_storage_converters:
+                        # Missing values come back as nan from pandas
+                        data[table.table_name][field.field_name] = [
+                            None if value is None or value != value \
+                                else self._from_sql_value(field, int(value)) \
+                            for value in data[table.table_name][field.field_name].tolist()]
         
         # Delete existing spreadsheet if it exists
         if exists(spreadsheet_path): remove(spreadsheet_path)
@@ -249,6 +559,7 @@ class SQLiteHandler(DataHandler):
     
     def _parse_raw_data_into_record(self, data:List[List[Any]], table:Table) -> Record:
         """ Parse the results of a query fetchall into records"""
+        table_version = self.get_table_version(table)
         records = []
         for list_value in data:
             # SQLite does not actually support boolean type and saves it as text (in this case)
@@ -256,11 +567,12 @@ class SQLiteHandler(DataHandler):
             # Or https://stackoverflow.com/questions/4824687/how-to-include-a-boolean-in-an-sqlite-where-clause/16880803#16880803
             # Made the choice to convert to actual booleans in the data handler, since it's supposed to
             # be the interface between a DB that just happens to be SQLite, and the app data model
-            dict_values = {
-                field: eval(value) if type(field) is BoolField else value \
-                for field, value in zip(table.fields, list_value)
-            }
-            records.append(Record(table, dict_values))
+            row = [self._from_sql_value(field, value) \
+                for field, value in zip(table.fields, list_value)]
+            # Records from the database are trusted, no need to validate them again
+            record = Record.from_row(table, row, validate=False)
+            record.stamp(table_version)
+            records.append(record)
         return records
 
     def get_records(
@@ -271,19 +583,117 @@ class SQLiteHandler(DataHandler):
         if type(table) == str:
             table = self.data_model.get_table(table)
 
-        # Check or get sort by field
+        # Check or get sort by field, ID breaks the ties so that the order is always the same
         if sort_by and type(sort_by) is Record: sort_by = sort_by.field_name
-        elif table.sort_rows_by and not sort_by: sort_by = table.sort_rows_by.field_name
+        order_by = f"{sort_by}, ID" if sort_by else self._get_order_by_sql(table)
 
         # Build query
         data_query = f'''SELECT * FROM {table.table_name}'''
         if where_condition: data_query += f''' WHERE {where_condition}'''
-        if sort_by: data_query += f''' ORDER BY {sort_by}'''
+        data_query += f''' ORDER BY {order_by}'''
         
         # Fetch data
         data = self._run_query(data_query, []).fetchall()
         return self._parse_raw_data_into_record(data, table)
     
+    def get_frame(
+            self, table:Table|str, columns:Optional[List[Field|str]]=None,
+            where:Optional[str]=None) -> "RecordBatch":
+        """ Return the records of a table as a columnar RecordBatch, sorted like get_records
+        Columns default to all the fields of the table, ID is always included """
+        from db.batch import RecordBatch
+        if type(table) == str:
+            table = self.data_model.get_table(table)
+        if columns is None:
+            fields = table.fields
+        else:
+            fields = [table.get_field(c) if type(c) is str else c for c in columns]
+            if table.get_field("ID") not in fields: fields = [table.get_field("ID")] + fields
+
+        # Build query
+        data_query = f'''SELECT {', '.join(f.field_name for f in fields)} FROM {table.table_name}'''
+        if where: data_query += f''' WHERE {where}'''
+        data_query += f''' ORDER BY {self._get_order_by_sql(table)}'''
+
+        # Fetch data
+        data = self._run_query(data_query, []).fetchall()
+        sql_types = SQLiteHandler.py_to_sql_numeric_type_mapping if self.numeric_storage \
+            else SQLiteHandler.py_to_sql_type_mapping
+        return RecordBatch.from_rows(table, fields, data, sql_types)
+
+    def _get_order_by_sql(self, table:Table) -> str:
+        """ Order of the rows of a table, the only place they are sorted
+        ID breaks the ties so that the order is always the same, and pages don't overlap """
+        if table.sort_rows_by: return f"{table.sort_rows_by.field_name}, ID"
+        return "ID"
+
+    @staticmethod
+    def _to_search_text(value:Any, field_type_name:Optional[str]=None) -> str|None:
+        """ SQL function search_text(column[, field type name]), the text of a value as searched:
+        casefolded like in the SearchIndex of the tables, numeric lengths and dates formatted """
+        if value is None: return None
+        if field_type_name is not None:
+            value = SQLiteHandler.numeric_search_formatters[field_type_name](value)
+        return str(value).casefold()
+
+    def get_search_condition(self, fields:List[Field], text:str) -> str|None:
+        """ WHERE condition for the rows whose searchable columns, among fields, contain every word
+        of text, case insensitively; None if there is nothing to search
+        Values are searched as records show them, like TableWidget does for the rows in memory """
+        columns = []
+        for field in fields:
+            if type(field) not in SQLiteHandler.searchable_field_types: continue
+            if self.numeric_storage and type(field) in SQLiteHandler.numeric_storage_converters:
+                columns.append(f"search_text({field.field_name}, '{type(field).__name__}')")
+            else:
+                columns.append(f"search_text({field.field_name})")
+        words = text.casefold().split()
+        if not columns or not words: return None
+        conditions = []
+        for word in words:
+            # The condition is inlined in the queries, quotes are doubled
+            pattern = "'" + word.replace("'", "''") + "'"
+            conditions.append(
+                "(" + " OR ".join(f"instr({c}, {pattern}) > 0" for c in columns) + ")")
+        return " AND ".join(conditions)
+
+    def count_records(self, table:Table|str, where_condition:Optional[str]=None) -> int:
+        """ Number of records in a table """
+        if type(table) == str: table = self.data_model.get_table(table)
+        sql = f"SELECT COUNT(*) FROM {table.table_name}"
+        if where_condition: sql += f" WHERE {where_condition}"
+        return self._run_query(sql, []).fetchone()[0]
+
+    def get_rows(
+            self, table:Table|str, fields:List[Field], offset:int=0, limit:int=-1,
+            where_condition:Optional[str]=None) -> List[List[Any]]:
+        """ Return one page of the values of the given fields, converted like record values
+        and sorted like get_records; a limit of -1 returns all the rows after offset """
+        if type(table) == str: table = self.data_model.get_table(table)
+        sql = f"SELECT {', '.join(f.field_name for f in fields)} FROM {table.table_name}"
+        if where_condition: sql += f" WHERE {where_condition}"
+        sql += f" ORDER BY {self._get_order_by_sql(table)} LIMIT ? OFFSET ?"
+        return [[self._from_sql_value(field, value) for field, value in zip(fields, row)] \
+            for row in self._run_query(sql, [limit, offset]).fetchall()]
+
+    def get_row_number(
+            self, table:Table|str, ID:int, where_condition:Optional[str]=None) -> int|None:
+        """ Position of a record in the rows of get_rows, None if it isn't there """
+        if type(table) == str: table = self.data_model.get_table(table)
+        sql = f"SELECT ID, ROW_NUMBER() OVER (ORDER BY {self._get_order_by_sql(table)}) - 1 " +\
+            f"AS row_number FROM {table.table_name}"
+        if where_condition: sql += f" WHERE {where_condition}"
+        result = self._run_query(
+            f"SELECT row_number FROM ({sql}) WHERE ID = ?", [ID]).fetchone()
+        return result[0] if result else None
+
+    def get_record_by_ID(self, table:Table|str, ID:int) -> Record|None:
+        """ Return record from database, None if there is no record with that ID """
+        if type(table) == str: table = self.data_model.get_table(table)
+        data = self._run_query(f"SELECT * FROM {table.table_name} WHERE ID = ?", [ID]).fetchall()
+        records = self._parse_raw_data_into_record(data, table)
+        return records[0] if records else None
+
     def get_record(self, table:Table|str, display_name:str) -> Record:
         """ Return record from database """
         # If table name was given instead of table object, check it exists and get it
@@ -310,50 +720,133 @@ class SQLiteHandler(DataHandler):
         for record in existing_records:
             self.delete_record_or_fail(record)
 
+    def _get_names_and_values(self, record:Record) -> Tuple[List[str], List[Any]]:
+        """ Validate the record and return the names and database values of its (non automatic)
+        fields, to be written """
+        record.validate()
+        fields = [
+            field for field in record.parent_table.non_automatic_fields if field in record.values]
+        field_names = [field.field_name for field in fields]
+        values = [self._to_sql_value(field, record.values[field]) for field in fields]
+        return field_names, values
+
     def create_or_update_record(self, record:Record) -> None:
         """ Add a record in the database, update it if it already exists """
-        fields = [field for field in record.values if not field.automatic]
-        values = [f'"{record.values[field]}"' for field in fields]
-        field_names = [field.field_name for field in fields]
+        field_names, values = self._get_names_and_values(record)
         sql = f"INSERT INTO {record.parent_table.table_name} ({', '.join(field_names)})"
-        sql += f" VALUES ({', '.join(values)}) ON CONFLICT(display_name) DO UPDATE SET "
-        sql += ', '.join(f'{field}={value}' for field, value in zip(field_names, values))
+        sql += f" VALUES ({', '.join('?' for _ in values)}) ON CONFLICT(display_name) DO UPDATE SET "
+        sql += ', '.join(f'{field}=excluded.{field}' for field in field_names)
         sql += ";"
-        self._run_query(sql, [])
+        self._run_query(sql, values)
+        self._notify_change(record.parent_table)
 
     def create_record_or_fail(self, record:Record) -> None:
         """ Add a record in the database, fail if it already exists """
-        fields = [field for field in record.values if not field.automatic]
-        values = [f'"{record.values[field]}"' for field in fields]
-        field_names = [field.field_name for field in fields]
+        field_names, values = self._get_names_and_values(record)
         sql = f"INSERT OR FAIL INTO {record.parent_table.table_name} "
-        sql += f"({', '.join(field_names)}) VALUES ({', '.join(values)});"
-        self._run_query(sql, [])
+        sql += f"({', '.join(field_names)}) VALUES ({', '.join('?' for _ in values)});"
+        self._run_query(sql, values)
+        self._notify_change(record.parent_table)
+
+    def create_records_or_fail(self, records:List[Record]) -> None:
+        """ Add records of a same table in the database in a single transaction, fail and add none
+        of them if one already exists """
+        if not records: return
+        table = records[0].parent_table
+        field_names, _ = self._get_names_and_values(records[0])
+        rows = []
+        for record in records:
+            record_field_names, values = self._get_names_and_values(record)
+            if record.parent_table != table or record_field_names != field_names:
+                raise ValueError(f"{record} doesn't have the same table and fields as {records[0]}")
+            rows.append(values)
+        sql = f"INSERT OR FAIL INTO {table.table_name} "
+        sql += f"({', '.join(field_names)}) VALUES ({', '.join('?' for _ in field_names)});"
+        try:
+            self.cur.executemany(sql, rows)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        self._notify_change(table)
+
+    def write_record_updates(self, records:List[Record]) -> List[Exception|None]:
+        """ Update records in a single transaction, each one in its own savepoint so that one that
+        can't be written doesn't prevent the others from being written
+        Return the error of each record, None for the ones that were written; the whole
+        transaction fails if the database can't be written, e.g. if it's locked """
+        errors = []
+        try:
+            if not self.con.in_transaction: self.cur.execute("BEGIN")
+            for record in records:
+                self.cur.execute("SAVEPOINT record_update")
+                try:
+                    field_names, values = self._get_names_and_values(record)
+                    sql = f"UPDATE OR FAIL {record.parent_table.table_name} SET "
+                    sql += ', '.join([f'{f}=?' for f in field_names])
+                    sql += f" WHERE ID = ?;"
+                    self.cur.execute(sql, values + [record.ID])
+                    if self.cur.rowcount == 0: raise ValueError(f"{record} isn't in the database")
+                    errors.append(None)
+                except (ValueError, IntegrityError) as e:
+                    self.cur.execute("ROLLBACK TO record_update")
+                    errors.append(e)
+                self.cur.execute("RELEASE record_update")
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        for table in {record.parent_table for record in records}: self._notify_change(table)
+        return errors
 
     def create_record_or_ignore(self, record:Record) -> None:
         """ Add a record in the database, pass if it already exists """
-        fields = [field for field in record.values if not field.automatic]
-        values = [f'"{record.values[field]}"' for field in fields]
-        field_names = [field.field_name for field in fields]
+        field_names, values = self._get_names_and_values(record)
         sql = f"INSERT OR IGNORE INTO {record.parent_table.table_name} "
-        sql += f"({', '.join(field_names)}) VALUES ({', '.join(values)});"
-        self._run_query(sql, [])
+        sql += f"({', '.join(field_names)}) VALUES ({', '.join('?' for _ in values)});"
+        self._run_query(sql, values)
+        self._notify_change(record.parent_table)
     
     def update_record_or_fail(self, record:Record) -> None:
         """ Update a record in the database, fail if it doesn't exist """
-        fields = [field for field in record.values if not field.automatic]
-        values = [f'"{record.values[field]}"' for field in fields]
-        field_names = [field.field_name for field in fields]
+        field_names, values = self._get_names_and_values(record)
         sql = f"UPDATE OR FAIL {record.parent_table.table_name} SET "
-        sql += ', '.join([f'{f}={v}' for f, v in zip(field_names, values)])
-        sql += f" WHERE ID = {record.ID};"
-        self._run_query(sql, [])
+        sql += ', '.join([f'{f}=?' for f in field_names])
+        sql += f" WHERE ID = ?;"
+        self._run_query(sql, values + [record.ID])
+        self._notify_change(record.parent_table)
+
+    def update_records_or_fail(self, table:Table|str, IDs:List[int], values:Dict[Field, Any]) -> None:
+        """ Set the same values to the records of the given IDs with set-based updates, in a single
+        transaction, fail and update none of them if a value isn't acceptable or a display name
+        ends up duplicated """
+        if type(table) == str: table = self.data_model.get_table(table)
+        if not IDs or not values: return
+        for field, value in values.items():
+            if field.automatic or not field.validate(value):
+                raise ValueError(f"Value {value} is not acceptable for field {field} in {table}")
+        sql = f"UPDATE OR FAIL {table.table_name} SET "
+        sql += ', '.join(f'{field.field_name}=?' for field in values)
+        sql_values = [self._to_sql_value(field, value) for field, value in values.items()]
+        IDs = [int(ID) for ID in IDs]
+        try:
+            # Bound parameters are limited, a statement per chunk of IDs
+            for start in range(0, len(IDs), SQLiteHandler.max_IDs_per_query):
+                chunk = IDs[start:start+SQLiteHandler.max_IDs_per_query]
+                self.cur.execute(
+                    sql + f" WHERE ID IN ({', '.join('?' for _ in chunk)});", sql_values + chunk)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        self._notify_change(table)
     
     def delete_record_or_ignore(self, record:Record) -> None:
         """ Delete a record in the database, pass if it doesn't exist """
         sql = f'DELETE FROM {record.parent_table.table_name} '
         sql += f'WHERE ID = {record.ID}'
         self._run_query(sql, [])
+        self._notify_change(record.parent_table)
 
     def delete_record_or_fail(self, record:Record) -> None:
         """ Delete a record in the database, fail if it doesn't exist """
@@ -366,7 +859,7 @@ class SQLiteHandler(DataHandler):
 if __name__ == "__main__":
     handler = SQLiteHandler(database_path="db/podfics.db", datamodel_path="db/datamodel.ods")
     handler.init_db_from_model()
-    handler.load_db_from_spreadsheet(spreadsheet_path="db/datamodel.ods", mode="delete and add")
-    handler.load_db_from_spreadsheet(spreadsheet_path="db/set_options.ods", mode="delete and add")
-    handler.load_db_from_spreadsheet(spreadsheet_path="db/parameter.ods", mode="delete and add")
+    handler.load_db_from_spreadsheets(
+        spreadsheet_paths=["db/datamodel.ods", "db/set_options.ods", "db/parameter.ods"],
+        mode="delete and add")
     handler.export_db_to_spreadsheet(spreadsheet_path="db/database_out.ods")
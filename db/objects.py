@@ -3,40 +3,82 @@ A DataModel object, instanciated from an excel datamodel file, contains Table ob
 which contain Field objects
 Records are not saved in the DataModel or Table objects but have a link back to their parent Table """
 
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Union
-from numpy import nan
-from pandas import DataFrame, ExcelFile
-from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta, timezone
 from re import compile as re_compile
-from os.path import exists as path_exists
+from os import replace, stat
+from hashlib import sha256
+from pickle import dump, load, HIGHEST_PROTOCOL
 
 
 from src.base_object import BaseObject
+from db.path_cache import PathCache
+
+# pandas and numpy are slow to import and only needed to parse spreadsheets, imported when needed
+if TYPE_CHECKING: from pandas import DataFrame
 
 
 def display_name_concat(to_concat:List[str]) -> str:
     """ Concatenate display name parts """
-    return " - ".join(to_concat)
+    return DisplayNameComposer.separator.join(to_concat)
+
+
+class DisplayNameComposer:
+    """ Builds the display names of the records of a table, from the fields that are part of it
+    The values are converted to text and joined, in the order of the fields; the database applies
+    the same rule in the display_name generated column, see sql_expression
+    Built once per table by Table.reindex_fields """
+    __slots__ = ("fields", "positions", "target_position")
+    separator = " - "
+
+    def __init__(self, fields:List["Field"], positions:List[int], target_position:int|None):
+        self.fields = tuple(fields)
+        self.positions = tuple(positions)
+        # Position of the display_name field itself, None while the model is being built
+        self.target_position = target_position
 
+    def compose(self, values:Sequence[Any]) -> str:
+        """ Display name from the list of values of a record, missing values are left out """
+        return display_name_concat(
+            [str(values[i]) for i in self.positions if values[i] is not _MISSING])
 
-def clean_df(df:DataFrame) -> DataFrame:
+    def sql_expression(self, column_sql:Callable[["Field"], str]=lambda f: f.field_name) -> str:
+        """ SQL expression of the display name, column_sql gives the text expression of a field """
+        if not self.fields: return "''"
+        return f" || '{DisplayNameComposer.separator}' || ".join(
+            column_sql(field) for field in self.fields)
+
+
+def clean_df(df:"DataFrame") -> "DataFrame":
     """ Clean dataframe """
+    from numpy import nan
     df.dropna(how="all", inplace=True)
     df.fillna(nan, inplace=True)
     df.replace([nan], [None], inplace=True)
     return df
 
     
+def file_sha256(path:str) -> str:
+    """ Hash of the contents of a file """
+    file_hash = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+    
+datetime_format = "%Y-%m-%d %H:%M:%S"  # YYYY-MM-DD HH:MM:SS
+timedelta_regex = re_compile(r'^(?P<hours>\d+?):(?P<minutes>\d{2}):(?P<seconds>\d{2})$')
+
 def parse_datetime_format(value:str) -> datetime|None:
     try:
-        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")  # # YYYY-MM-DD HH:MM:SS
+        return datetime.strptime(value, datetime_format)
     except ValueError as e:
         return None
     
 def parse_timedelta_format(value:str) -> timedelta|None:
-    regex = re_compile(r'^(?P<hours>\d+?):(?P<minutes>\d{2}):(?P<seconds>\d{2})$')
-    parts = regex.match(value)
+    parts = timedelta_regex.match(value)
     if not parts: return None
     parts = parts.groupdict()
     time_params = {}
@@ -45,13 +87,50 @@ def parse_timedelta_format(value:str) -> timedelta|None:
             time_params[name] = int(param)
     return timedelta(**time_params)
 
+def format_timedelta_seconds(seconds:int) -> str:
+    """ Format a number of seconds the way parse_timedelta_format reads it, HH:MM:SS """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def length_to_seconds(value:Any) -> int|None:
+    """ Convert a length, as HH:MM:SS text or already in seconds, to seconds """
+    if type(value) is int: return value
+    if type(value) is not str: return None
+    length = parse_timedelta_format(value)
+    return int(length.total_seconds()) if length is not None else None
+
+def datetime_to_epoch(value:Any) -> int|None:
+    """ Convert a date, as YYYY-MM-DD HH:MM:SS text or already in seconds, to epoch seconds
+    Dates are UTC, like the creation dates SQLite generates """
+    if type(value) is int: return value
+    if type(value) is not str: return None
+    date = parse_datetime_format(value)
+    return int(date.replace(tzinfo=timezone.utc).timestamp()) if date is not None else None
+
+def format_epoch(seconds:int) -> str:
+    """ Format epoch seconds the way parse_datetime_format reads it """
+    return datetime.fromtimestamp(int(seconds), timezone.utc).strftime(datetime_format)
+
 
 class BaseDataObject(BaseObject):
     """ Data or data model base object class to be inherited from """
+    __slots__ = ("display_name",)
+
     def __init__(self, display_name:str) -> None:
         super().__init__()
         self.display_name = display_name
 
+    def __getstate__(self):
+        # display_name is a slot, it isn't in __dict__
+        state = super().__getstate__()
+        state["display_name"] = self.display_name
+        return state
+
+    def __setstate__(self, state):
+        self.display_name = state.pop("display_name")
+        super().__setstate__(state)
+
     def __str__(self) -> str:
         return self.display_name  # .replace("_"," ")
     def __repr__(self) -> str:
@@ -135,7 +214,7 @@ class FilepathField(Field):
     def validate(self, value:Any) -> bool:
         if (type(value)) is not str: return False
         if self.mandatory and value == "": return False
-        return path_exists(value)
+        return PathCache().exists(value)
 
 class LengthField(Field):
     def validate(self, value:Any) -> bool:
@@ -159,8 +238,19 @@ spreadsheet_to_py_type_mapping = {
 
 
 class Table(BaseDataObject):
-    """ Table in a DataModel, contains Fields """
-    __hash__ = BaseObject.__hash__
+    """ Table in a DataModel, contains Fields
+    Fields are indexed by name, and a few filtered views of the fields are precomputed:
+    editable_fields, non_automatic_fields, display_name_fields and foreign_key_fields, as well as
+    the display_name_composer of the records
+    They are refreshed when fields are set, reindex_fields has to be called if they are modified
+    in place
+    The structure of the table (name, field names and types) is summed up in a fingerprint, used
+    for equality; hashing only uses the name, which doesn't change, the fields can change while
+    the table is a dict key, e.g. in the OptionCache """
+
+    # Precomputed attributes, not pickled
+    _precomputed = ("editable_fields", "non_automatic_fields", "display_name_fields",
+        "foreign_key_fields", "display_name_composer", "fingerprint")
     
     def __init__(
             self, table_name:str, fields:Optional[List[Field]] = [],
@@ -170,66 +260,190 @@ class Table(BaseDataObject):
         self.sort_rows_by = sort_rows_by
         self.fields = fields
 
+    @property
+    def fields(self) -> List[Field]:
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields:List[Field]) -> None:
+        self._fields = fields
+        self.reindex_fields()
+
+    def reindex_fields(self) -> None:
+        """ Rebuild the field name index and the field views """
+        self._fields_by_name = {}
+        self._duplicate_field_names = set()
+        self._field_positions = {field: i for i, field in enumerate(self._fields)}
+        for field in self._fields:
+            if field.field_name in self._fields_by_name:
+                self._duplicate_field_names.add(field.field_name)
+            self._fields_by_name[field.field_name] = field
+        self.editable_fields = [f for f in self._fields if f.editable]
+        self.non_automatic_fields = [f for f in self._fields if not f.automatic]
+        self.display_name_fields = [f for f in self._fields if f.part_of_display_name]
+        self.foreign_key_fields = [f for f in self._fields if f.foreign_key_table]
+        display_name_field = self._fields_by_name.get("display_name")
+        self.display_name_composer = DisplayNameComposer(
+            self.display_name_fields,
+            [self._field_positions[f] for f in self.display_name_fields],
+            self._field_positions[display_name_field] if display_name_field else None)
+        self.fingerprint = hash((
+            self.table_name, tuple((type(f).__name__, f.field_name) for f in self._fields)))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for attribute in Table._precomputed: state.pop(attribute, None)
+        state["fields"] = self._fields
+        return state
+
+    def __setstate__(self, state):
+        fields = state.pop("fields")
+        super().__setstate__(state)
+        self.fields = fields
 
     def get_field(self, field_name:str) -> Field:
         """ Fetch one field based on field name """
-        found_fields = [field for field in self.fields if field.field_name==field_name]
-        if len(found_fields) == 0: raise NameError(
-            f"Coudln't find field {field_name} in table {self} in data model")
-        if len(found_fields) > 1: raise NameError(
+        if field_name in self._duplicate_field_names: raise NameError(
             f"Found several field {field_name} in table {self} in data model")
-        return found_fields[0]
+        try:
+            return self._fields_by_name[field_name]
+        except KeyError:
+            raise NameError(f"Coudln't find field {field_name} in table {self} in data model")
     
     def get_fields(self, field_names:List[str]) -> List[Field]:
         """ Fetch several fields based on field names """
         fields = [self.get_field(field_name) for field_name in field_names]
         return fields
+
+    def get_field_position(self, field:Field|str) -> int:
+        """ Position of the field in the table, raise KeyError if it isn't a field of the table """
+        if type(field) is str: field = self.get_field(field)
+        return self._field_positions[field]
     
+    def __hash__(self):
+        return hash(self.table_name)
+
     def __eq__(self, other) -> bool:
+        if self is other: return True
         if not type(other) is type(self): return False
-        if not self.table_name == other.table_name: return False
-        if not len(self.fields) == len(other.fields): return False
-        for f in self.fields:
-            if not f in other.fields:
-                return False
-        return True
+        return self.fingerprint == other.fingerprint and self.table_name == other.table_name
     
 
+class _Missing:
+    """ Placeholder for the values of the fields that weren't given to a record """
+    __slots__ = ()
+    def __repr__(self) -> str: return "<missing>"
+    def __reduce__(self): return "_MISSING"
+
+_MISSING = _Missing()
+
+
+class RecordValues(MutableMapping):
+    """ Dict-like view of the values of a record, {Field: value}, in the order of the table fields
+    Fields that weren't given to the record are not part of the view """
+    __slots__ = ("_record",)
+
+    def __init__(self, record) -> None:
+        self._record = record
+
+    def __getitem__(self, field:Field) -> Any:
+        value = self._record._values[self._record.parent_table.get_field_position(field)]
+        if value is _MISSING: raise KeyError(field)
+        return value
+
+    def __setitem__(self, field:Field, value:Any) -> None:
+        self._record._values[self._record.parent_table.get_field_position(field)] = value
+        self._record._stamp = None
+
+    def __delitem__(self, field:Field) -> None:
+        self[field]  # KeyError if missing
+        self._record._values[self._record.parent_table.get_field_position(field)] = _MISSING
+        self._record._stamp = None
+
+    def __iter__(self) -> Iterator[Field]:
+        for field, value in zip(self._record.parent_table.fields, self._record._values):
+            if value is not _MISSING: yield field
+
+    def __len__(self) -> int:
+        return sum(1 for value in self._record._values if value is not _MISSING)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
 class Record(BaseDataObject):
     """ Record in a table
     Records are not loaded in the DataModel or the Table
-    ID and display_name can be empty if the record doesn't exist in the database yet """
-    __hash__ = BaseObject.__hash__
+    ID and display_name can be empty if the record doesn't exist in the database yet
+    Values are stored in a list, in the order of the fields of the parent table, and can be
+    accessed as a dict through record.values
+    Values are validated at creation, except for trusted sources (the database), use validate=False
+    The handler validates records again before writing them
+    Records read from the database are stamped with the version of the table they were read from
+    and their ID, which makes comparing them cheap; modifying the values removes the stamp """
+    __slots__ = ("parent_table", "_values", "_stamp")
+
     def __init__(
             self, parent_table:Table,
-            values:Dict[Field, Any]) -> None:
+            values:Dict[Field, Any], validate:bool=True) -> None:
         super().__init__("")
         self.parent_table = parent_table
+        self._stamp = None
+        self._values = [_MISSING] * len(parent_table.fields)
+        for field, value in values.items():
+            self._values[parent_table.get_field_position(field)] = value
+        self._init_values(validate)
+
+    @classmethod
+    def from_row(cls, parent_table:Table, row:Sequence[Any], validate:bool=True):
+        """ Create a record from a list of values for all the fields of the table, in order """
+        record = cls.__new__(cls)
+        record.parent_table = parent_table
+        record._stamp = None
+        record._values = list(row)
+        record._init_values(validate)
+        return record
+
+    def _init_values(self, validate:bool) -> None:
+        """ Set the automatic fields if needed, validate the values and the display name """
         # ID and creation date fields
         # Values are automatically generated by the database
-        ID_field = parent_table.get_field("ID")
-        if ID_field not in values:
-            self.ID = None
-            values[ID_field] = None
-        else:
-            self.ID = values[ID_field]
-        creation_date_field = parent_table.get_field("creation_date")
-        if creation_date_field not in values:
-            self.creation_date = None
-            values[creation_date_field] = None
-        else:
-            self.creation_date = values[creation_date_field]
-        # All values are kept
-        self.values = values
-        # Validate values
-        for field, value in self.values.items():
-            if not field.automatic and not field.validate(value):
-                raise ValueError(
-                    f"Value {value} is not acceptable for field {field} in {parent_table}\n" +\
-                        str(self.values))
+        for field_name in ["ID", "creation_date"]:
+            position = self.parent_table.get_field_position(field_name)
+            if self._values[position] is _MISSING: self._values[position] = None
+        if validate: self.validate()
         # Display name is also managed by the database but can change
         # and needs to be known by the python program
         self.recalculate_display_name()
+
+    def validate(self) -> None:
+        """ Raise a ValueError if any of the (non automatic) values is not acceptable """
+        for field, value in zip(self.parent_table.fields, self._values):
+            if value is not _MISSING and not field.automatic and not field.validate(value):
+                raise ValueError(
+                    f"Value {value} is not acceptable for field {field} in {self.parent_table}\n" +\
+                        str(self.values))
+
+    @property
+    def values(self) -> RecordValues:
+        return RecordValues(self)
+
+    @property
+    def ID(self) -> int|None:
+        return self._values[self.parent_table.get_field_position("ID")]
+
+    @property
+    def creation_date(self) -> str|None:
+        return self._values[self.parent_table.get_field_position("creation_date")]
+
+    def __getstate__(self):
+        return {"parent_table": self.parent_table, "values": self._values}
+
+    def __setstate__(self, state):
+        self.parent_table = state["parent_table"]
+        self._stamp = None
+        self._values = state["values"]
+        self.recalculate_display_name()
     
     def __repr__(self) -> str:
         return f"({self.parent_table}) {self}"
@@ -240,15 +454,25 @@ class Record(BaseDataObject):
     def __hash__(self):
         return hash((hash(type(self).__name__), self.ID, hash(self.display_name)))
     
+    def stamp(self, table_version:int) -> None:
+        """ Mark the record as read from the database, when the table was at the given version """
+        self._stamp = (table_version, self.ID)
+
     def __eq__(self, other):
+        if self is other:
+            return True
         if not type(other) is type(self):
             return False
         if not self.parent_table == other.parent_table:
             return False
-        if not len(self.values) == len(other.values):
-            return False
-        for f in self.parent_table.fields:
-            if self.values[f] != other.values[f] and self.values[f]:
+        # Records read from the same version of a table are the same if they are the same row
+        if self._stamp is not None and other._stamp is not None \
+                and self._stamp[0] == other._stamp[0]:
+            return self._stamp[1] == other._stamp[1]
+        for value, other_value in zip(self._values, other._values):
+            if (value is _MISSING) != (other_value is _MISSING):
+                return False
+            if value != other_value and value:
                 return False
         return True
 
@@ -261,21 +485,100 @@ class Record(BaseDataObject):
             SQLiteHandler().update_record_or_fail(self)
     
     def recalculate_display_name(self):
-        """ """
-        self.display_name = display_name_concat([self.values[field] for field in self.values if field.part_of_display_name])
-        self.values[self.parent_table.get_field("display_name")] = self.display_name
+        """ Update the display name from the values, with the composer of the parent table """
+        composer = self.parent_table.display_name_composer
+        self.display_name = composer.compose(self._values)
+        if composer.target_position is not None:
+            self._values[composer.target_position] = self.display_name
 
 
 
 class DataModel(BaseObject):
-    """ Data model, contains Tables, which contain Fields """
+    """ Data model, contains Tables, which contain Fields
+    Parsing the spreadsheet is slow, so the parsed model is cached in a pickle file next to it,
+    keyed by the modification time and the hash of the spreadsheet """
+
+    # To increase whenever Table or Field change in a way that makes older caches unusable
+    cache_version = 3
+    # {spreadsheet hash: tables}, so that reloading an unchanged model gives the same objects
+    _interned_tables = {}
+
     def __init__(self, spreadsheet_path:str="db/datamodel.ods"):
         super().__init__()
         self.spreadsheet_path = spreadsheet_path
-        self.load_db_model_from_spreadsheet()
+        self.cache_path = spreadsheet_path + ".cache"
+        self.load_db_model()
+
+    @property
+    def tables(self) -> List[Table]:
+        return self._tables
+
+    @tables.setter
+    def tables(self, tables:List[Table]) -> None:
+        self._tables = tables
+        self._tables_by_name = {}
+        self._duplicate_table_names = set()
+        for table in tables:
+            if table.table_name in self._tables_by_name:
+                self._duplicate_table_names.add(table.table_name)
+            self._tables_by_name[table.table_name] = table
+
+    def load_db_model(self) -> None:
+        """ Load tables and fields from the cache if it is up to date, from the spreadsheet if not
+        Tables are interned: if the same model was already loaded, its tables are reused """
+        self.spreadsheet_hash = None
+        if not self.load_db_model_from_cache():
+            self.load_db_model_from_spreadsheet()
+            self.save_db_model_to_cache()
+        if not self.spreadsheet_hash: self.spreadsheet_hash = file_sha256(self.spreadsheet_path)
+        if self.spreadsheet_hash in DataModel._interned_tables:
+            self.tables = DataModel._interned_tables[self.spreadsheet_hash]
+        else:
+            DataModel._interned_tables[self.spreadsheet_hash] = self.tables
+
+    def load_db_model_from_cache(self) -> bool:
+        """ Load tables and fields from the cache, return False if there is no usable cache
+        If only the modification time of the spreadsheet changed, the cache is updated and used """
+        try:
+            with open(self.cache_path, "rb") as f:
+                cache = load(f)
+            if cache["version"] != DataModel.cache_version: return False
+            spreadsheet_stat = stat(self.spreadsheet_path)
+            if (cache["mtime"], cache["size"]) != \
+                    (spreadsheet_stat.st_mtime_ns, spreadsheet_stat.st_size):
+                if cache["sha256"] != file_sha256(self.spreadsheet_path): return False
+                self.tables = cache["tables"]
+                self.save_db_model_to_cache(cache["sha256"])
+                return True
+            self.tables = cache["tables"]
+            self.spreadsheet_hash = cache["sha256"]
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.debug(f"Couldn't use data model cache {self.cache_path}", exc_info=e)
+            return False
+
+    def save_db_model_to_cache(self, spreadsheet_hash:Optional[str]=None) -> None:
+        """ Save tables and fields to the cache, failing silently (apart from debug logs) """
+        try:
+            spreadsheet_stat = stat(self.spreadsheet_path)
+            self.spreadsheet_hash = spreadsheet_hash or file_sha256(self.spreadsheet_path)
+            cache = {
+                "version": DataModel.cache_version,
+                "mtime": spreadsheet_stat.st_mtime_ns, "size": spreadsheet_stat.st_size,
+                "sha256": self.spreadsheet_hash,
+                "tables": self.tables}
+            # Write then rename, so that a crash can't leave a half-written cache
+            with open(self.cache_path+".tmp", "wb") as f:
+                dump(cache, f, protocol=HIGHEST_PROTOCOL)
+            replace(self.cache_path+".tmp", self.cache_path)
+        except Exception as e:
+            self.debug(f"Couldn't save data model cache {self.cache_path}", exc_info=e)
     
     def load_db_model_from_spreadsheet(self) -> None:
         """ Load tables and fields based on spreadsheet """
+        from pandas import ExcelFile
         # Load model in dataframes
         excel_file = ExcelFile(self.spreadsheet_path)
         data_table_df = clean_df(excel_file.parse("data_table"))
@@ -320,10 +623,33 @@ class DataModel(BaseObject):
             for field in table.fields:
                 field.foreign_key_table = self.get_table(field.foreign_key_table) \
                     if field.foreign_key_table else None
+            table.reindex_fields()
             
     def get_table(self, table_name:str) -> Table:
         """ Fetch table based on table name """
-        found_tables = [table for table in self.tables if table.table_name==table_name]
-        if len(found_tables) == 0: raise NameError(f"Coudln't find table {table_name} in data model")
-        if len(found_tables) > 1: raise NameError(f"Found several {table_name} in data model")
-        return found_tables[0]
+        if table_name in self._duplicate_table_names:
+            raise NameError(f"Found several {table_name} in data model")
+        try:
+            return self._tables_by_name[table_name]
+        except KeyError:
+            raise NameError(f"Coudln't find table {table_name} in data model")
+
+    def get_tables_in_dependency_order(self) -> List[Table]:
+        """ Return the tables sorted so that any table comes after the tables its foreign keys
+        point to, model order otherwise
+        Self-references are ignored, tables caught in a cycle are added at the end in model order """
+        dependencies = {table: {
+                field.foreign_key_table for field in table.foreign_key_fields
+                if field.foreign_key_table is not table}
+            for table in self.tables}
+        ordered = []
+        remaining = list(self.tables)
+        while remaining:
+            ready = [table for table in remaining if dependencies[table].issubset(ordered)]
+            if not ready:
+                self.debug(f"Foreign key cycle between tables {remaining}, keeping model order")
+                ordered += remaining
+                break
+            ordered += ready
+            remaining = [table for table in remaining if table not in ready]
+        return ordered
@@ -0,0 +1,67 @@
+""" Cached file existence checks
+Checking files one stat at a time is slow when they live on a network or external drive, so the
+entries of a whole directory are listed at once with os.scandir and kept for a little while """
+
+from os import scandir
+from os.path import exists, split
+from time import monotonic
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+from src.base_object import BaseObject, Singleton
+
+
+class PathCache(BaseObject, metaclass=Singleton):
+    """ Cache of directory listings, used to check whether paths exist
+    Listings expire after ttl seconds; paths that can't be checked from a listing (".", "..",
+    trailing slashes, unreadable directories) fall back to os.path.exists
+    Only the paths found in a listing are trusted, a path missing from it is checked again with
+    os.path.exists, it might have been created since the listing, e.g. a file just picked """
+
+    def __init__(self, ttl:float=30.):
+        super().__init__()
+        self.ttl = ttl
+        # {directory: (listing time, names of the entries or None if it couldn't be listed)}
+        self._listings:Dict[str, Tuple[float, Optional[Set[str]]]] = {}
+
+    def exists(self, path:str) -> bool:
+        """ Whether the path exists, as os.path.exists would say (symlinks are followed) """
+        directory, name = split(path)
+        if name in ["", ".", ".."]: return exists(path)
+        entries = self._get_entries(directory)
+        if entries is not None and name in entries: return True
+        # Misses are rare, and the listing is outdated if the path exists now
+        if not exists(path): return False
+        self.invalidate(path)
+        return True
+
+    def prefetch(self, paths:Iterable[str]) -> None:
+        """ List the directories of all the given paths in one go """
+        for directory in {split(path)[0] for path in paths}:
+            self._get_entries(directory)
+
+    def invalidate(self, path:Optional[str]=None) -> None:
+        """ Forget the listing of the directory containing the path, or of all directories """
+        if path is None:
+            self._listings = {}
+        else:
+            self._listings.pop(split(path)[0], None)
+            self._listings.pop(path, None)
+
+    def _get_entries(self, directory:str) -> Optional[Set[str]]:
+        """ Names of the entries of the directory, from the cache if it hasn't expired """
+        now = monotonic()
+        cached = self._listings.get(directory)
+        if cached and now - cached[0] < self.ttl: return cached[1]
+        try:
+            with scandir(directory or ".") as entries:
+                # Broken symlinks don't exist for os.path.exists
+                names = {entry.name for entry in entries \
+                    if not entry.is_symlink() or exists(entry.path)}
+        except (FileNotFoundError, NotADirectoryError):
+            names = set()
+        except OSError as e:
+            self.debug(f"Couldn't list {directory}, checking paths one by one", exc_info=e)
+            names = None
+        self._listings[directory] = (now, names)
+        return names
@@ -0,0 +1,143 @@
+""" Background loading, to keep slow queries off the GTK main loop
+Fetches run in worker threads (the database handler gives each thread its own connection), their
+results are handed back to the main loop with GLib.idle_add """
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, List, Optional
+from gi.repository import GLib
+
+
+from src.base_object import BaseObject
+
+
+# Shared by all the widgets, a couple of threads is enough for SQLite reads
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background_load")
+# Number of fetches whose result hasn't been handed back yet
+_pending = 0
+_pending_lock = Lock()
+
+
+def _add_pending(n:int) -> None:
+    global _pending
+    with _pending_lock: _pending += n
+
+
+def has_pending_work() -> bool:
+    """ Whether fetches are running or waiting for the main loop, e.g. to wait for a widget to be
+    loaded in benchmarks """
+    return _pending > 0
+
+
+class LoadRequest:
+    """ Cancellation token of a background load """
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+def run_in_background(
+        fetch:Callable[[], Any], on_result:Callable[[Any], None],
+        on_error:Callable[[Exception], None], request:Optional[LoadRequest]=None) -> None:
+    """ Call fetch() in a worker thread, then on_result(result) or on_error(exception) in the main
+    loop, unless the request was cancelled in the meantime """
+    def deliver(callback:Callable, value:Any) -> bool:
+        try:
+            if request is None or not request.cancelled: callback(value)
+        finally:
+            _add_pending(-1)
+        return False  # Don't call again
+
+    def work() -> None:
+        # Requests can be cancelled while waiting for a thread
+        if request is not None and request.cancelled:
+            _add_pending(-1)
+            return
+        try:
+            result = fetch()
+        except Exception as e:
+            GLib.idle_add(deliver, on_error, e)
+        else:
+            GLib.idle_add(deliver, on_result, result)
+
+    _add_pending(1)
+    _executor.submit(work)
+
+
+class BackgroundLoader(BaseObject):
+    """ Loads the data of one widget in the background, one load at a time
+    Starting a new load cancels the previous one, whose results are dropped
+    on_loading_changed(loading:bool) is called when loading starts and stops, e.g. for a spinner """
+
+    def __init__(self, on_loading_changed:Callable[[bool], None]=lambda loading: None,
+            chunk_size:int=200):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self._on_loading_changed = on_loading_changed
+        self._request = None
+
+    @property
+    def loading(self) -> bool:
+        return self._request is not None
+
+    def cancel(self) -> None:
+        """ Cancel the current load, if any """
+        if self._request is None: return
+        self._request.cancel()
+        self._request = None
+        self._on_loading_changed(False)
+
+    def _start(self) -> LoadRequest:
+        if self._request is not None: self._request.cancel()
+        else: self._on_loading_changed(True)
+        self._request = LoadRequest()
+        return self._request
+
+    def _stop(self, request:LoadRequest) -> None:
+        if self._request is request:
+            self._request = None
+            self._on_loading_changed(False)
+
+    def _on_error(self, request:LoadRequest, on_error:Callable|None, e:Exception) -> None:
+        self._stop(request)
+        if on_error: on_error(e)
+        else: self.error("Background load failed", exc_info=e)
+
+    def load(
+            self, fetch:Callable[[], Any], on_result:Callable[[Any], None],
+            on_error:Optional[Callable[[Exception], None]]=None) -> None:
+        """ Call fetch() in a worker thread, then on_result(result) in the main loop """
+        request = self._start()
+        def on_fetched(result:Any) -> None:
+            self._stop(request)
+            on_result(result)
+        run_in_background(
+            fetch, on_fetched, lambda e: self._on_error(request, on_error, e), request)
+
+    def load_in_chunks(
+            self, fetch:Callable[[], List[Any]], on_chunk:Callable[[List[Any]], None],
+            on_fetched:Callable[[List[Any]], None]=lambda items: None,
+            on_done:Callable[[], None]=lambda: None,
+            on_error:Optional[Callable[[Exception], None]]=None) -> None:
+        """ Call fetch() in a worker thread, then in the main loop on_fetched(items) and
+        on_chunk(items) with chunk_size items at a time, one chunk per main loop iteration so that
+        the window keeps being redrawn, then on_done() """
+        request = self._start()
+        def add_next_chunk(items:List[Any], start:int) -> bool:
+            if request.cancelled: return False
+            if start >= len(items):
+                self._stop(request)
+                on_done()
+                return False
+            on_chunk(items[start:start+self.chunk_size])
+            GLib.idle_add(add_next_chunk, items, start + self.chunk_size)
+            return False
+        def on_result(items:List[Any]) -> None:
+            on_fetched(items)
+            add_next_chunk(items, 0)
+        run_in_background(
+            fetch, on_result, lambda e: self._on_error(request, on_error, e), request)
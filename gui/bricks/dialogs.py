@@ -4,6 +4,7 @@ from gi.repository.Gtk import Label, Button
 from gi.repository.Gtk import ResponseType, PositionType
 
 from gui.bricks.containers import PaddedGrid, ScrollWindow
+from gui.bricks.instrumentation import timed_connect
 
 
 
@@ -25,7 +26,7 @@ class Dialog(GtkDialog):
         # OK button
         if add_ok_button:
             ok_button = self.add_button("OK", Dialog.OK)
-            ok_button.connect("clicked", self._on_button_ok_clicked)
+            timed_connect(ok_button, "clicked", self._on_button_ok_clicked)
     
     def _on_button_ok_clicked(self, _:Button):
         self.destroy()
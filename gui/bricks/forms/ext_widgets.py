@@ -1,8 +1,12 @@
-from typing import Any, Callable, List
+from typing import Any, Callable, List, Optional
+from gi.repository import GLib
 from gi.repository.Gtk import Label, ComboBoxText, RadioButton
 
-from db.objects import Record
+from db.handler import SQLiteHandler
+from db.objects import Record, Table
 from gui.bricks.containers import PlainGrid
+from gui.bricks.forms.option_cache import OptionCache
+from gui.bricks.instrumentation import timed_connect
 from gui.bricks.tables import SingleSelectTable
 
 
@@ -27,6 +31,12 @@ def find_index_of(to_find:Record|str|None, in_list:List[Record|None]) -> int|Non
     return
 
 
+def _get_record(table:Table, value:Record|str) -> Record|None:
+    """ Record of a value, which can also be a display name, e.g. for default values """
+    if type(value) is str: return SQLiteHandler().get_record(table, value)
+    return value
+
+
 def _select_ext_widget_type(number_options) -> type:
     """ Return the class of widget appropriate for this number of options """
     if number_options == 0: return NAExtWidget
@@ -36,13 +46,29 @@ def _select_ext_widget_type(number_options) -> type:
 
 
 class ExtWidget:
-    """ Abstract class """
+    """ Abstract class
+    Widgets given the table of their options get them from the database themselves, as late as
+    they can, then keep them up to date through the OptionCache """
     def set_value(self, value:Any|None) -> None:
         raise NotImplementedError
     def get_value(self) -> Record|None:
         raise NotImplementedError
     def load_options(self, options:List[Record|None], include_none:bool) -> None:
         raise NotImplementedError
+    def subscribe_to_options(self, table:Table, include_none:bool) -> List[Record]:
+        """ Return the records of the table, and reload them, keeping the selection, when they
+        change """
+        def on_options_changed(options:List[Record]) -> None:
+            self.reload_options(options, include_none)
+        self.connect("destroy", lambda _: OptionCache().unsubscribe(table, on_options_changed))
+        return OptionCache().subscribe(table, on_options_changed)
+
+
+    def reload_options(self, options:List[Record|None], include_none:bool) -> None:
+        """ Load new options, keeping the selection """
+        value = self.get_value()
+        self.load_options(options, include_none)
+        self.set_value(value)
 
 
 class NAExtWidget(Label, ExtWidget):
@@ -57,11 +83,15 @@ class NAExtWidget(Label, ExtWidget):
 
 class RadioExtWidget(PlainGrid, ExtWidget):
     """ An external form field widget with radio button options
+    Given a table, all the options are loaded right away, there are only a few
     https://stackoverflow.com/questions/391237/pygtk-radio-button """
-    def __init__(self, options:List[Record], include_none:bool, on_selection_modified:Callable):
+    def __init__(
+            self, options:Optional[List[Record]], include_none:bool, on_selection_modified:Callable,
+            table:Optional[Table]=None):
         super().__init__()
         self._buttons = []
         self._on_selection_modified = lambda x: on_selection_modified()
+        if table: options = self.subscribe_to_options(table, include_none)
         self.load_options(options, include_none)
 
     def load_options(self, options:List[Record|None], include_none) -> None:
@@ -95,7 +125,7 @@ class RadioExtWidget(PlainGrid, ExtWidget):
         self._buttons = list(reversed(none_button.get_group()))
 
         for button in self._buttons:
-            button.connect("clicked", self._on_selection_modified)
+            timed_connect(button, "clicked", self._on_selection_modified)
 
     def set_value(self, value:Record|None):
         if not value:
@@ -113,14 +143,51 @@ class RadioExtWidget(PlainGrid, ExtWidget):
 
 
 class DropdownExtWidget(ComboBoxText, ExtWidget):
-    """ An external form field widget with a dropdown menu """
-
-    def __init__(self, options:List[Record|None], include_none:bool, on_selection_modified:Callable):
+    """ An external form field widget with a dropdown menu
+    Given a table, only the selected option is loaded at first, all the options are loaded once
+    the main loop is idle, or when the dropdown is focused if that comes first, never while the
+    popup opens
+    Reloading the options doesn't signal a change of selection, unless the option selected is
+    gone """
+
+    def __init__(
+            self, options:Optional[List[Record|None]], include_none:bool,
+            on_selection_modified:Callable, table:Optional[Table]=None):
         super().__init__()
-        self.load_options(options, include_none)
-        self.connect("changed", lambda x: on_selection_modified())
+        self._table = table
+        self._include_none = include_none
+        self._on_selection_modified = on_selection_modified
+        self._options_loaded = table is None
+        self._destroyed = False
+        self.load_options(options if table is None else [], include_none)
+        self._changed_handler = timed_connect(self, "changed", lambda x: on_selection_modified())
+        self.connect("destroy", lambda _: setattr(self, "_destroyed", True))
+        if table:
+            self.connect("set-focus-child", lambda _, child: child and self._load_all_options())
+            GLib.idle_add(self._load_all_options_idle, priority=GLib.PRIORITY_LOW)
         # DEBUG size this one is variable and changes the size of the scrollwindows
 
+    def _load_all_options_idle(self) -> bool:
+        if not self._destroyed: self._load_all_options()
+        return False  # Don't call again
+
+    def _load_all_options(self) -> None:
+        if self._options_loaded: return
+        self._options_loaded = True
+        self.reload_options(
+            self.subscribe_to_options(self._table, self._include_none), self._include_none)
+
+    def reload_options(self, options:List[Record|None], include_none:bool) -> None:
+        """ Load new options, keeping the selection, without emitting changed """
+        value = self.get_value()
+        self.handler_block(self._changed_handler)
+        try:
+            self.load_options(options, include_none)
+            self.set_value(value)
+        finally:
+            self.handler_unblock(self._changed_handler)
+        if self.get_value() != value: self._on_selection_modified()
+
     def load_options(self, options:List[Record|None], include_none:bool) -> None:
         self.remove_all()
         # None option
@@ -135,6 +202,10 @@ class DropdownExtWidget(ComboBoxText, ExtWidget):
     def set_value(self, value:Record|None):
         if not value: row = 0
         else:
+            # Until all the options are loaded, the selected one is the only one
+            if not self._options_loaded:
+                value = _get_record(self._table, value)
+                if value: self.load_options([value], self._include_none)
             row = find_index_of(value, self._options)
             if not row: row = 0
         self.set_active(row)
@@ -147,17 +218,29 @@ class DropdownExtWidget(ComboBoxText, ExtWidget):
 
 
 class TableExtWidget(SingleSelectTable, ExtWidget):
-    """ A table form field widget with single selection and a button to edit records """
+    """ A table form field widget with single selection and a button to edit records
+    Given a table, rows are fetched as they are shown, cf TableWidget.load_table, and refreshed
+    when the table changes """
     
-    def __init__(self, options:List[Record|None], include_none:bool, on_selection_modified:Callable):
+    def __init__(
+            self, options:Optional[List[Record|None]], include_none:bool,
+            on_selection_modified:Callable, table:Optional[Table]=None):
         super().__init__(on_selection_modified)
-        self.load_options(options, include_none)
+        self._options_table = table
+        if table:
+            self.load_table(table)
+            OptionCache().watch(table, self.apply_changes)
+            self.connect("destroy", lambda _: OptionCache().unwatch(table, self.apply_changes))
+        else:
+            self.load_options(options, include_none)
         
     def load_options(self, options:List[Record|None], include_none:bool):
         """ Table widgets can't display an empty line, None is just unselecting all """
-        SingleSelectTable.load_options(self, options)
+        # The options can be shared, and the table keeps its list
+        SingleSelectTable.load_options(self, list(options))
     
     def set_value(self, value:Record|None) -> None:
+        if value and self._options_table: value = _get_record(self._options_table, value)
         self.set_selected(value)
 
     def get_value(self) -> Record:
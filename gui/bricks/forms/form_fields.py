@@ -6,6 +6,7 @@ from datetime import datetime
 from db.objects import Field, TextField, IntField, BoolField, DateField, \
     FilepathField, LengthField
 from gui.bricks.containers import PlainGrid
+from gui.bricks.instrumentation import timed_connect
 
 
 class FormField(PlainGrid):
@@ -136,7 +137,7 @@ class FilepathFormField(FormField):
         # self._widget.set_current_folder('./db')
         def on_file_picked(file_chooser_button):
               pass  # self.value = file_chooser_button.get_filename()
-        self._widget.connect("file-set", on_file_picked)
+        timed_connect(self._widget, "file-set", on_file_picked)
 
         if self.field.default_value: self._widget.set_value(self.field.default_value)
 
@@ -0,0 +1,113 @@
+""" Shared options of the form fields that reference other tables """
+
+from typing import Callable, Dict, List, Tuple
+from gi.repository import GLib
+
+
+from db.handler import SQLiteHandler
+from db.objects import Record, Table
+from src.base_object import BaseObject, Singleton
+
+
+class _Options:
+    """ Cached records of a table, with the version of the table they were fetched at and the
+    callbacks of the widgets using them """
+    __slots__ = ("records", "version", "subscribers")
+
+    def __init__(self, records:List[Record], version:int):
+        self.records = records
+        self.version = version
+        self.subscribers:List[Callable[[List[Record]], None]] = []
+
+
+class OptionCache(BaseObject, metaclass=Singleton):
+    """ Records of the foreign tables, shared by all the form fields and widgets offering them
+    as options, sorted by sort_rows_by (by the database)
+    Each table is read once, and again only when it changes: the handler tells the cache about
+    every write, and the tables that changed are refetched together once the main loop is idle,
+    the subscribers then get the new options
+    Subscriptions are reference counts, a table's options are dropped with its last subscriber
+    Widgets that don't need the records themselves, e.g. paged tables or widgets that only count
+    them, watch the table instead: they are called the same way, without the records being read """
+
+    def __init__(self):
+        super().__init__()
+        self._db_handler = SQLiteHandler()
+        self._options:Dict[Table, _Options] = {}
+        # {table: (version, callbacks)}
+        self._watchers:Dict[Table, Tuple[int, List[Callable[[], None]]]] = {}
+        self._refresh_scheduled = False
+        self._db_handler.add_change_listener(self._on_table_changed)
+
+    def get_options(self, table:Table) -> List[Record]:
+        """ Records of the table, refetched if the table changed since they were cached
+        The list is shared, it shouldn't be modified """
+        options = self._options.get(table)
+        if options is None: return self._db_handler.get_records(table)
+        if options.version != self._db_handler.get_table_version(table): self._refresh(table)
+        return options.records
+
+    def subscribe(self, table:Table, callback:Callable[[List[Record]], None]) -> List[Record]:
+        """ Call callback(records) whenever the records of the table change, return the current
+        ones; unsubscribe when the widget is destroyed """
+        if table not in self._options:
+            version = self._db_handler.get_table_version(table)
+            self._options[table] = _Options(self._db_handler.get_records(table), version)
+        self._options[table].subscribers.append(callback)
+        return self.get_options(table)
+
+    def unsubscribe(self, table:Table, callback:Callable[[List[Record]], None]) -> None:
+        options = self._options.get(table)
+        if options is None or callback not in options.subscribers: return
+        options.subscribers.remove(callback)
+        if not options.subscribers: del self._options[table]
+
+    def watch(self, table:Table, callback:Callable[[], None]) -> None:
+        """ Call callback() whenever the records of the table change; unwatch when the widget is
+        destroyed """
+        if table not in self._watchers:
+            self._watchers[table] = (self._db_handler.get_table_version(table), [])
+        self._watchers[table][1].append(callback)
+
+    def unwatch(self, table:Table, callback:Callable[[], None]) -> None:
+        if table not in self._watchers or callback not in self._watchers[table][1]: return
+        self._watchers[table][1].remove(callback)
+        if not self._watchers[table][1]: del self._watchers[table]
+
+    def refresh(self, table:Table|None=None) -> None:
+        """ Notify the watchers and refetch the options of the table (or of all the tables) that
+        changed, right away
+        Watchers go first, they can replace the widgets subscribed to the options """
+        for watched_table in [table] if table is not None else list(self._watchers):
+            if watched_table not in self._watchers: continue
+            version, callbacks = self._watchers[watched_table]
+            new_version = self._db_handler.get_table_version(watched_table)
+            if version == new_version: continue
+            self._watchers[watched_table] = (new_version, callbacks)
+            for callback in list(callbacks):
+                if callback in callbacks: callback()
+        for cached_table in [table] if table is not None else list(self._options):
+            options = self._options.get(cached_table)
+            if options and options.version != self._db_handler.get_table_version(cached_table):
+                self._refresh(cached_table)
+
+    def _refresh(self, table:Table) -> None:
+        options = self._options[table]
+        options.version = self._db_handler.get_table_version(table)
+        options.records = self._db_handler.get_records(table)
+        # Subscribers can unsubscribe others, e.g. a form field replacing its widget
+        for callback in list(options.subscribers):
+            if callback in options.subscribers: callback(options.records)
+
+    def _on_table_changed(self, table:Table|None) -> None:
+        """ Handler change listener, writes come in bursts so refreshes wait for the main loop
+        to be idle; also called from the write-behind writer, the refresh runs in the main loop """
+        if table is not None and table not in self._options and table not in self._watchers:
+            return
+        if self._refresh_scheduled: return
+        self._refresh_scheduled = True
+        def refresh() -> bool:
+            self._refresh_scheduled = False
+            self.refresh()
+            return False
+        GLib.idle_add(refresh)
@@ -1,18 +1,30 @@
-from typing import Any, Dict, Tuple, Callable, List
-from gi.repository.Gtk import Button, PositionType, Label, Button, PositionType, Align
+from collections import OrderedDict
+from sqlite3 import IntegrityError
+from typing import Any, Dict, Literal, Optional, Tuple, Callable, List
+from gi.repository.Gtk import Button, CheckButton, PositionType, Label, Button, PositionType, Align
 
 
 from db.handler import SQLiteHandler
 from db.objects import Field, Record, Table
-from gui.bricks.containers import PaddedGrid
+from gui.bricks.containers import PaddedGrid, PlainGrid
 from gui.bricks.dialogs import ConfirmDialog, Dialog, InfoDialog
 from gui.bricks.forms.form_fields import FormField, get_form_field
-from gui.bricks.forms.ext_widgets import _select_ext_widget_type
+from gui.bricks.forms.ext_widgets import ExtWidget, _select_ext_widget_type
+from gui.bricks.forms.option_cache import OptionCache
+from gui.bricks.instrumentation import timed_connect
+from gui.bricks.write_queue import WriteQueue
+
+
+def _to_record_value(value:Any) -> Any:
+    """ Records hold the display names of the records their foreign keys point to """
+    return value.display_name if type(value) is Record else value
 
 
 class ExtFormField(FormField):
     """ Any form field that is a reference to another table 
-    Several widgets available """
+    Several widgets available, depending on the number of options, which are only counted
+    The widgets load the options themselves and keep them up to date, the form field changes the
+    type of widget when the number of options requires it """
 
     def __init__(self, field:Field, *args, **kwargs):
         self._db_handler = SQLiteHandler()
@@ -23,12 +35,12 @@ class ExtFormField(FormField):
 
         # Modify buttons
         modify_button = Button(label="?")
-        modify_button.connect("clicked", self._on_button_modify_clicked)
+        timed_connect(modify_button, "clicked", self._on_button_modify_clicked)
         self.attach_next(modify_button, PositionType.RIGHT)
 
         # Create button
         create_button = Button(label="+")
-        create_button.connect("clicked", self._on_button_create_clicked)
+        timed_connect(create_button, "clicked", self._on_button_create_clicked)
         self.attach_next(create_button, PositionType.RIGHT)
 
     def set_default(self) -> None:
@@ -40,41 +52,36 @@ class ExtFormField(FormField):
     def get_value(self) -> Record|None:
         return self._widget.get_value()
 
-    def _get_options_from_db(self) -> List[Record|None]:
-        """ Fetch and return all records in the DB table of the field """
-        options = self._db_handler.get_records(self.table)
-        options.sort(
-            key=lambda record: record.values[self.table.sort_rows_by],
-            reverse=False)
-        return options
-
     def _on_selection_modified(self) -> None:
         """ If selection changes, it needs to be traced/accessible """
         if self._widget:  # At widget init, the selection will be initialized before the widget reference is saved
             self.last_record = self._widget.get_value()
 
     def _init_widget(self) -> None:
-        """ Initialize widget OR refresh to take into account for modification of DB records """
-        # Get (new) list of options and type of widget
-        self._options = self._get_options_from_db()
-        include_none = not self.field.mandatory
-        new_type = _select_ext_widget_type(len(self._options))
-        
+        """ Initialize widget, cf super.__init__ """
+        self._option_count = self._db_handler.count_records(self.table)
+        OptionCache().watch(self.table, self._on_table_changed)
+        self.connect("destroy", lambda _: OptionCache().unwatch(self.table, self._on_table_changed))
+        self._widget = self._new_widget()
+        self.set_default()
+
+    def _new_widget(self) -> ExtWidget:
+        """ Widget of the type appropriate for the number of options, kept up to date """
+        new_type = _select_ext_widget_type(self._option_count)
+        return new_type(None, not self.field.mandatory, self._on_selection_modified, table=self.table)
+
+    def _on_table_changed(self) -> None:
+        """ The widgets reload their options themselves, but some need another type of widget """
+        self._option_count = self._db_handler.count_records(self.table)
+        if type(self._widget) is _select_ext_widget_type(self._option_count): return
         # Resetting the widget will deselect and by doing so, update last_record
         last_record = self.last_record
-
-        if not self._widget: # Init of the form, cf super.__init__                          
-            self._widget = new_type(self._options, include_none, self._on_selection_modified)
-        if type(self._widget) == new_type:  # Refresh but same widget type
-            self._widget.load_options(self._options, include_none)
-        
-        else:  # Refresh and new widget type
-            self.remove(self._widget)
-            self._widget = new_type(self._options, include_none, self._on_selection_modified)
-            self.attach(self._widget, 0, 0)
-            self._format_widget()
-            self._widget.show_all()
-        
+        # Destroying the widget also unsubscribes it
+        self._widget.destroy()
+        self._widget = self._new_widget()
+        self.attach(self._widget, 0, 0)
+        self._format_widget()
+        self._widget.show_all()
         # Depending on the case, select the previous selection, or the default value, or nothing
         if last_record: self._widget.set_value(last_record)
         else: self.set_default()
@@ -96,13 +103,18 @@ class ExtFormField(FormField):
             delete_button=False)
 
     def _on_record_modified(self, record:Record) -> None:
-        """ If a record manager dialog generated from this form modified a record, reload """
+        """ If a record manager dialog generated from this form modified a record, reload the
+        options right away to select it """
         self.last_record = record
-        self._init_widget()
+        OptionCache().refresh(self.table)
+        if record: self._widget.set_value(record)
+        else: self.set_default()
 
 
 class RecordFormGrid(PaddedGrid):
     """ All fields of a record, existing or to-be
+    The labels and form fields of a table are built once and kept in a pool, switching records
+    only changes the values; the pools of the tables used least recently are dropped
     Code interface:
     - last_table
     - last_record
@@ -111,6 +123,9 @@ class RecordFormGrid(PaddedGrid):
     - reset_form_from_table
     - reset_form_from_nothing """
 
+    # Number of tables whose form fields are kept
+    max_pooled_tables = 5
+
     def __init__(self, init_table:Table=None, init_record:Record=None,):
         super().__init__()
         self.set_vexpand(False)
@@ -120,6 +135,9 @@ class RecordFormGrid(PaddedGrid):
         self.last_table = init_table
         self._form_fields = []
         self._db_handler = SQLiteHandler()
+        # {table: (grid of labels and form fields, form fields)}, least recently used first
+        self._pools:OrderedDict[Table, Tuple[PlainGrid, List[FormField]]] = OrderedDict()
+        self._form_grid = None
 
         # Init if possible
         if init_record: self.reset_form_from_record(init_record)
@@ -142,17 +160,39 @@ class RecordFormGrid(PaddedGrid):
         # label.set_size_request(20,20)
         return label, form_field
 
+    def _get_pool(self, table:Table) -> Tuple[PlainGrid, List[FormField]]:
+        """ Labels and form fields of the table, built if they aren't in the pool """
+        if table in self._pools:
+            self._pools.move_to_end(table)
+            # Options of foreign keys are kept up to date by the OptionCache
+            return self._pools[table]
+        grid, form_fields = PlainGrid(), []
+        grid.set_vexpand(False)
+        for i, field in enumerate(table.fields):
+            label, form_field = self._get_form_field_and_label(field)
+            grid.attach(label, 0, i)
+            grid.attach(form_field, 1, i)
+            form_fields.append(form_field)
+        grid.show_all()
+        self._pools[table] = (grid, form_fields)
+        if len(self._pools) > RecordFormGrid.max_pooled_tables:
+            _, (evicted_grid, _) = self._pools.popitem(last=False)
+            evicted_grid.destroy()
+        return grid, form_fields
+
+    def _show_form(self, table:Table) -> None:
+        """ Show the form fields of the table in place of the current ones """
+        grid, self._form_fields = self._get_pool(table)
+        if self._form_grid is not grid:
+            if self._form_grid: self.remove(self._form_grid)
+            self._form_grid = grid
+            self.attach(grid, 0, 0)
+        self.last_table = table
+
     def reset_form_from_record(self, record:Record):
-        """ Recreate all form fields and fill them with record values """
-        self.reset_form_from_nothing()
+        """ Show the form fields of the table of the record and fill them with its values """
+        self._show_form(record.parent_table)
         self.last_record = record
-        self.last_table = record.parent_table
-
-        for i, field in enumerate(record.parent_table.fields):
-            label, form_field = self._get_form_field_and_label(field)
-            self.attach(label, 0, i-1)
-            self.attach(form_field, 1, i-1)
-            self._form_fields.append(form_field)
 
         for form_field in self._form_fields:
             if form_field.field.field_name == "ID":
@@ -164,34 +204,25 @@ class RecordFormGrid(PaddedGrid):
             else:
                 value = self.last_record.values[form_field.field]
                 form_field.set_value(value)
-        self.show_all()
-
-    def reset_form_from_table(self, table:Table):
-        """ Recreate all form fields and fill them with default values"""
-        self.reset_form_from_nothing()
-        self.last_table = table
 
-        for field in table.fields:
-            label, form_field = self._get_form_field_and_label(field)
-            self.attach_next(label)
-            self.attach_next(form_field, position=PositionType.RIGHT)
-            self.last_added = label
-            self._form_fields.append(form_field)
+    def reset_form_from_table(self, table:Table|None):
+        """ Show the form fields of the table with default values """
+        if table is None:
+            self.reset_form_from_nothing()
+            return
+        self._show_form(table)
+        self.last_record = None
 
         for form_field in self._form_fields:
             form_field.set_default()
-            
-        self.show_all()
     
     def reset_form_from_nothing(self):
-        """ Remove form """
-        for form_field in self._form_fields:
-            self.remove(form_field)
+        """ Remove form, the form fields stay in the pool """
+        if self._form_grid: self.remove(self._form_grid)
+        self._form_grid = None
         self._form_fields = []
-        self.last_added = None
         self.last_record = None
         self.last_table = None
-        self.show_all()
 
     def get_current_values(self) -> Dict[Field, Any]:
         return {form_field.field:form_field.get_value() for form_field in self._form_fields}
@@ -207,52 +238,124 @@ class RecordManagerGrid(RecordFormGrid):
     - Save button creates a new record
     - Cancel button resets fields to default values/empty
     - Delete button does nothing after info popup
+    After a change, last_change is (kind of change, record), so that tables showing the records can
+    be patched instead of reloaded, cf TableWidget.apply_changes
+    With write_behind, modifications are shown right away and written by the WriteQueue, until
+    then last_change_written is False: once written, last_change is the record as read back from
+    the database and on_change_notify is called again; if the write fails, an error popup shows
+    and the record goes back to its database values. New records are still written right away,
+    their ID is needed
     #TODO to test """
     def __init__(self,
             init_table:Table=None, init_record:Record=None,
             on_change_notify:Callable=lambda x: None,
             on_cancel_notify:Callable=lambda x: None,
             delete_button:bool=True,
+            write_behind:bool=False,
         ):
         super().__init__(init_table, init_record)
+        self.last_change:Optional[Tuple[Literal["inserted", "updated", "deleted"], Record]] = None
+        # Whether last_change is in the database yet, cf write_behind
+        self.last_change_written = True
         self._on_change_notify = on_change_notify
         self._on_cancel_notify = on_cancel_notify
+        self._write_behind = write_behind
+        # Writes can be confirmed after the form is closed
+        self._destroyed = False
+        self.connect("destroy", lambda _: setattr(self, "_destroyed", True))
 
         # Action buttons
         save_button = Button(label="Save")
-        save_button.connect("clicked", self._on_button_save_clicked)
+        timed_connect(save_button, "clicked", self._on_button_save_clicked)
         cancel_button = Button(label="Cancel")
-        cancel_button.connect("clicked", self._on_button_cancel_clicked)
+        timed_connect(cancel_button, "clicked", self._on_button_cancel_clicked)
         if delete_button:
             delete_button = Button(label="Delete")
-            delete_button.connect("clicked", self._on_button_delete_clicked)
+            timed_connect(delete_button, "clicked", self._on_button_delete_clicked)
 
         button_grid = PaddedGrid()
         button_grid.attach_next(save_button)
         button_grid.attach_next(cancel_button, PositionType.RIGHT)
         if delete_button: button_grid.attach_next(delete_button, PositionType.RIGHT)
-        self.attach_next(button_grid)
+        # Below the form, which is swapped in and out at 0, 0
+        self.attach(button_grid, 0, 1)
 
     def _on_button_save_clicked(self, button:Button):
-        # Fetch and validate values
-        values = self.get_current_values()
+        # Fetch and validate values, foreign keys as display names
+        values = {
+            field: _to_record_value(value) for field, value in self.get_current_values().items()}
+        if self._write_behind and self.last_record:
+            self._save_write_behind(values)
+            return
         try:
             if not self.last_record:
                 self.last_record = Record(self.last_table, values)
                 self.last_record.save_to_db(new=True)
                 self.last_record = self._db_handler.get_record(
                     self.last_record.parent_table, self.last_record.display_name)
+                self.last_change = ("inserted", self.last_record)
+                self.last_change_written = True
                 self.reset_form_from_record(self.last_record)
             else:
                 for field in values:
                     self.last_record.values[field] = values[field]
                 self.last_record.save_to_db(new=False)
                 self.last_record.recalculate_display_name()
+                self.last_change = ("updated", self.last_record)
+                self.last_change_written = True
                 self.reset_form_from_record(self.last_record)
             self._on_change_notify()
         except ValueError as e:
             self.error("Something went wrong while trying to save", exc_info=e)
 
+    def _save_write_behind(self, values:Dict[Field, Any]) -> None:
+        """ Show the modifications right away and queue the update """
+        try:
+            record = Record(self.last_table, {
+                field: values.get(field, value) for field, value in self.last_record.values.items()})
+        except ValueError as e:
+            self.error("Something went wrong while trying to save", exc_info=e)
+            return
+        self.last_record = record
+        self._show_automatic_values(record)
+        self.last_change = ("updated", record)
+        self.last_change_written = False
+        WriteQueue().save(
+            record, self._on_write_confirmed, lambda e: self._on_write_failed(record, e))
+        self._on_change_notify()
+
+    def _is_shown(self, record:Record) -> bool:
+        return not self._destroyed and self.last_record is not None and self.last_record.ID == record.ID \
+            and self.last_record.parent_table == record.parent_table
+
+    def _show_automatic_values(self, record:Record) -> None:
+        """ Update the values that aren't edited, e.g. the display name, keep the others """
+        for form_field in self._form_fields:
+            if form_field.field.field_name == "display_name":
+                form_field.set_value(record.display_name)
+            elif form_field.field.automatic:
+                form_field.set_value(record.values[form_field.field])
+
+    def _on_write_confirmed(self, record:Record) -> None:
+        """ The record as written in the database replaces the one shown """
+        if self._is_shown(record):
+            self.last_record = record
+            self._show_automatic_values(record)
+        self.last_change = ("updated", record)
+        self.last_change_written = True
+        self._on_change_notify()
+
+    def _on_write_failed(self, record:Record, e:Exception) -> None:
+        """ Show the error, and the record as it still is in the database """
+        self.error(f"Couldn't save {record}", exc_info=e)
+        InfoDialog("Couldn't save", f"The modifications of {record} weren't saved: {e}")
+        saved_record = self._db_handler.get_record_by_ID(record.parent_table, record.ID)
+        if saved_record is None: return
+        if self._is_shown(record): self.reset_form_from_record(saved_record)
+        self.last_change = ("updated", saved_record)
+        self.last_change_written = True
+        self._on_change_notify()
+
     def _on_button_cancel_clicked(self, _:Button):
         if self.last_record: self.reset_form_from_record(self.last_record)
         elif self.last_table: self.reset_form_from_table(self.last_table)
@@ -265,6 +368,8 @@ class RecordManagerGrid(RecordFormGrid):
             response = popup.run()
             if response == Dialog.OK:
                 self._db_handler.delete_record_or_fail(self.last_record)
+                self.last_change = ("deleted", self.last_record)
+                self.last_change_written = True
                 self.last_record = None
                 self.reset_form_from_table(self.last_table)
                 self._on_change_notify()
@@ -278,21 +383,27 @@ class RecordManagerGrid(RecordFormGrid):
             
 
 class RecordManagerDialog(Dialog):
-    """ The RecordManagerGrid but in a popup """
+    """ The RecordManagerGrid but in a popup
+    on_change_notify gets the record, the kind of change is in self.record_manager.last_change
+    With write_behind, it's called again once the modifications are written, even if the popup
+    self destructed in the meantime """
     def __init__(self,
             table:Table, record:Record=None,
             on_change_notify:Callable=lambda x: None,
             delete_button:bool=True,
-            self_destruct_after_call:bool=True):
+            self_destruct_after_call:bool=True,
+            write_behind:bool=False):
         
         if record: title = f"Edit {record.parent_table.table_name} record"
         elif table: title = f"Create {table.table_name} record"
         else: title = "???"
         super().__init__(title, freeze_app=False, add_ok_button=False)
+        self._destroyed = False
+        self.connect("destroy", lambda _: setattr(self, "_destroyed", True))
 
         def _on_change_notify() -> None:
             """ Wrapper to add table and record to callable"""
-            if self_destruct_after_call:
+            if self_destruct_after_call and not self._destroyed:
                 self.destroy()
             on_change_notify(record_manager.last_record)
         
@@ -304,8 +415,104 @@ class RecordManagerDialog(Dialog):
             init_table=table, init_record=record,
             on_change_notify=_on_change_notify,
             on_cancel_notify=_on_cancel_notify,
-            delete_button=delete_button)
+            delete_button=delete_button,
+            write_behind=write_behind)
 
+        self.record_manager = record_manager
         self._box.add(record_manager)
         self.set_size_request(600,500)  #DEBUG size this one works but at what cost
         self.show_all()
+
+
+class BulkEditGrid(PaddedGrid):
+    """ Form to give the same values to several records of a table at once
+    Only the fields whose check button is active are written, to all the records, with a single
+    set-based update, cf SQLiteHandler.update_records_or_fail: either all records are updated or
+    none is
+    After a change, last_change is ("updated", records), the records as they are now, so that
+    tables showing them can be patched instead of reloaded, cf TableWidget.apply_changes """
+    def __init__(self,
+            table:Table, records:List[Record],
+            on_change_notify:Callable=lambda: None,
+            on_cancel_notify:Callable=lambda: None):
+        super().__init__()
+        self.table = table
+        self.records = records
+        self.last_change:Optional[Tuple[Literal["updated"], List[Record]]] = None
+        self._on_change_notify = on_change_notify
+        self._on_cancel_notify = on_cancel_notify
+        self._db_handler = SQLiteHandler()
+
+        self.attach_next(Label(f"Values to give to the {len(records)} records selected"))
+
+        # Check buttons as labels, for the fields to write
+        form_grid = PlainGrid()
+        self._form_fields:List[Tuple[CheckButton, FormField]] = []
+        for i, field in enumerate(f for f in table.editable_fields if not f.automatic):
+            check_button = CheckButton(label="*"+field.field_name if field.mandatory \
+                else field.field_name)
+            check_button.set_halign(Align.END)
+            form_field = ExtFormField(field) if field.foreign_key_table else get_form_field(field)
+            form_field.set_default()
+            form_grid.attach(check_button, 0, i)
+            form_grid.attach(form_field, 1, i)
+            self._form_fields.append((check_button, form_field))
+        self.attach_next(form_grid, PositionType.BOTTOM)
+
+        # Action buttons
+        apply_button = Button(label="Apply")
+        timed_connect(apply_button, "clicked", self._on_button_apply_clicked)
+        cancel_button = Button(label="Cancel")
+        timed_connect(cancel_button, "clicked", lambda _: self._on_cancel_notify())
+        button_grid = PaddedGrid()
+        button_grid.attach_next(apply_button)
+        button_grid.attach_next(cancel_button, PositionType.RIGHT)
+        self.attach_next(button_grid, PositionType.BOTTOM)
+
+    def get_checked_values(self) -> Dict[Field, Any]:
+        """ Values of the fields to write, foreign keys as display names, as records hold them """
+        values = {}
+        for check_button, form_field in self._form_fields:
+            if not check_button.get_active(): continue
+            values[form_field.field] = _to_record_value(form_field.get_value())
+        return values
+
+    def _on_button_apply_clicked(self, _:Button) -> None:
+        values = self.get_checked_values()
+        if not values:
+            InfoDialog("Nothing to apply", "Check the fields to give to the records")
+            return
+        IDs = [record.ID for record in self.records]
+        try:
+            self._db_handler.update_records_or_fail(self.table, IDs, values)
+        except (ValueError, IntegrityError) as e:
+            self.error("Something went wrong while trying to save, no record was modified",
+                exc_info=e)
+            InfoDialog("Couldn't save", f"No record was modified: {e}")
+            return
+        # Display names can change, records are read back in one query
+        self.records = self._db_handler.get_records(
+            self.table, where_condition=f"ID IN ({', '.join(str(ID) for ID in IDs)})")
+        self.last_change = ("updated", self.records)
+        self._on_change_notify()
+
+
+class BulkEditDialog(Dialog):
+    """ The BulkEditGrid but in a popup, closed once the records are saved
+    on_change_notify gets the updated records """
+    def __init__(self,
+            table:Table, records:List[Record],
+            on_change_notify:Callable[[List[Record]], None]=lambda records: None):
+        super().__init__(
+            f"Edit {len(records)} {table.table_name} records", freeze_app=False,
+            add_ok_button=False)
+
+        def _on_change_notify() -> None:
+            self.destroy()
+            on_change_notify(self.bulk_edit.records)
+
+        self.bulk_edit = BulkEditGrid(
+            table, records, on_change_notify=_on_change_notify, on_cancel_notify=self.destroy)
+        self._box.add(self.bulk_edit)
+        self.set_size_request(600,500)
+        self.show_all()
@@ -0,0 +1,137 @@
+""" Instrumentation of the GTK main loop: durations of the signal callbacks and main loop stalls
+Callbacks connected with timed_connect are timed, a watchdog thread notices when the main loop
+stops turning and samples the Python stack of the main thread, to know what froze the window """
+
+from collections import deque
+from sys import _current_frames
+from threading import Event, Thread, main_thread
+from time import perf_counter, time
+from traceback import format_stack
+from typing import Any, Callable, Deque, Dict, List, Optional
+from gi.repository import GLib
+
+
+from src.base_object import BaseObject, Singleton
+
+
+def get_callback_name(callback:Callable) -> str:
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+
+class CallbackStats:
+    """ Durations of the last calls of a callback, in seconds """
+    __slots__ = ("durations", "count", "total")
+    max_samples = 1000
+
+    def __init__(self):
+        self.durations:Deque[float] = deque(maxlen=CallbackStats.max_samples)
+        self.count = 0
+        self.total = 0.
+
+    def add(self, duration:float) -> None:
+        self.durations.append(duration)
+        self.count += 1
+        self.total += duration
+
+    def percentiles(self, *percents:float) -> List[float]:
+        """ Nearest rank percentiles of the last durations, for ex percentiles(50, 90, 99) """
+        durations = sorted(self.durations)
+        if not durations: return [0. for _ in percents]
+        return [durations[min(len(durations) - 1, max(0, round(p / 100 * len(durations)) - 1))] \
+            for p in percents]
+
+
+class Stall:
+    """ A time the main loop didn't turn for longer than the threshold """
+    __slots__ = ("started", "duration", "callback", "stack")
+
+    def __init__(self, started:float, callback:Optional[str], stack:str):
+        self.started = started  # Epoch seconds
+        self.duration = 0.
+        self.callback = callback
+        self.stack = stack
+
+
+class UIMonitor(BaseObject, metaclass=Singleton):
+    """ Collects the durations of the timed callbacks, by name, and the main loop stalls
+    The main loop beats every heartbeat_interval seconds, when the watchdog thread sees no beat for
+    stall_threshold seconds, it samples the stack of the main thread along with the name of the
+    timed callback running, if any; the stall is reported once the main loop is back """
+
+    heartbeat_interval = 0.05
+    stall_threshold = 0.25
+    max_stalls = 50
+
+    def __init__(self):
+        super().__init__()
+        self.stats:Dict[str, CallbackStats] = {}
+        self.stalls:Deque[Stall] = deque(maxlen=UIMonitor.max_stalls)
+        # Names of the timed callbacks running, callbacks can trigger others
+        self._running:List[str] = []
+        self._last_beat = perf_counter()
+        self._stall = None
+        self._stop = Event()
+        self._watchdog = None
+
+    def timed(self, name:str, callback:Callable) -> Callable:
+        """ Wrap a callback so that its calls are timed under name """
+        def timed_callback(*args, **kwargs) -> Any:
+            self._running.append(name)
+            start = perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                duration = perf_counter() - start
+                self._running.pop()
+                if name not in self.stats: self.stats[name] = CallbackStats()
+                self.stats[name].add(duration)
+        return timed_callback
+
+    def start(self) -> None:
+        """ Start the heartbeat and the watchdog, once the main loop runs """
+        if self._watchdog is not None: return
+        self._stop.clear()
+        self._last_beat = perf_counter()
+        GLib.timeout_add(int(self.heartbeat_interval * 1000), self._beat)
+        self._watchdog = Thread(target=self._watch, name="ui_watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._watchdog = None
+
+    def _beat(self) -> bool:
+        """ Main loop side, also reports the stall that just ended, if any """
+        now = perf_counter()
+        stall = self._stall
+        if stall is not None:
+            self._stall = None
+            stall.duration = now - self._last_beat - self.heartbeat_interval
+            self.stalls.append(stall)
+            self.warning(
+                f"Main loop stalled for {stall.duration:.2f}s, in {stall.callback or 'untimed code'}" +\
+                f"\n{stall.stack}")
+        self._last_beat = now
+        return not self._stop.is_set()  # Keep beating until stopped
+
+    def _watch(self) -> None:
+        """ Watchdog thread side """
+        main_thread_ID = main_thread().ident
+        while not self._stop.wait(self.stall_threshold / 2):
+            late = perf_counter() - self._last_beat - self.heartbeat_interval
+            if late < self.stall_threshold or self._stall is not None: continue
+            frame = _current_frames().get(main_thread_ID)
+            # The list can change meanwhile, but only on the main thread, which is stuck
+            running = list(self._running)
+            self._stall = Stall(
+                time() - late,
+                " > ".join(running) if running else None,
+                "".join(format_stack(frame)) if frame is not None else "")
+
+
+def timed_connect(widget:Any, signal:str, callback:Callable, *args, name:Optional[str]=None) -> int:
+    """ widget.connect(signal, callback, *args), with the calls timed by the UIMonitor
+    Calls are named after the class of the widget, the signal and the callback, unless given a
+    name, for ex when the callback is a wrapper """
+    if name is None: name = f"{type(widget).__name__} {signal} -> {get_callback_name(callback)}"
+    return widget.connect(signal, UIMonitor().timed(name, callback), *args)
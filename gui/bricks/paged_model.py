@@ -0,0 +1,158 @@
+""" Lazy list model for tree views, fetching its rows page by page """
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+from gi.repository import GObject
+from gi.repository.Gtk import TreeIter, TreeModel, TreeModelFlags, TreePath
+
+
+from src.base_object import BaseObject
+
+
+py_to_gtype_mapping = {str: GObject.TYPE_STRING, int: GObject.TYPE_INT64, bool: GObject.TYPE_BOOLEAN}
+
+
+class PagedTreeModel(GObject.Object, TreeModel, BaseObject):
+    """ Read only list model that knows its number of rows up front and only fetches the rows that
+    are shown, page by page, with fetch_rows(offset, limit)
+    The last max_pages pages used are kept, the least recently used ones are dropped
+    With run_in_background(fetch, on_result, on_error), pages are fetched outside of the main
+    loop, their rows are shown empty until they arrive
+    Rows can only be patched where they are with update_rows, load a new model to refresh the view
+    Iters hold the row number, they stay valid as long as the model """
+
+    def __init__(
+            self, column_types:List[type], row_count:int,
+            fetch_rows:Callable[[int, int], List[List[Any]]],
+            page_size:int=200, max_pages:int=20,
+            pages:Optional[Dict[int, List[List[Any]]]]=None,
+            run_in_background:Optional[Callable]=None):
+        GObject.Object.__init__(self)
+        BaseObject.__init__(self)
+        self._column_types = column_types
+        self._row_count = row_count
+        self._fetch_rows = fetch_rows
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self._pages:OrderedDict[int, List[List[Any]]] = OrderedDict(pages or {})
+        self._run_in_background = run_in_background
+        self._pending_pages = set()
+        # Iters from other models (or older versions of this one) are told apart by their stamp
+        self._stamp = id(self) & 0x7fffffff
+
+    def get_row(self, row:int) -> List[Any]:
+        """ Values of one row, fetching its page if needed """
+        page_number, position = divmod(row, self.page_size)
+        page = self._pages.get(page_number)
+        if page is None and self._run_in_background:
+            self._request_page(page_number)
+            return [None] * len(self._column_types)
+        if page is None:
+            page = self._fetch_rows(page_number * self.page_size, self.page_size)
+            self._add_page(page_number, page)
+        else:
+            self._pages.move_to_end(page_number)
+        # The table can shrink between the count and the fetch
+        if position >= len(page): return [None] * len(self._column_types)
+        return page[position]
+
+    def update_rows(self, rows:List[List[Any]]) -> None:
+        """ Replace the rows fetched that have the same ID, in the first column, as the given ones
+        Rows don't move, and pages fetched later come from fetch_rows """
+        new_rows = {row[0]: row for row in rows}
+        for page_number, page in self._pages.items():
+            for position, row in enumerate(page):
+                if row[0] not in new_rows: continue
+                page[position] = new_rows[row[0]]
+                row_number = page_number * self.page_size + position
+                if row_number < self._row_count:
+                    self.row_changed(TreePath.new_from_indices([row_number]), self._make_iter(row_number))
+
+    def _add_page(self, page_number:int, page:List[List[Any]]) -> None:
+        self._pages[page_number] = page
+        if len(self._pages) > self.max_pages: self._pages.popitem(last=False)
+
+    def _request_page(self, page_number:int) -> None:
+        """ Fetch a page in the background, then tell the view its rows changed """
+        if page_number in self._pending_pages: return
+        self._pending_pages.add(page_number)
+        def on_page(page:List[List[Any]]) -> None:
+            self._pending_pages.discard(page_number)
+            self._add_page(page_number, page)
+            first_row = page_number * self.page_size
+            for row in range(first_row, min(first_row + len(page), self._row_count)):
+                self.row_changed(TreePath.new_from_indices([row]), self._make_iter(row))
+        def on_error(e:Exception) -> None:
+            self._pending_pages.discard(page_number)
+            self.error(f"Couldn't fetch page {page_number}", exc_info=e)
+        self._run_in_background(
+            lambda: self._fetch_rows(page_number * self.page_size, self.page_size),
+            on_page, on_error)
+
+    def _to_gtk_value(self, column:int, value:Any) -> Any:
+        """ Values have to match the type of their column, None isn't accepted for numbers """
+        column_type = self._column_types[column]
+        if column_type is str: return "" if value is None else str(value)
+        if column_type is bool: return bool(value)
+        try: return int(value)
+        except (TypeError, ValueError): return 0
+
+    def _make_iter(self, row:int) -> TreeIter:
+        tree_iter = TreeIter()
+        tree_iter.stamp = self._stamp
+        # user_data is a pointer, 0 would read back as None
+        tree_iter.user_data = row + 1
+        return tree_iter
+
+    def _get_row_number(self, tree_iter:TreeIter) -> int:
+        return tree_iter.user_data - 1
+
+    # TreeModel interface
+    def do_get_flags(self) -> TreeModelFlags:
+        return TreeModelFlags.LIST_ONLY | TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self) -> int:
+        return len(self._column_types)
+
+    def do_get_column_type(self, column:int):
+        return py_to_gtype_mapping[self._column_types[column]]
+
+    def do_get_iter(self, path:TreePath):
+        indices = path.get_indices()
+        if len(indices) != 1 or not 0 <= indices[0] < self._row_count: return (False, None)
+        return (True, self._make_iter(indices[0]))
+
+    def do_get_path(self, tree_iter:TreeIter) -> TreePath:
+        return TreePath.new_from_indices([self._get_row_number(tree_iter)])
+
+    def do_get_value(self, tree_iter:TreeIter, column:int) -> Any:
+        return self._to_gtk_value(column, self.get_row(self._get_row_number(tree_iter))[column])
+
+    def do_iter_next(self, tree_iter:TreeIter) -> bool:
+        row = self._get_row_number(tree_iter) + 1
+        if row >= self._row_count: return False
+        tree_iter.user_data = row + 1
+        return True
+
+    def do_iter_previous(self, tree_iter:TreeIter) -> bool:
+        row = self._get_row_number(tree_iter) - 1
+        if row < 0: return False
+        tree_iter.user_data = row + 1
+        return True
+
+    def do_iter_children(self, parent:TreeIter|None):
+        if parent is None and self._row_count: return (True, self._make_iter(0))
+        return (False, None)
+
+    def do_iter_has_child(self, tree_iter:TreeIter) -> bool:
+        return False
+
+    def do_iter_n_children(self, tree_iter:TreeIter|None) -> int:
+        return self._row_count if tree_iter is None else 0
+
+    def do_iter_nth_child(self, parent:TreeIter|None, n:int):
+        if parent is None and 0 <= n < self._row_count: return (True, self._make_iter(n))
+        return (False, None)
+
+    def do_iter_parent(self, child:TreeIter):
+        return (False, None)
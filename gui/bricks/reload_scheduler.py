@@ -0,0 +1,62 @@
+""" Coalescing of the reloads of widgets that depend on each other """
+
+from typing import Callable, Dict, List, Tuple
+from gi.repository import GLib
+
+
+from src.base_object import BaseObject
+
+
+class ReloadScheduler(BaseObject):
+    """ Collects the reloads requested during one main loop iteration and runs each of them once,
+    in order, once the main loop is idle
+    Steps are given in dependency order as (name, reload function), invalidating a step also
+    invalidates the steps that depend on it, for ex {"tables": ["fields", "records"]}
+    While the reloads run, self.running is True: the widgets being reloaded emit signals, e.g.
+    their selection is cleared, callbacks should ignore them rather than ask for more reloads
+    Steps invalidated by a reload run in the same pass if they come after it, in the next one
+    otherwise """
+
+    def __init__(self, steps:List[Tuple[str, Callable[[], None]]], dependents:Dict[str, List[str]]):
+        super().__init__()
+        self._steps = steps
+        self._dependents = dependents
+        self._pending = set()
+        self._scheduled = False
+        self.running = False
+
+    def invalidate(self, *names:str) -> None:
+        """ Reload the given steps, and the ones depending on them, once the main loop is idle """
+        to_add = list(names)
+        while to_add:
+            name = to_add.pop()
+            if name in self._pending: continue
+            self._pending.add(name)
+            to_add.extend(self._dependents.get(name, []))
+        if self._scheduled or self.running: return
+        self._scheduled = True
+        GLib.idle_add(self._run_idle)
+
+    def flush(self) -> None:
+        """ Run the pending reloads right away, e.g. when the caller needs their result """
+        if not self.running: self._run()
+
+    def _run_idle(self) -> bool:
+        self._run()
+        return False  # Don't call again
+
+    def _run(self) -> None:
+        self._scheduled = False
+        self.running = True
+        try:
+            for name, reload in self._steps:
+                if name not in self._pending: continue
+                self._pending.discard(name)
+                self.debug(f"Reloading {name}")
+                reload()
+        finally:
+            self.running = False
+        # Steps invalidated by a later step
+        if self._pending and not self._scheduled:
+            self._scheduled = True
+            GLib.idle_add(self._run_idle)
@@ -0,0 +1,73 @@
+""" In-memory text search over the rows of a table """
+
+from typing import Dict, Iterable, Optional, Set
+
+
+def _get_trigrams(text:str) -> Set[str]:
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """ Text of rows by ID, to find the rows containing every word of a query, case insensitively
+    Words of 3 characters or more narrow down the candidates with a trigram index, the candidates
+    are then checked against the whole query
+    The trigram index is only built on the first search, tables that are never searched don't
+    pay for it """
+
+    def __init__(self):
+        self._texts:Dict[int, str] = {}
+        self._trigrams:Optional[Dict[str, Set[int]]] = None
+
+    def clear(self) -> None:
+        self._texts = {}
+        self._trigrams = None
+
+    def add(self, ID:int, text:str) -> None:
+        """ Add the text of a row, replacing its previous text if any """
+        if ID in self._texts: self.remove(ID)
+        text = text.casefold()
+        self._texts[ID] = text
+        if self._trigrams is None: return
+        for trigram in _get_trigrams(text): self._trigrams.setdefault(trigram, set()).add(ID)
+
+    def remove(self, ID:int) -> None:
+        text = self._texts.pop(ID, None)
+        if text is None or self._trigrams is None: return
+        for trigram in _get_trigrams(text):
+            IDs = self._trigrams.get(trigram)
+            if IDs is None: continue
+            IDs.discard(ID)
+            if not IDs: del self._trigrams[trigram]
+
+    def _build_trigrams(self) -> None:
+        self._trigrams = {}
+        for ID, text in self._texts.items():
+            for trigram in _get_trigrams(text): self._trigrams.setdefault(trigram, set()).add(ID)
+
+    def search(self, query:str) -> Set[int]:
+        """ IDs of the rows whose text contains every word of the query """
+        words = query.casefold().split()
+        if not words: return set(self._texts)
+        if self._trigrams is None: self._build_trigrams()
+        candidates:Optional[Set[int]] = None
+        # Rarest trigrams first, the candidates shrink faster
+        trigrams = sorted(
+            set().union(*(_get_trigrams(word) for word in words)),
+            key=lambda trigram: len(self._trigrams.get(trigram, ())))
+        for trigram in trigrams:
+            IDs = self._trigrams.get(trigram)
+            if not IDs: return set()
+            candidates = set(IDs) if candidates is None else candidates & IDs
+            if not candidates: return set()
+        # Short words only, every row is a candidate
+        if candidates is None: candidates = self._texts.keys()
+        return {ID for ID in candidates if self._contains(self._texts[ID], words)}
+
+    def matches(self, ID:int, query:str) -> bool:
+        """ Whether the text of one row contains every word of the query """
+        text = self._texts.get(ID)
+        return text is not None and self._contains(text, query.casefold().split())
+
+    @staticmethod
+    def _contains(text:str, words:Iterable[str]) -> bool:
+        return all(word in text for word in words)
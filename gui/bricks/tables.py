@@ -1,9 +1,21 @@
-from typing import Any, Callable, List, Optional
-from gi.repository.Gtk import ListStore, TreeView, TreeSelection, PositionType, CellRendererText, TreeViewColumn, SelectionMode
+from bisect import bisect_right
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+from gi.repository import GLib
+from gi.repository.Gtk import ListStore, TreeView, TreeSelection, PositionType, CellRendererText, TreeViewColumn, SelectionMode, \
+    TreeViewColumnSizing, Spinner, TreeIter, TreePath, TreeModel, SearchEntry, TreeModelSort
 
 
-from db.objects import Field, Record, Table, TextField, IntField, BoolField, DateField, FilepathField, LengthField
+from db.handler import SQLiteHandler
+from db.objects import Field, Record, Table, TextField, IntField, BoolField, DateField, FilepathField, LengthField, \
+    length_to_seconds
+from gui.bricks.background import BackgroundLoader, LoadRequest, run_in_background
 from gui.bricks.containers import PaddedFrame, PaddedGrid, ScrollWindow
+from gui.bricks.instrumentation import get_callback_name, timed_connect
+from gui.bricks.paged_model import PagedTreeModel
+from gui.bricks.search_index import SearchIndex
+
+# Only for type hints, numpy is slow to import
+if TYPE_CHECKING: from db.batch import RecordBatch
 
 
 py_to_gtk_type_mapping = {
@@ -16,26 +28,76 @@ py_to_gtk_type_mapping = {
 }
 
 
+def _compare_lengths(model:TreeModel, iter_a:TreeIter, iter_b:TreeIter, column:int) -> int:
+    """ Sort function of length columns, missing lengths first like in the database """
+    seconds_a, seconds_b = (
+        length_to_seconds(model.get_value(tree_iter, column)) for tree_iter in (iter_a, iter_b))
+    seconds_a = -1 if seconds_a is None else seconds_a
+    seconds_b = -1 if seconds_b is None else seconds_b
+    return (seconds_a > seconds_b) - (seconds_a < seconds_b)
+
+
 class TableWidget(PaddedGrid):
     """ Table that can show data from records
     Columns can be set at init or be calculated dynamically from the records given
     Selection is implemented at subclass level
     External interface:
     - self.current_selection, Record or list of Records
-    - self.load_options(records:Optional[List[Record]])
+    - self.load_options(records:Optional[List[Record]]), records are shown in the order given, the
+    database handler returns them sorted by the sort_rows_by of their table
+    - self.load_batch(batch:RecordBatch)
+    - self.load_table(table:Table, where_condition:Optional[str]), for large tables, rows are
+    fetched from the database as they are scrolled into view
+    - self.load_options_async(fetch:Callable[[], List[Record]])
+    load_table and load_options_async query the database in the background and show a spinner
+    meanwhile, any new load cancels the previous one
+    - self.apply_changes(inserted, updated, deleted), to show modified records without reloading
     - self.set_selected(to_select:Record|int)
+    Rows loaded in memory can be sorted by clicking on the column headers, through a TreeModelSort
+    comparing the values by column type, and lengths by their number of seconds; lazily loaded
+    tables keep the order of the database
+    - self.search(text:str), for searchable tables (init arg), to only show the rows whose text,
+    date, length and filepath columns contain every word of text, case insensitively; their
+    search entry calls it as the user types
+    Rows loaded in memory are filtered with a SearchIndex, tables loaded with load_table are
+    filtered by the database; the rows stay in the order of the table and the selection is kept
+    if it still matches
     Calls on_change_notify (init arg) when the selection changes """
 
+    # Rows fetched at a time by load_table
+    page_size = 200
+
     def __init__(
             self, on_change_notify:Callable,
             set_fields:Optional[List[Field]]=[],
+            searchable:bool=False,
             *args, **kwargs):
         """ To dynamically refresh columns based on records, leave fields out """
 
         super().__init__(*args, **kwargs)
+        self._searchable = searchable
         self._set_fields = set_fields != []
         self.current_selection = None
         self._records = []
+        # When loaded from a batch, records are only built when selected
+        self._batch = None
+        # Rows of the list store by record ID, {ID: (row number, iter, record)}
+        # List store iters stay valid until their row is removed, row numbers are updated when
+        # rows are inserted, moved or removed; records of batches are only built when needed
+        self._index:Dict[int, Tuple[int, TreeIter, Record|None]] = {}
+        # When loaded lazily from the database, (table, where condition including the search),
+        # and the where condition given to load_table
+        self._paged_query = None
+        self._paged_where = None
+        # Text of the rows loaded in memory, and IDs of the rows matching the search, None if
+        # not searching
+        self._search_index = SearchIndex()
+        self._search_text = ""
+        self._matching_IDs = None
+        # Background loads, and selection to apply once they are done
+        self._loader = BackgroundLoader(self._on_loading_changed)
+        self._pending_selection = None
+        self._selection_request = None
 
         # Fields and columns
         self._treeview = TreeView()
@@ -50,15 +112,31 @@ class TableWidget(PaddedGrid):
             self._fetch_current(selection)
             on_change_notify()
         
-        self._tree_selection.connect("changed", _on_selection_changed)
+        # Named after the callback notified, the wrapper is the same for all tables
+        timed_connect(self._tree_selection, "changed", _on_selection_changed,
+            name=f"{type(self).__name__} selection changed -> {get_callback_name(on_change_notify)}")
+
+        # Search entries already wait for a pause in the typing before notifying
+        if searchable:
+            self._search_entry = SearchEntry()
+            timed_connect(self._search_entry, "search-changed",
+                lambda entry: self.search(entry.get_text()),
+                name=f"{type(self).__name__} search -> {get_callback_name(on_change_notify)}")
+            self.attach_next(self._search_entry, PositionType.BOTTOM)
 
         self._widget = ScrollWindow()
         self._widget.add(self._treeview)
         self.attach_next(self._widget, PositionType.BOTTOM)
 
+        # Loading indicator, only shown during background loads
+        self._spinner = Spinner()
+        self._spinner.set_no_show_all(True)
+        self.attach_next(self._spinner, PositionType.BOTTOM)
+
     def _reset_fields(self, fields):
         """ Reset the columns/fields of the table """
-        self._fields = fields
+        # Copy, the list is sorted in place and might be the fields of the table itself
+        self._fields = list(fields)
         self._table = None if fields == [] else fields[0].parent_table
 
         # Double check fields, sort, add ID at the start if needed
@@ -70,10 +148,23 @@ class TableWidget(PaddedGrid):
                 self._fields.remove(id_field)
                 self._fields = [id_field]+self._fields
         
-        # Reset datastore
-        self._datastore = ListStore(*[py_to_gtk_type_mapping[type(f)] for f in self._fields])
+        # Reset datastore, searchable tables show it through a filter, and it's shown sorted by
+        # the column chosen by the user, if any
+        self._column_types = [py_to_gtk_type_mapping[type(f)] for f in self._fields]
+        self._datastore = ListStore(*self._column_types)
+        self._filter = None
+        if self._searchable:
+            self._filter = self._datastore.filter_new()
+            self._filter.set_visible_func(self._is_row_visible)
+        self._list_model = TreeModelSort(
+            model=self._filter if self._filter is not None else self._datastore)
+        # Lengths are shown as text, which isn't always zero padded, e.g. 1:02:03 or 100:00:00
+        for i, field in enumerate(self._fields):
+            if type(field) is LengthField: self._list_model.set_sort_func(i, _compare_lengths, i)
+        self._index = {}
+        self._reset_search_index()
         # Reset treeview model and columns
-        self._treeview.set_model(self._datastore)
+        self._treeview.set_model(self._list_model)
         for column_name in self._treeview.get_columns():
             self._treeview.remove_column(column_name)
         # Reformat, underscores get skipped otherwise
@@ -84,6 +175,7 @@ class TableWidget(PaddedGrid):
             column = TreeViewColumn(column_name, renderer, text=i)
             column.set_expand(True)
             column.set_resizable(True)
+            column.set_sort_column_id(i)
             self._treeview.append_column(column)
 
     def _set_selection_mode(self):
@@ -92,57 +184,373 @@ class TableWidget(PaddedGrid):
     def _fetch_current(self, selection:TreeSelection):
         raise NotImplementedError
 
+    def _on_loading_changed(self, loading:bool) -> None:
+        if loading:
+            self._spinner.show()
+            self._spinner.start()
+        else:
+            self._spinner.stop()
+            self._spinner.hide()
+
+    def _reset_search_index(self) -> None:
+        """ Rows are added to the search index as they are added to the list store """
+        self._search_index.clear()
+        self._matching_IDs = set() if self._search_text else None
+
+    def _set_search_text(self, ID:int, row:List[Any]) -> None:
+        """ Index the text columns of a row, before it is added to or changed in the list store,
+        the filter then knows whether to show it """
+        if not self._searchable: return
+        self._search_index.add(ID, " ".join(str(value) \
+            for value, field in zip(row, self._fields) \
+            if type(field) in SQLiteHandler.searchable_field_types and value is not None))
+        if self._matching_IDs is None: return
+        if self._search_index.matches(ID, self._search_text): self._matching_IDs.add(ID)
+        else: self._matching_IDs.discard(ID)
+
+    def _remove_search_text(self, ID:int) -> None:
+        self._search_index.remove(ID)
+        if self._matching_IDs is not None: self._matching_IDs.discard(ID)
+
+    def _is_row_visible(self, model:TreeModel, tree_iter:TreeIter, data:Any) -> bool:
+        return self._matching_IDs is None or model.get_value(tree_iter, 0) in self._matching_IDs
+
+    def search(self, text:str) -> None:
+        """ Only show the rows whose text columns contain every word of text, all of them if
+        text is empty """
+        text = text.strip()
+        if text == self._search_text: return
+        self._search_text = text
+        if self._paged_query:
+            table, _ = self._paged_query
+            self._paged_query = (table, self._get_paged_where())
+            model, paths = self._tree_selection.get_selected_rows()
+            selected_IDs = [model.get_value(model.get_iter(path), 0) for path in paths]
+            self._load_paged_model([0], lambda: self._select_IDs(selected_IDs))
+        elif self._searchable:
+            # Hidden rows are unselected by the filter, the others stay selected
+            self._matching_IDs = self._search_index.search(text) if text else None
+            self._filter.refilter()
+
+    def _get_paged_where(self) -> str|None:
+        """ Where condition of load_table, with the condition of the search """
+        search_condition = SQLiteHandler().get_search_condition(self._fields, self._search_text)
+        if not search_condition: return self._paged_where
+        if not self._paged_where: return search_condition
+        return f"({self._paged_where}) AND {search_condition}"
+
+    def _to_view_iter(self, tree_iter:TreeIter) -> TreeIter|None:
+        """ Iter of the tree view for an iter of the list store, None if the row is filtered out """
+        if self._filter is not None:
+            found, tree_iter = self._filter.convert_child_iter_to_iter(tree_iter)
+            if not found: return None
+        found, tree_iter = self._list_model.convert_child_iter_to_iter(tree_iter)
+        return tree_iter if found else None
+
+    def _to_view_path(self, path:TreePath) -> TreePath|None:
+        """ Path of the tree view for a path of the list store, None if the row is filtered out """
+        if self._filter is not None: path = self._filter.convert_child_path_to_path(path)
+        return self._list_model.convert_child_path_to_path(path) if path is not None else None
+
+    def _set_model(self, model) -> None:
+        """ Show the given model, paged models need fixed height rows so that the tree view
+        doesn't measure, and so fetch, every row; they can't be sorted either, it would mean
+        fetching every row """
+        paged = type(model) is PagedTreeModel
+        if not paged: self._treeview.set_fixed_height_mode(False)
+        for i, column in enumerate(self._treeview.get_columns()):
+            column.set_sizing(TreeViewColumnSizing.FIXED if paged else TreeViewColumnSizing.GROW_ONLY)
+            column.set_sort_column_id(-1 if paged else i)
+        if paged: self._treeview.set_fixed_height_mode(True)
+        self._treeview.set_model(model)
+
     def _find_record_by_ID(self, to_find:int) -> Record|None:
-        if self._records:
-            for record in self._records:
-                if record.ID == to_find:
-                    return record
+        if self._paged_query:
+            record = SQLiteHandler().get_record_by_ID(self._paged_query[0], to_find)
+            if record: return record
+        elif to_find in self._index:
+            row_number, tree_iter, record = self._index[to_find]
+            if record is None and self._batch:
+                record = self._batch.get_record(to_find)
+                self._index[to_find] = (row_number, tree_iter, record)
+            return record
         self.debug(f"Record ID {to_find} cannot be found here.")
         return None
 
-    def _find_row_number_by_ID(self, to_find) -> Record|None:
-        i = None
-        if self._records:
-            for i, record in enumerate(self._records):
-                if record.ID == to_find:
-                    return i
+    def _find_records_by_IDs(self, to_find:List[int]) -> List[Record|None]:
+        """ Same as _find_record_by_ID for several records, with a single query for paged tables """
+        if not self._paged_query: return [self._find_record_by_ID(ID) for ID in to_find]
+        table, where_condition = self._paged_query
+        IDs = [int(ID) for ID in to_find]
+        records = {r.ID: r for r in SQLiteHandler().get_records(
+            table, where_condition=f"ID IN ({', '.join(str(ID) for ID in IDs)})")} if IDs else {}
+        return [records.get(ID) for ID in IDs]
+
+    def _find_row_number_by_ID(self, to_find) -> int|None:
+        if self._paged_query:
+            table, where_condition = self._paged_query
+            row_number = SQLiteHandler().get_row_number(table, to_find, where_condition)
+            if row_number is not None: return row_number
+        elif to_find in self._index:
+            return self._index[to_find][0]
         self.debug(f"Record ID {to_find} cannot be found here.")
         return None
 
+    def _reindex_rows(self, start:int=0) -> None:
+        """ Update the row numbers of the index from the given row, after rows moved """
+        for row_number in range(start, len(self._records)):
+            record = self._records[row_number]
+            if record.ID not in self._index: continue  # Rows that couldn't be added
+            _, tree_iter, _ = self._index[record.ID]
+            self._index[record.ID] = (row_number, tree_iter, record)
+
     def load_options(self, records:Optional[List[Record]]) -> None:
         """ Reload the table with the given records
         Warning, might not display columns if there is no record and no set columns were specified for this table """
 
+        self._loader.cancel()
+        self._clear()
+        self._prepare_records(records)
+        self._append_records(self._records)
+
+    def load_options_async(self, fetch:Callable[[], List[Record]]) -> None:
+        """ Reload the table with the records returned by fetch, which is called in a worker
+        thread; records are then added a chunk at a time so that the window stays responsive """
+        self._clear()
+        self._loader.load_in_chunks(
+            fetch, on_chunk=self._append_records, on_fetched=self._prepare_records,
+            on_done=self._apply_pending_selection)
+
+    def _clear(self) -> None:
+        """ Empty the table, back to the list store if a paged model was shown """
+        if self._selection_request: self._selection_request.cancel()
         self._datastore.clear()
+        self._index = {}
+        self._records = []
+        self._batch = None
+        self._reset_search_index()
+        if self._paged_query:
+            self._paged_query = None
+            self._paged_where = None
+            self._set_model(self._list_model)
 
-        if records:
-            # If no set columns at init, recalculate them based on given records
-            # The data table is also dynamic in that case
-            if not self._set_fields: self._reset_fields(records[0].parent_table.fields)
-            # Double check that all records are in the same table
-            for r in records: assert r.parent_table == self._table
-            # Sort records
-            records.sort(key=lambda r: r.values[self._table.sort_rows_by])
-            self._records = records
-        
-            for record in records:
-                try:
-                    self._datastore.append([record.values[f] for f in self._fields])
-                except Exception as e:
-                    self.debug(f"Couldn't add record to table widget...\nTable:{self._table}\nFields:{self._fields}\nRecord: {record}", exc_info=e)
+    def _prepare_records(self, records:Optional[List[Record]]) -> None:
+        """ Check the records to show, recalculate the columns if needed """
+        if not records: return
+        # If no set columns at init, recalculate them based on given records
+        # The data table is also dynamic in that case
+        if not self._set_fields: self._reset_fields(records[0].parent_table.fields)
+        # Double check that all records are in the same table
+        for r in records: assert r.parent_table == self._table
+        self._records = records
+
+    def _append_records(self, records:List[Record]) -> None:
+        for record in records:
+            try:
+                row = [record.values[f] for f in self._fields]
+                self._set_search_text(record.ID, row)
+                self._index[record.ID] = (len(self._datastore), self._datastore.append(row), record)
+            except Exception as e:
+                self.debug(f"Couldn't add record to table widget...\nTable:{self._table}\nFields:{self._fields}\nRecord: {record}", exc_info=e)
+
+    def load_batch(self, batch:"RecordBatch") -> None:
+        """ Reload the table with the rows of a batch, without building the records
+        The batch is expected to be sorted already and to contain the columns shown """
+        self._loader.cancel()
+        self._clear()
+        self._batch = batch
+        if not self._set_fields: self._reset_fields(batch.fields)
+        for row_number, row in enumerate(batch.rows(self._fields)):
+            # ID is always the first column
+            row = list(row)
+            self._set_search_text(row[0], row)
+            self._index[row[0]] = (row_number, self._datastore.append(row), None)
+
+    def load_table(self, table:Table, where_condition:Optional[str]=None) -> None:
+        """ Reload the table with the records of a database table, without loading them all
+        The number of rows is counted up front, rows are then fetched page by page as they are
+        shown, and records are only built when selected
+        Counting and fetching the rows happen in the background """
+        self._clear()
+        if not self._set_fields: self._reset_fields(table.fields)
+        self._paged_where = where_condition
+        self._paged_query = (table, self._get_paged_where())
+        self._load_paged_model([0], self._apply_pending_selection)
+
+    def _load_paged_model(self, page_numbers:List[int], on_loaded:Callable[[], None]) -> None:
+        """ Count the rows and fetch the given pages in the background, then show a new paged
+        model of self._paged_query """
+        table, where_condition = self._paged_query
+        handler = SQLiteHandler()
+        fields = self._fields
+        page_size = TableWidget.page_size
+        fetch_rows = lambda offset, limit: handler.get_rows(table, fields, offset, limit, where_condition)
+
+        def fetch_pages():
+            return handler.count_records(table, where_condition), \
+                {n: fetch_rows(n * page_size, page_size) for n in page_numbers}
+
+        def on_pages(result):
+            row_count, pages = result
+            self._set_model(PagedTreeModel(
+                [py_to_gtk_type_mapping[type(f)] for f in fields], row_count, fetch_rows,
+                page_size=page_size, pages=pages, run_in_background=run_in_background))
+            on_loaded()
+
+        self._loader.load(fetch_pages, on_pages)
+
+    def apply_changes(
+            self, inserted:List[Record]=[], updated:List[Record]=[],
+            deleted:List[Record|int]=[], written:bool=True) -> None:
+        """ Show records that were created, modified or deleted, matched by ID, without reloading
+        the whole table: only their rows are patched, the selection and the scroll are kept
+        Tables loaded with load_table are refreshed in the background instead, only fetching the
+        pages that are visible; if the changes aren't written yet, e.g. by the WriteQueue, the
+        rows fetched are patched where they are instead, they move when called again once the
+        changes are written """
+        if self._paged_query:
+            model = self._treeview.get_model()
+            if written: self._refresh_paged_model()
+            elif type(model) is PagedTreeModel:
+                model.update_rows([[record.values[f] for f in self._fields] for record in updated])
+            return
+        # Batches can't be modified, records are built once for all
+        if self._batch:
+            self._records = self._batch.to_records()
+            self._batch = None
+            self._reindex_rows()
+
+        # Rows from which row numbers have to be updated
+        first_moved_row = len(self._records)
+
+        deleted_IDs = {r.ID if type(r) is Record else r for r in deleted}
+        for ID in deleted_IDs:
+            if ID not in self._index: continue
+            row_number, tree_iter, _ = self._index.pop(ID)
+            self._remove_search_text(ID)
+            self._datastore.remove(tree_iter)
+            first_moved_row = min(first_moved_row, row_number)
+        if deleted_IDs:
+            self._records = [r for r in self._records if r.ID not in deleted_IDs]
+
+        for record in updated:
+            if record.ID not in self._index:
+                inserted = inserted + [record]
+                continue
+            old_position, tree_iter, _ = self._index[record.ID]
+            # Deletions before the record might have shifted it
+            if old_position >= first_moved_row:
+                old_position = next(i for i, r in enumerate(self._records) if r.ID == record.ID)
+            del self._records[old_position]
+            position = self._get_sorted_position(record)
+            self._records.insert(position, record)
+            self._index[record.ID] = (position, tree_iter, record)
+            row = [record.values[f] for f in self._fields]
+            self._set_search_text(record.ID, row)
+            self._datastore.set_row(tree_iter, row)
+            # Moving keeps the iter, and so the selection
+            if position != old_position:
+                next_iter = self._index[self._records[position+1].ID][1] \
+                    if position + 1 < len(self._records) else None
+                self._datastore.move_before(tree_iter, next_iter)
+                first_moved_row = min(first_moved_row, position, old_position)
+
+        for record in inserted:
+            if not self._set_fields and not self._fields: self._reset_fields(record.parent_table.fields)
+            position = self._get_sorted_position(record)
+            self._records.insert(position, record)
+            row = [record.values[f] for f in self._fields]
+            self._set_search_text(record.ID, row)
+            self._index[record.ID] = (position, self._datastore.insert(position, row), record)
+            first_moved_row = min(first_moved_row, position)
+
+        self._reindex_rows(first_moved_row)
+
+        # Selected records might have been replaced
+        self._fetch_current(self._tree_selection)
+
+    def _get_sorted_position(self, record:Record) -> int:
+        """ Where the record goes in self._records, sorted like the database sorts them, cf
+        SQLiteHandler._get_order_by_sql: NULL first, then by ID """
+        if not self._table or not self._table.sort_rows_by: return len(self._records)
+        sort_rows_by = self._table.sort_rows_by
+        key = lambda r: (r.values[sort_rows_by] is not None, r.values[sort_rows_by], r.ID or 0)
+        try:
+            return bisect_right(self._records, key(record), key=key)
+        except TypeError:  # Values that can't be compared, e.g. None
+            return len(self._records)
+
+    def _refresh_paged_model(self) -> None:
+        """ Reload the paged model, keeping the visible rows, the selection and the scroll """
+        visible_range = self._treeview.get_visible_range()
+        first_row, last_row = (visible_range[0].get_indices()[0], visible_range[1].get_indices()[0]) \
+            if visible_range else (0, 0)
+        page_numbers = list(range(
+            first_row // TableWidget.page_size, last_row // TableWidget.page_size + 1))
+        adjustment = self._widget.get_vadjustment()
+        scroll = adjustment.get_value()
+        model, paths = self._tree_selection.get_selected_rows()
+        selected_IDs = [model.get_value(model.get_iter(path), 0) for path in paths]
+
+        def on_loaded():
+            # The new rows have to be laid out before scrolling back
+            GLib.idle_add(lambda: adjustment.set_value(scroll) and False)
+            self._select_IDs(selected_IDs)
+
+        self._load_paged_model(page_numbers, on_loaded)
+
+    def _select_IDs(self, IDs:List[int]) -> None:
+        """ Select the rows of the records, without scrolling to them """
+        if self._paged_query:
+            table, where_condition = self._paged_query
+            self._selection_request = request = LoadRequest()
+            run_in_background(
+                lambda: [SQLiteHandler().get_row_number(table, ID, where_condition) for ID in IDs],
+                lambda row_numbers: [self._tree_selection.select_path(TreePath.new_from_indices([n])) \
+                    for n in row_numbers if n is not None],
+                lambda e: self.error(f"Couldn't find record IDs {IDs}", exc_info=e),
+                request)
+        else:
+            for ID in IDs:
+                if ID not in self._index: continue
+                view_iter = self._to_view_iter(self._index[ID][1])
+                if view_iter: self._tree_selection.select_iter(view_iter)
 
     def set_selected(self, to_select:Record|int|None) -> None:
+        """ Select a record, once the rows are loaded if a background load is running """
+        if self._selection_request: self._selection_request.cancel()
+        self._pending_selection = None
         if to_select is None:
             self._treeview.get_selection().unselect_all()
             return
         elif type(to_select) is Record:
             to_select = to_select.ID
-        row_number = self._find_row_number_by_ID(to_select)
-        if not row_number is None:
-            self._treeview.set_cursor(self._find_row_number_by_ID(to_select))
+        if self._loader.loading:
+            self._pending_selection = to_select
+        elif self._paged_query:
+            # Finding the row of a record means sorting the table, not on the main loop
+            table, where_condition = self._paged_query
+            self._selection_request = request = LoadRequest()
+            run_in_background(
+                lambda: SQLiteHandler().get_row_number(table, to_select, where_condition),
+                self._select_row_number,
+                lambda e: self.error(f"Couldn't find record ID {to_select}", exc_info=e),
+                request)
+        else:
+            self._select_row_number(self._find_row_number_by_ID(to_select))
+
+    def _select_row_number(self, row_number:int|None) -> None:
+        """ Select a row of the model shown, or of the list store if filtered """
+        path = None if row_number is None else TreePath.new_from_indices([row_number])
+        if path and not self._paged_query: path = self._to_view_path(path)
+        if path is not None:
+            self._treeview.set_cursor(path)
         else:
             self._treeview.get_selection().unselect_all()
 
+    def _apply_pending_selection(self) -> None:
+        if self._pending_selection is not None: self.set_selected(self._pending_selection)
+
 
 class SingleSelectTable(TableWidget):
     def _set_selection_mode(self):
@@ -159,8 +567,6 @@ class MultiSelectTable(TableWidget):
         self._tree_selection.set_mode(SelectionMode.MULTIPLE)
     def _fetch_current(self, selection) -> List[Record]:
         (model, pathlist) = selection.get_selected_rows()
-        self.current_selection = []
-        for path in pathlist:
-            record_id =  model.get_value(model.get_iter(path), 0)
-            self.current_selection.append(self._find_record_by_ID(record_id))
+        record_ids = [model.get_value(model.get_iter(path), 0) for path in pathlist]
+        self.current_selection = self._find_records_by_IDs(record_ids)
 
@@ -0,0 +1,228 @@
+""" Write-behind saves of records
+Updates are written by a background writer to a journal file, then to the database, in batches, so
+that quick successive edits don't each wait for a sync or a commit; the journal survives a crash
+and is replayed when the database is opened again """
+
+from atexit import register as register_at_exit
+from json import dumps, loads
+from os import fsync, replace
+from os.path import abspath, exists
+from queue import Empty, Queue
+from threading import Lock, Thread, Timer
+from time import sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from gi.repository import GLib
+
+
+from db.handler import SQLiteHandler
+from db.objects import Record, Table
+from src.base_object import BaseObject, Singleton
+
+
+class WriteQueue(BaseObject, metaclass=Singleton):
+    """ Queue of record updates, written to the database by a background thread
+    - save(record) queues the update and returns right away, on_saved(record as read back from
+      the database) or on_error(exception) is called in the main loop once it's written
+    - the writer journals the updates as soon as it wakes up, all those queued in one go, then
+      waits batch_delay for more saves and writes them in a single transaction, only the last
+      save of a same record is written; the main loop never waits for the disk
+    - the journal keeps the updates that aren't written yet, of every database, the updates of a
+      database are queued again when it's opened
+    Updates that can't be written (invalid values, duplicated display names...) are dropped from
+    the journal and their on_error is called; when the transaction itself fails, e.g. if the
+    database is locked, nothing is reported: the batch stays queued and in the journal, and is
+    written again after retry_delay
+    The writer is started by the first save, or by start() once a database is opened """
+
+    batch_delay = 0.05
+    max_batch = 200
+    retry_delay = 5.
+
+    def __init__(self, journal_path:str="db/write_journal.jsonl"):
+        super().__init__()
+        self.journal_path = journal_path
+        self._db_handler = SQLiteHandler()
+        self._queue:Queue[Optional[int]] = Queue()
+        # Main loop and writer both modify the entries, only the writer writes the journal
+        self._lock = Lock()
+        # {number: journal entry}, updates that aren't written yet
+        self._entries:Dict[int, Dict[str, Any]] = {}
+        # Numbers of the entries that aren't in the journal yet
+        self._unjournaled:List[int] = []
+        # {number: (on_saved, on_error)}, for the saves of this session
+        self._callbacks:Dict[int, Tuple[Callable[[Record], None], Callable[[Exception], None]]] = {}
+        self._next_number = 0
+        self._writer = None
+
+    def start(self) -> None:
+        """ Load the journal, queue the updates of the current database and start the writer,
+        stopped at exit """
+        if self._writer is not None: return
+        self._load_journal()
+        self._db_handler.add_change_listener(self._on_db_changed)
+        self._writer = Thread(target=self._write_loop, name="write_behind", daemon=True)
+        self._writer.start()
+        register_at_exit(self.stop)
+        self._queue_database_entries()
+
+    def stop(self) -> None:
+        """ Write the updates queued and stop the writer """
+        if self._writer is None: return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._db_handler.remove_change_listener(self._on_db_changed)
+        # Updates left are replayed from the journal by the next start
+        self._queue = Queue()
+
+    def save(
+            self, record:Record, on_saved:Callable[[Record], None]=lambda record: None,
+            on_error:Callable[[Exception], None]=lambda e: None) -> None:
+        """ Queue an update of the record, whose foreign keys are display names """
+        self.start()
+        values = {field.field_name: record.values[field] \
+            for field in record.parent_table.non_automatic_fields if field in record.values}
+        values["ID"] = record.ID
+        entry = {
+            "database": abspath(self._db_handler.database_path),
+            "table": record.parent_table.table_name, "values": values}
+        with self._lock:
+            entry["number"] = number = self._next_number
+            self._next_number += 1
+            self._entries[number] = entry
+            self._callbacks[number] = (on_saved, on_error)
+            self._unjournaled.append(number)
+        self._queue.put(number)
+
+    def _load_journal(self) -> None:
+        if not exists(self.journal_path): return
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try: entry = loads(line)
+                except ValueError: continue  # Last line cut short by a crash
+                self._entries[entry["number"]] = entry
+        self._next_number = max(self._entries, default=-1) + 1
+        if self._entries: self.info(f"{len(self._entries)} updates to replay from the journal")
+
+    def _journal_new_entries(self) -> None:
+        """ Append the entries saved since the last call to the journal, writer side """
+        with self._lock:
+            entries = [self._entries[n] for n in self._unjournaled if n in self._entries]
+            self._unjournaled = []
+        if not entries: return
+        with open(self.journal_path, "a") as journal:
+            for entry in entries: journal.write(dumps(entry) + "\n")
+            journal.flush()
+            fsync(journal.fileno())
+
+    def _rewrite_journal(self) -> None:
+        """ Replace the journal with the entries left, writer side """
+        with self._lock:
+            entries = [self._entries[number] for number in sorted(self._entries)]
+            self._unjournaled = []
+        temporary_path = self.journal_path + ".tmp"
+        with open(temporary_path, "w") as journal:
+            for entry in entries: journal.write(dumps(entry) + "\n")
+            journal.flush()
+            fsync(journal.fileno())
+        replace(temporary_path, self.journal_path)
+
+    def _on_db_changed(self, table:Table|None) -> None:
+        if table is None: self._queue_database_entries()
+
+    def _queue_database_entries(self) -> None:
+        """ Queue the journaled updates of the current database """
+        database = abspath(self._db_handler.database_path)
+        with self._lock:
+            numbers = sorted(n for n, entry in self._entries.items() if entry["database"] == database)
+        for number in numbers: self._queue.put(number)
+
+    def _write_loop(self) -> None:
+        """ Writer thread side """
+        while True:
+            number = self._queue.get()
+            if number is None: return
+            self._journal_new_entries()
+            sleep(self.batch_delay)  # Quick successive saves end up in the same batch
+            numbers, stopping = [number], False
+            while len(numbers) < self.max_batch:
+                try: number = self._queue.get_nowait()
+                except Empty: break
+                if number is None:
+                    stopping = True
+                    break
+                numbers.append(number)
+            try:
+                self._journal_new_entries()
+                self._write_batch(numbers)
+            except Exception as e:
+                self.error("Couldn't write the batch of updates", exc_info=e)
+            if stopping: return
+
+    def _to_record(self, entry:Dict[str, Any]) -> Record:
+        table = self._db_handler.data_model.get_table(entry["table"])
+        # The handler validates the values before writing them
+        return Record(
+            table, {table.get_field(name): value for name, value in entry["values"].items()},
+            validate=False)
+
+    def _write_batch(self, numbers:List[int]) -> None:
+        database = abspath(self._db_handler.database_path)
+        with self._lock:
+            # Numbers can be queued twice, when their database is opened again
+            entries = [self._entries[n] for n in sorted(set(numbers)) if n in self._entries]
+        # The updates of other databases wait in the journal until they are opened again
+        entries = [entry for entry in entries if entry["database"] == database]
+        if not entries: return
+
+        # Only the last save of a record is written, the previous ones get its result
+        get_key = lambda entry: (entry["table"], entry["values"]["ID"])
+        last_entries = {get_key(entry): entry for entry in entries}
+        results:Dict[Tuple[str, int], Record|Exception] = {}
+        to_write:List[Tuple[Tuple[str, int], Record]] = []
+        for key, entry in last_entries.items():
+            try: to_write.append((key, self._to_record(entry)))
+            except Exception as e: results[key] = e  # e.g. the data model changed
+        try:
+            errors = self._db_handler.write_record_updates([record for _, record in to_write])
+        except Exception as e:
+            # Nothing was written, the updates are neither dropped nor reported, only delayed
+            self.error(
+                f"Couldn't write {len(to_write)} updates, trying again in {self.retry_delay}s",
+                exc_info=e)
+            self._retry_later([entry["number"] for entry in entries])
+            return
+        for (key, record), error in zip(to_write, errors):
+            results[key] = error if error is not None else \
+                self._db_handler.get_record_by_ID(record.parent_table, record.ID) or record
+
+        with self._lock:
+            for entry in entries: del self._entries[entry["number"]]
+            callbacks = [self._callbacks.pop(entry["number"], None) for entry in entries]
+        self._rewrite_journal()
+        for entry, entry_callbacks in zip(entries, callbacks):
+            result = results[get_key(entry)]
+            if entry_callbacks is None and isinstance(result, Exception):
+                self.error(f"Couldn't write the update of the journal {entry}", exc_info=result)
+            self._deliver_later(entry_callbacks, result)
+
+    def _retry_later(self, numbers:List[int]) -> None:
+        queue = self._queue
+        def retry() -> None:
+            # Once stopped, the updates wait in the journal for the next start
+            if queue is self._queue and self._writer is not None:
+                for number in numbers: queue.put(number)
+        timer = Timer(self.retry_delay, retry)
+        timer.daemon = True
+        timer.start()
+
+    def _deliver_later(self, callbacks:Optional[Tuple[Callable, Callable]], result:Any) -> None:
+        """ Call on_saved or on_error in the main loop, updates replayed from the journal have no
+        callbacks """
+        if callbacks is None: return
+        on_saved, on_error = callbacks
+        def deliver() -> bool:
+            if isinstance(result, Exception): on_error(result)
+            else: on_saved(result)
+            return False  # Don't call again
+        GLib.idle_add(deliver)
@@ -1,12 +1,48 @@
-from gi.repository.Gtk import ApplicationWindow, Grid, Stack, StackSidebar, Label, Application
+from typing import Callable
+from gi.repository import GLib
+from gi.repository.Gtk import ApplicationWindow, Box, Grid, Stack, StackSidebar, Label, Application, Widget
 
 from gui.bricks.containers import ScrollWindow
-from gui.workflows.db_manager import DBManager2
+from gui.bricks.instrumentation import UIMonitor
+
+
+class LazyPage(Box):
+    """ Stack page whose content is only built by factory() when first needed, cf MainWindow.add_page """
+
+    def __init__(self, factory:Callable[[], Widget]):
+        super().__init__()
+        self._factory = factory
+        self.content = None
+
+    def build(self) -> bool:
+        """ Build the content if it isn't yet, return False to be usable as an idle callback """
+        if self.content is None:
+            self.content = self._factory()
+            self.pack_start(self.content, True, True, 0)
+            self.content.show_all()
+        return False
+
+
+def _build_db_manager() -> Widget:
+    # The database manager pulls in the tables and forms, only imported when the page is built
+    from gui.bricks.write_queue import WriteQueue
+    from gui.workflows.db_manager import DBManager2
+    db_manager = DBManager2()
+    # Updates journaled but not written before the last exit are written, once the database is open
+    WriteQueue().start()
+    return db_manager
+
+
+def _build_debug_page() -> Widget:
+    from gui.workflows.debug_page import DebugPage
+    return DebugPage()
 
 
 class MainWindow(ApplicationWindow):
     """ Main window of the application, navigation level
     Contains a menu to the left that selects the content of the panel to the left
+    Pages are registered as factories with add_page and built when first shown, after the window
+    is drawn, so that opening the window doesn't depend on the number or the weight of the pages
     https://stackoverflow.com/questions/44509994/create-a-simple-tabbed-multi-page-application-with-python-and-gtk """
 
     def __init__(self, application):
@@ -28,6 +64,8 @@ class MainWindow(ApplicationWindow):
         # Right panel for content, will be filled dynamically by the options of the left navifation sidebar
         right_content = Stack()
         right_content.set_border_width(10)
+        right_content.connect("notify::visible-child", self._on_page_shown)
+        self._stack = right_content
         # Scrollable vertically
         right_scrollable = ScrollWindow()
         right_scrollable.add(right_content)
@@ -39,28 +77,51 @@ class MainWindow(ApplicationWindow):
         self.main_grid.attach(left_menu, 0, 0, 1, 1)
 
         # DB Manager
-        self.db_manager = DBManager2()
-        self.db_manager.tests()  # TEST
-        right_content.add_titled(self.db_manager, "db_manager", "DB Manager")
+        self.add_page("db_manager", "DB Manager", _build_db_manager)
 
         # # Example of simple label content
-        # content = Gtk.Label(label="this text shows in the right panel")
-        # right_content.add_titled(content, "label_1_name", "menu title")
+        # self.add_page("label_1_name", "menu title",
+        #     lambda: Label(label="this text shows in the right panel"))
 
         # Project main view, for later
-        placeholder = Label(label="TODO")
-        right_content.add_titled(placeholder, "projects", "Projects")
+        self.add_page("projects", "Projects", lambda: Label(label="TODO"))
 
         # Application parameters, for later
-        placeholder = Label(label="Settings:\n"+\
+        self.add_page("settings", "Settings", lambda: Label(label="Settings:\n"+\
             "add self as person, add own socmed accounts\n"+\
             "add default database for projects\n"+\
             "add secrets?\n"+\
-            "guided set up if possible")
-        right_content.add_titled(placeholder, "settings", "Settings")
+            "guided set up if possible"))
+
+        # Latency of the interface, cf UIMonitor
+        self.add_page("debug", "Debug", _build_debug_page)
 
         self.show_all()
 
+    def add_page(
+            self, name:str, title:str, factory:Callable[[], Widget], prewarm:bool=False) -> None:
+        """ Add a page to the navigation sidebar, its content is built by factory() when the page
+        is first shown, or once the application is idle if prewarm """
+        page = LazyPage(factory)
+        self._stack.add_titled(page, name, title)
+        if prewarm: GLib.idle_add(page.build, priority=GLib.PRIORITY_LOW)
+
+    def get_page(self, name:str) -> Widget|None:
+        """ Content of a page, built if needed """
+        page = self._stack.get_child_by_name(name)
+        if page is None: return None
+        page.build()
+        return page.content
+
+    @property
+    def db_manager(self) -> Widget:
+        return self.get_page("db_manager")
+
+    def _on_page_shown(self, stack:Stack, _) -> None:
+        """ Build the page shown once the main loop is idle, the window is drawn first """
+        page = stack.get_visible_child()
+        if page is not None and page.content is None: GLib.idle_add(page.build)
+
 
 
 
@@ -78,6 +139,8 @@ class PodficApplication(Application):
 
     def do_startup(self):
         Application.do_startup(self)
+        # Callback durations and main loop stalls, shown in the debug page
+        UIMonitor().start()
 
     def do_activate(self):
         # We only allow a single window and raise any existing ones
@@ -5,14 +5,18 @@ from gi.overrides.Gtk import Button
 
 from db.handler import SQLiteHandler
 from db.objects import Record, Table
-from gui.bricks.forms.record_managers import RecordManagerDialog, RecordManagerGrid
+from gui.bricks.forms.record_managers import BulkEditDialog, RecordManagerDialog, RecordManagerGrid
 from gui.bricks.containers import PaddedFrame, PaddedGrid
+from gui.bricks.instrumentation import timed_connect
+from gui.bricks.reload_scheduler import ReloadScheduler
 from gui.bricks.tables import MultiSelectTable, SingleSelectTable, TableWidget
 
 
 class DBManager(PaddedGrid):
     """ Database manager widget, contains tables for table and record selection and a form to edit
     or create records
+    Reloads go through a ReloadScheduler, db -> tables -> fields and records -> form, so that each
+    element is reloaded once however many callbacks ask for it
     Code interface, to be used for setting up tests only:
     - self.database_path, str
     - self.current_table, Table
@@ -31,17 +35,26 @@ class DBManager(PaddedGrid):
         self.current_fields = []  # Obsolete, was intended to filter the columns to show in records table
         self.current_record = None
 
+        # Each reload invalidates the elements depending on it
+        self._reloads = ReloadScheduler(
+            [
+                ("db", self._reload_db),
+                ("tables", self._reload_tables_table),
+                ("fields", self._reload_fields_table),
+                ("records", self._reload_records_table),
+                ("form", self._reload_record_form)],
+            {"db": ["tables"], "tables": ["fields", "records"], "records": ["form"]})
         
         # Database picker
         db_picker = Gtk.FileChooserButton(
             title="Select the database", action=Gtk.FileChooserAction.OPEN)
         db_picker.set_current_folder('./db')
-        db_picker.connect("file-set", self._on_file_picked)
+        timed_connect(db_picker, "file-set", self._on_file_picked)
         self._db_picker = db_picker
 
         # Reload database button
         reload_button = Gtk.Button(label="Reload")
-        reload_button.connect("clicked", self._on_button_reload_clicked)
+        timed_connect(reload_button, "clicked", self._on_button_reload_clicked)
         reload_button.vexpand = False
 
         # Database picker and button in a single frame
@@ -61,11 +74,18 @@ class DBManager(PaddedGrid):
         self.attach_next(frame_grid(self._tables_table, "Tables"))
         self._fields_table = MultiSelectTable(self._on_fields_selection_changed)
         self.attach_next(frame_grid(self._fields_table, "Table fields"))
-        self._records_table = SingleSelectTable(self._on_records_selection_changed)
-        self.attach_next(frame_grid(self._records_table, "Table records"))
+        self._records_table = MultiSelectTable(self._on_records_selection_changed, searchable=True)
+        records_frame = frame_grid(self._records_table, "Table records")
+        # The form edits one record, the bulk edit all the records selected
+        bulk_edit_button = Gtk.Button(label="Edit selected records")
+        timed_connect(bulk_edit_button, "clicked", self._on_button_bulk_edit_clicked)
+        records_frame.grid.attach_next(bulk_edit_button, Gtk.PositionType.BOTTOM)
+        self.attach_next(records_frame)
 
         # Record form
-        self._record_grid = RecordManagerGrid(on_change_notify=self._on_record_modified)
+        # Quick successive edits don't each wait for the database
+        self._record_grid = RecordManagerGrid(
+            on_change_notify=self._on_record_modified, write_behind=True)
         record_frame = PaddedFrame(label="Record form")
         # swap default grid for RecordManager
         record_frame.remove(record_frame.grid)
@@ -80,7 +100,6 @@ class DBManager(PaddedGrid):
         self._db_handler = SQLiteHandler(self.database_path)
         self._db_handler.change_db(self.database_path)
         self._record_grid.db_handler = self._db_handler
-        self._reload_tables_table()        
         # A few data model stuff that doesn't need to be calculated every time
         self._data_table_table = self._db_handler.data_model.get_table("data_table")
         self._table_name_field = self._data_table_table.get_field("table_name")
@@ -91,37 +110,28 @@ class DBManager(PaddedGrid):
         return table
 
     def _reload_tables_table(self) -> None:
-        """ Reload the tables table, reload in cascade the elements that depend on that table
+        """ Reload the tables table, the scheduler then reloads the elements that depend on it
         This table shows the data_table records """
-        records = self._db_handler.get_records(table="data_table")
-        self._tables_table.load_options(records)
+        self._tables_table.load_options_async(
+            lambda: self._db_handler.get_records(table="data_table"))
         self.current_fields = None
-        self._reload_fields_table()
-        self._reload_records_table()
     
     def _reload_fields_table(self) -> None:
-        """ Reload the fields table for the current table selected, if any, reload in cascade the elements that depend on that table (none currently)
+        """ Reload the fields table for the current table selected, if any
         This table shows the data_field records with a filter on the data_table if applicable"""
-        records = self._db_handler.get_records(
-            table="data_field",
-            where_condition=f'''table_name="{self.current_table.table_name}"''' if self.current_table else ""
-        )
-        self._fields_table.load_options(records)
+        where_condition = f'''table_name="{self.current_table.table_name}"''' if self.current_table else ""
+        self._fields_table.load_options_async(lambda: self._db_handler.get_records(
+            table="data_field", where_condition=where_condition))
 
     def _reload_records_table(self) -> None:
-        """ Reload the records table, reload in cascade the elements that depend on that table
+        """ Reload the records table, the scheduler then reloads the record form
         This table shows the records of the selected table, if any
         If no table has been selected, or if the table is empty, nothing will be shown, not even column headers """
         if self.current_table:
-            records = \
-                self._db_handler.get_records(
-                    table=self.current_table, sort_by=None
-            )
+            self._records_table.load_table(self.current_table)
         else:
-            records = []
-        self._records_table.load_options(records)
+            self._records_table.load_options([])
         self.current_record = None
-        self._reload_record_form()
 
 
     def _reload_record_form(self) -> None:
@@ -130,30 +140,28 @@ class DBManager(PaddedGrid):
         If only a table, the fields are empty
         If no table, nothing """
         if self.current_record and self.current_table:
-            self._record_grid.form.reset_form_from_record(self.current_record)
+            self._record_grid.reset_form_from_record(self.current_record)
         elif self.current_table:
-            self._record_grid.form.reset_form_from_table(self.current_table)
+            self._record_grid.reset_form_from_table(self.current_table)
         else:
-            self._record_grid.form.reset_form_from_nothing()
+            self._record_grid.reset_form_from_nothing()
             
 
     def _on_file_picked(self, file_chooser_button):
-        """ Callback for database file selection """
+        """ Callback for database file selection
+        Reloading the tables clears their selection """
         self.database_path = file_chooser_button.get_filename()
-        self._tables_table.set_selected(None)
-        self._fields_table.set_selected(None)
-        self._records_table.set_selected(None)
-        self._reload_db()
+        self._reloads.invalidate("db")
 
 
     def _on_table_selection_changed(self) -> None:
-        """ Callback for table selection """
+        """ Callback for table selection, ignored when caused by the reloads """
+        if self._reloads.running: return
         if self._tables_table.current_selection:
             self.current_table = self._get_table_from_table_record(self._tables_table.current_selection)
         self.current_fields = []
-        self._reload_fields_table()
         self.current_record = None
-        self._reload_records_table()
+        self._reloads.invalidate("fields", "records")
 
     def _on_fields_selection_changed(self) -> None:
         """ Callback for fields selection """
@@ -161,28 +169,56 @@ class DBManager(PaddedGrid):
         # self._reload_records_table()
     
     def _on_records_selection_changed(self) -> None:
-        """ Callback for record selection """
-        self.current_record = self._records_table.current_selection
-        self._reload_record_form()
+        """ Callback for record selection, ignored when caused by the reloads
+        The form shows the record selected, if there is only one """
+        if self._reloads.running: return
+        selection = self._records_table.current_selection or []
+        self.current_record = selection[0] if len(selection) == 1 else None
+        self._reloads.invalidate("form")
+
+    def _on_button_bulk_edit_clicked(self, button:Button) -> None:
+        """ Callback for the bulk edit button, opens a popup to edit all the records selected """
+        records = [r for r in self._records_table.current_selection or [] if r is not None]
+        if not self.current_table or not records: return
+        BulkEditDialog(self.current_table, records, on_change_notify=self._on_records_bulk_edited)
+
+    def _on_records_bulk_edited(self, records:List[Record]) -> None:
+        """ Callback for the bulk edit popup, only the rows of the records change """
+        self._records_table.apply_changes(updated=records)
+        if self.current_record:
+            self.current_record = next(
+                (r for r in records if r.ID == self.current_record.ID), self.current_record)
+        self._reloads.invalidate("form")
 
     def _on_button_reload_clicked(self, button:Button) -> None:
         """ Callback for database reload button """
-        self._reload_db()
+        self._reloads.invalidate("db")
 
     def _on_record_modified(self) -> None:
         """ Callback for the record manager widget that can edit, create and delete records """
         # The assumption is that the user won't edit the data_table and data_field db tables
         # There is no safegard/failsafe, but come one
-        old_record = self.current_record
-        self._reload_records_table()
-        if old_record:
-            self._records_table.set_selected(old_record)
+        change = self._record_grid.last_change
+        if change and self.current_table and change[1].parent_table == self.current_table:
+            # Only the modified row changes, the selection stays
+            kind, record = change
+            self._records_table.apply_changes(
+                **{kind: [record]}, written=self._record_grid.last_change_written)
+            if kind == "inserted": self._records_table.set_selected(record)
+        else:
+            old_record = self.current_record
+            self._reloads.invalidate("records")
+            # The selection waits for the rows, which are loaded in the background
+            self._reloads.flush()
+            if old_record:
+                self._records_table.set_selected(old_record)
 
     def set_db(self, db_path:str) -> None:
         """ For test purposes """
         self._db_picker.set_filename(db_path)
         self.database_path = db_path
-        self._reload_db()
+        self._reloads.invalidate("db")
+        self._reloads.flush()
 
     def set_table(self, table:Table|str|Record) -> None:
         """ For test purposes """
@@ -201,9 +237,10 @@ class DBManager(PaddedGrid):
                 table=self.current_table, display_name=record)
         self._records_table.set_selected(record)
 
-    def tests(self):
-        self.set_db("/home/anna/Documents/code/podfic_poster2/db/podfics.db")
-        self.set_table("contribution")
+    def tests(self, database_path:str="db/podfics.db", table_name:str="contribution"):
+        """ For test purposes, the database can be generated, cf src.gui_benchmark """
+        self.set_db(database_path)
+        self.set_table(table_name)
         # self.set_record("No Archive Warnings Apply")
         # self.info(f"{self.current_record}")
 
@@ -230,12 +267,12 @@ class DBManager2(PaddedGrid):
         db_picker = Gtk.FileChooserButton(
             title="Select the database", action=Gtk.FileChooserAction.OPEN)
         db_picker.set_current_folder('./db')
-        db_picker.connect("file-set", self._on_file_picked)
+        timed_connect(db_picker, "file-set", self._on_file_picked)
         self._db_picker = db_picker
 
         # Reload database button
         reload_button = Gtk.Button(label="Reload")
-        reload_button.connect("clicked", self._on_button_reload_clicked)
+        timed_connect(reload_button, "clicked", self._on_button_reload_clicked)
         reload_button.vexpand = False
 
         # Database picker and button in a single frame
@@ -277,19 +314,17 @@ class DBManager2(PaddedGrid):
     def _reload_tables_table(self) -> None:
         """ Reload the tables table, reload in cascade the elements that depend on that table
         This table shows the data_table records """
-        records = self._db_handler.get_records(table="data_table")
-        self._tables_table.load_options(records)
+        self._tables_table.load_options_async(
+            lambda: self._db_handler.get_records(table="data_table"))
         self._reload_fields_table()
         self._reload_records_table()
     
     def _reload_fields_table(self) -> None:
         """ Reload the fields table for the current table selected, if any, reload in cascade the elements that depend on that table (none currently)
         This table shows the data_field records with a filter on the data_table if applicable"""
-        records = self._db_handler.get_records(
-            table="data_field",
-            where_condition=f'''table_name="{self.current_table.table_name}"''' if self.current_table else ""
-        )
-        self._fields_table.load_options(records)
+        where_condition = f'''table_name="{self.current_table.table_name}"''' if self.current_table else ""
+        self._fields_table.load_options_async(lambda: self._db_handler.get_records(
+            table="data_field", where_condition=where_condition))
 
     def _reload_records_table(self) -> None:
         """ Reload the records table
@@ -340,9 +375,10 @@ class DBManager2(PaddedGrid):
         """ For test purposes """
         self._records_table.set_selected(record)
 
-    def tests(self):
-        self.set_db("/home/anna/Documents/code/podfic_poster2/db/podfics.db")
-        self.set_table("contribution")
+    def tests(self, database_path:str="db/podfics.db", table_name:str="contribution"):
+        """ For test purposes, the database can be generated, cf src.gui_benchmark """
+        self.set_db(database_path)
+        self.set_table(table_name)
         # self.set_record("No Archive Warnings Apply")
 
 
@@ -358,46 +394,74 @@ class TableManager(PaddedGrid):
         self._db_handler = SQLiteHandler()
         self.current_table = init_table
         self.current_record = init_record
+        self.current_records = [init_record] if init_record else []
 
         def _on_records_selection_changed() -> None:
-            """ Callback for record selection """
-            self.current_record = self._records_table.current_selection
+            """ Callback for record selection, the record is the one selected if there is only one """
+            self.current_records = [
+                r for r in self._records_table.current_selection or [] if r is not None]
+            self.current_record = self.current_records[0] if len(self.current_records) == 1 \
+                else None
             on_selection_changed()
         self._on_records_selection_changed = _on_records_selection_changed
 
-        self._records_table = SingleSelectTable(self._on_records_selection_changed)
+        self._records_table = MultiSelectTable(self._on_records_selection_changed, searchable=True)
         self._records_table.set_column_homogeneous(True)
         if init_options: self.load_options(init_options)
         self.attach_next(self._records_table, width=5)
 
         # Action buttons
         modify_button = Button(label="Modify")
-        modify_button.connect("clicked", self._on_button_modify_clicked)
+        timed_connect(modify_button, "clicked", self._on_button_modify_clicked)
         self.attach_next(modify_button, Gtk.PositionType.RIGHT)
+        bulk_edit_button = Button(label="Edit selected")
+        timed_connect(bulk_edit_button, "clicked", self._on_button_bulk_edit_clicked)
+        self.attach_next(bulk_edit_button, Gtk.PositionType.BOTTOM)
 
     def load_options(self, records:List[Record]|None=None, table:Table=None) -> None:
         """ Reload the records table """
         # Define current table
         if table: self.current_table = table
         elif records: self.current_table = records[0].parent_table
-        # Fetch records if only table is given
+        # Only the rows shown are fetched if only table is given
         if self.current_table and not records:
-            records = self._db_handler.get_records(
-                table=self.current_table, sort_by=None)
+            self._records_table.load_table(self.current_table)
         # Reset table records
-        self._records_table.load_options(records)
+        else:
+            self._records_table.load_options(records)
         # self._records_table.set_selected(self.current_record)
 
     def _on_button_modify_clicked(self, button:Button) -> None:
-        """ Callback for record edit button"""
-        popup = RecordManagerDialog(
+        """ Callback for record edit button, modifications are written in the background """
+        dialog = RecordManagerDialog(
             table=self.current_table,
             record=self.current_record,
-            on_change_notify=self._on_record_modified)
-
-    def _on_record_modified(self, record:Record) -> None:
-        """ Callback for the record manager popups that can edit, create and delete records """
-        self.load_options()
+            on_change_notify=lambda record: self._on_record_modified(dialog, record),
+            write_behind=True)
+
+    def _on_button_bulk_edit_clicked(self, button:Button) -> None:
+        """ Callback for the bulk edit button, opens a popup to edit all the records selected """
+        if not self.current_table or not self.current_records: return
+        BulkEditDialog(
+            self.current_table, self.current_records, on_change_notify=self._on_records_bulk_edited)
+
+    def _on_records_bulk_edited(self, records:List[Record]) -> None:
+        """ Callback for the bulk edit popup, only the rows of the records change """
+        self._records_table.apply_changes(updated=records)
+        self.current_records = records
+        if self.current_record: self.current_record = next(
+            (r for r in records if r.ID == self.current_record.ID), self.current_record)
+
+    def _on_record_modified(self, dialog:RecordManagerDialog, record:Record) -> None:
+        """ Callback for the record manager popups that can edit, create and delete records
+        Only the modified row of the table changes, once more when the modifications are written """
+        change = dialog.record_manager.last_change
+        if change and change[1].parent_table == self.current_table:
+            kind, changed_record = change
+            self._records_table.apply_changes(
+                **{kind: [changed_record]}, written=dialog.record_manager.last_change_written)
+        else:
+            self.load_options()
         if record and record.parent_table == self.current_table:
             self.set_record(record)
 
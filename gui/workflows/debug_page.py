@@ -0,0 +1,62 @@
+from datetime import datetime
+from gi.repository.Gtk import Button, CellRendererText, ListStore, PositionType, TextView, TreeView, \
+    TreeViewColumn, WrapMode
+
+from gui.bricks.containers import PaddedFrame, PaddedGrid, ScrollWindow
+from gui.bricks.instrumentation import UIMonitor, timed_connect
+
+
+class DebugPage(PaddedGrid):
+    """ Latency of the interface, from the UIMonitor: durations of the timed callbacks, slowest
+    first, and the last main loop stalls with the stack of the main thread when they happened
+    Refreshed when shown, or with the refresh button """
+
+    percents = (50, 90, 99)
+
+    def __init__(self):
+        super().__init__()
+
+        refresh_button = Button(label="Refresh")
+        timed_connect(refresh_button, "clicked", lambda _: self.refresh())
+        self.attach_next(refresh_button)
+
+        # Callbacks: name, calls, percentiles and max in milliseconds
+        columns = ["Callback", "Calls"] + [f"p{p} (ms)" for p in DebugPage.percents] + ["Max (ms)"]
+        self._callbacks_store = ListStore(str, int, *[float] * (len(DebugPage.percents) + 1))
+        treeview = TreeView(model=self._callbacks_store)
+        for i, column_name in enumerate(columns):
+            column = TreeViewColumn(column_name, CellRendererText(), text=i)
+            column.set_resizable(True)
+            column.set_sort_column_id(i)
+            treeview.append_column(column)
+        callbacks_frame = PaddedFrame(label="Callbacks")
+        scroll_window = ScrollWindow()
+        scroll_window.add(treeview)
+        callbacks_frame.grid.attach_next(scroll_window)
+        self.attach_next(callbacks_frame, PositionType.BOTTOM)
+
+        # Stalls, latest first
+        self._stalls_view = TextView()
+        self._stalls_view.set_editable(False)
+        self._stalls_view.set_monospace(True)
+        self._stalls_view.set_wrap_mode(WrapMode.NONE)
+        stalls_frame = PaddedFrame(label=f"Main loop stalls over {UIMonitor.stall_threshold}s")
+        scroll_window = ScrollWindow()
+        scroll_window.add(self._stalls_view)
+        stalls_frame.grid.attach_next(scroll_window)
+        self.attach_next(stalls_frame, PositionType.BOTTOM)
+
+        self.connect("map", lambda _: self.refresh())
+
+    def refresh(self) -> None:
+        monitor = UIMonitor()
+        self._callbacks_store.clear()
+        for name, stats in sorted(
+                monitor.stats.items(), key=lambda item: -item[1].percentiles(99)[0]):
+            values = stats.percentiles(*DebugPage.percents) + [max(stats.durations, default=0.)]
+            self._callbacks_store.append([name, stats.count] + [round(v * 1000, 1) for v in values])
+
+        self._stalls_view.get_buffer().set_text("\n\n".join(
+            f"{datetime.fromtimestamp(stall.started):%H:%M:%S} {stall.duration:.2f}s in " +\
+                f"{stall.callback or 'untimed code'}\n{stall.stack}" \
+            for stall in reversed(monitor.stalls)) or "No stall")
@@ -15,6 +15,9 @@ class DebugError(Exception):
 class BaseObject:
     """ Base class for every object """
 
+    # Empty so that subclasses can use __slots__ too
+    __slots__ = ()
+
     logger = getLogger("global")
     
     def log(self, *args, **kargs): return BaseObject.logger.log(*args, **kargs)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of the widget layer
+Generates a database of random records, then runs the widgets (TableWidget, RecordFormGrid,
+RecordManagerDialog, DBManager2) in an offscreen window and times scripted actions: load a
+table, select the n-th record, search, fill the form, save, open a popup...
+An action is done once the main loop has nothing left to do and no background fetch is running,
+it's timed over several runs, then run once more with tracemalloc on to count its allocations
+(Python allocations only, the ones made by GTK aren't seen)
+GTK needs a display, without one, use a virtual framebuffer
+Usage, from the root of the project:
+xvfb-run -a python -m src.gui_benchmark [--rows N] [--table T] [--repeat N] [--save results.json]
+    [--baseline results.json] [--tolerance 1.5] """
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from json import dump, load
+from os import remove
+from os.path import abspath, exists, join
+from random import Random
+from statistics import median
+from sys import argv, exit
+from tempfile import gettempdir
+from time import perf_counter, sleep
+from tracemalloc import get_traced_memory, start as start_tracing, stop as stop_tracing, \
+    take_snapshot
+from typing import Any, Callable, Dict, List, Optional
+
+from db.handler import SQLiteHandler
+from db.objects import BoolField, DateField, Field, FilepathField, IntField, LengthField, Record, \
+    Table, TextField, format_epoch, format_timedelta_seconds
+
+
+words = ["podfic", "audio", "fandom", "exchange", "cover", "chapter", "remix", "summer"]
+
+
+def _generate_value(
+        field:Field, i:int, display_names:Dict[str, List[str]], rng:Random) -> Any:
+    """ Random valid value for the field of the i-th record of its table """
+    if field.foreign_key_table:
+        # Display names of the records of the foreign table, generated first
+        options = display_names.get(field.foreign_key_table.table_name)
+        return rng.choice(options) if options else None
+    field_type = type(field)
+    if field_type is IntField: return rng.randint(0, 100000)
+    if field_type is BoolField: return rng.random() < 0.5
+    if field_type is DateField: return format_epoch(rng.randint(1500000000, 1800000000))
+    if field_type is LengthField: return format_timedelta_seconds(rng.randint(60, 36000))
+    # Filepaths are checked, this one exists
+    if field_type is FilepathField: return abspath(__file__)
+    if not field.mandatory and rng.random() < 0.1: return None
+    return f"{field.field_name} {i} {rng.choice(words)}"
+
+
+def _generate_values(
+        table:Table, count:int, display_names:Dict[str, List[str]], rng:Random,
+        tables:List[Table]) -> List[Dict[Field, Any]]:
+    """ Values of the records of a table """
+    # The tables of the data model, for DBManager2 to find them
+    if table.table_name == "data_table":
+        return [{
+            table.get_field("table_name"): t.table_name,
+            table.get_field("sort_rows_by"): str(t.sort_rows_by)} for t in tables]
+    fields = table.non_automatic_fields
+    return [
+        {field: _generate_value(field, i, display_names, rng) for field in fields} \
+        for i in range(count)]
+
+
+def generate_database(
+        database_path:str, table_name:str, rows:int, other_rows:int=8,
+        seed:int=0) -> SQLiteHandler:
+    """ Create a database with rows records in the table and other_rows in the other ones, foreign
+    keys pointing to existing records
+    Records with the display name of a previous one are dropped, the tables whose display name
+    is made of foreign keys only can end up with fewer records """
+    if exists(database_path): remove(database_path)
+    # If the handler isn't built yet, it shouldn't open the default database first
+    handler = SQLiteHandler(database_path)
+    handler.change_db(database_path)
+    handler.init_db_from_model()
+    rng = Random(seed)
+    tables = handler.data_model.get_tables_in_dependency_order()
+    display_names = {}
+    for table in tables:
+        count = rows if table.table_name == table_name else other_rows
+        records = {}
+        for values in _generate_values(table, count, display_names, rng, tables):
+            record = Record(table, values)
+            records.setdefault(record.display_name, record)
+        handler.create_records_or_fail(list(records.values()))
+        display_names[table.table_name] = list(records)
+    return handler
+
+
+@dataclass
+class Action:
+    """ Scripted action on the widgets, setup and teardown aren't timed """
+    name:str
+    run:Callable[[], Any]
+    setup:Callable[[], Any] = lambda: None
+    teardown:Callable[[Any], None] = lambda result: None
+
+
+@dataclass
+class Result:
+    name:str
+    durations_ms:List[float]
+    allocated_blocks:int  # Still allocated after the action
+    peak_kib:float
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "min_ms": min(self.durations_ms), "median_ms": median(self.durations_ms),
+            "max_ms": max(self.durations_ms), "allocated_blocks": self.allocated_blocks,
+            "peak_kib": self.peak_kib}
+
+
+def wait_until_idle(timeout:float=60.) -> None:
+    """ Run the main loop until it has nothing left to do and no background fetch is running """
+    from gi.repository import Gtk
+    from gui.bricks.background import has_pending_work
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        while Gtk.events_pending(): Gtk.main_iteration_do(False)
+        if not has_pending_work() and not Gtk.events_pending(): return
+        sleep(0.001)  # Waiting for a worker thread
+    raise TimeoutError(f"The main loop was still busy after {timeout}s")
+
+
+def measure(action:Action, repeat:int) -> Result:
+    def run_once() -> Any:
+        result = action.run()
+        wait_until_idle()
+        return result
+
+    durations = []
+    for _ in range(repeat):
+        action.setup()
+        wait_until_idle()
+        start = perf_counter()
+        result = run_once()
+        durations.append((perf_counter() - start) * 1000)
+        action.teardown(result)
+        wait_until_idle()
+
+    action.setup()
+    wait_until_idle()
+    start_tracing()
+    before = take_snapshot()
+    result = run_once()
+    after = take_snapshot()
+    _, peak = get_traced_memory()
+    stop_tracing()
+    action.teardown(result)
+    wait_until_idle()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return Result(action.name, durations, blocks, peak / 1024)
+
+
+def get_actions(handler:SQLiteHandler, table:Table, nth:int) -> List[Action]:
+    """ Build the widgets in an offscreen window, and the actions to run on them """
+    from gi.repository import Gtk
+    from gui.bricks.forms.record_managers import RecordManagerDialog, RecordManagerGrid
+    from gui.bricks.tables import SingleSelectTable
+    from gui.workflows.db_manager import DBManager2
+
+    records = handler.get_records(table)
+    nth_record = records[min(nth, len(records) - 1)]
+    # Saving modifies a text field that isn't part of the display name
+    text_field = next((
+        field for field in table.editable_fields if type(field) is TextField \
+        and not field.automatic and not field.foreign_key_table and not field.part_of_display_name),
+        None)
+    search_text = f"{words[0]} 1"
+
+    window = Gtk.OffscreenWindow()
+    box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+    window.add(box)
+    table_widget = SingleSelectTable(lambda: None, searchable=True)
+    form = RecordManagerGrid(init_table=table)
+    db_manager = DBManager2()
+    box.add(table_widget)
+    box.add(form)
+    box.add(db_manager)
+    window.show_all()
+    wait_until_idle()
+
+    saves = iter(range(1000000))
+    saved_values = []
+    def edit_form() -> None:
+        form.reset_form_from_record(handler.get_record_by_ID(table, nth_record.ID))
+        form_field = next(f for f in form._form_fields if f.field == text_field)
+        saved_values.append(f"{text_field.field_name} benchmark {next(saves)}")
+        form_field.set_value(saved_values[-1])
+
+    def check_saved(_) -> None:
+        """ A save that failed would be timed as if it had worked """
+        value = handler.get_record_by_ID(table, nth_record.ID).values[text_field]
+        if value != saved_values[-1]:
+            raise RuntimeError(f"The record wasn't saved, {text_field} is {value!r}")
+
+    actions = [
+        Action("load records", lambda: table_widget.load_options(records),
+            setup=lambda: table_widget.load_options(None)),
+        Action("load table (paged)", lambda: table_widget.load_table(table),
+            setup=lambda: table_widget.load_options(None)),
+        Action("select n-th record", lambda: table_widget.set_selected(nth_record),
+            setup=lambda: table_widget.set_selected(None)),
+        Action("search", lambda: table_widget.search(search_text),
+            setup=lambda: table_widget.search("")),
+        Action("fill form", lambda: form.reset_form_from_record(nth_record),
+            setup=form.reset_form_from_nothing),
+        Action("open popup", lambda: RecordManagerDialog(table, nth_record),
+            teardown=lambda dialog: dialog.destroy()),
+        Action("DBManager2 tests",
+            lambda: db_manager.tests(handler.database_path, table.table_name)),
+    ]
+    if text_field:
+        actions.append(
+            Action("save record", lambda: form._on_button_save_clicked(None), setup=edit_form,
+                teardown=check_saved))
+    return actions
+
+
+def report(
+        results:List[Result], baseline:Optional[Dict[str, Dict[str, float]]],
+        tolerance:float) -> bool:
+    """ Print the timings, return whether none of the actions got slower than the baseline """
+    all_ok = True
+    print(f"{'action':<24}{'min ms':>10}{'median ms':>11}{'max ms':>10}{'blocks':>10}" +\
+        f"{'peak KiB':>10}")
+    for result in results:
+        values = result.to_dict()
+        line = f"{result.name:<24}{values['min_ms']:>10.1f}{values['median_ms']:>11.1f}" +\
+            f"{values['max_ms']:>10.1f}{result.allocated_blocks:>10}{result.peak_kib:>10.0f}"
+        if baseline and result.name in baseline:
+            budget_ms = baseline[result.name]["median_ms"] * tolerance
+            ok = values["median_ms"] <= budget_ms
+            all_ok = all_ok and ok
+            line += f"  {'OK' if ok else 'KO'} (budget {budget_ms:.1f} ms)"
+        print(line)
+    return all_ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Time scripted actions on the widgets")
+    parser.add_argument("--table", default="project_section", help="table to benchmark")
+    parser.add_argument("--rows", type=int, default=5000, help="number of records of the table")
+    parser.add_argument("--nth", type=int, default=None,
+        help="record to select, the one in the middle by default")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs per action")
+    parser.add_argument("--database", default=join(gettempdir(), "gui_benchmark.db"),
+        help="where to generate the database, overwritten")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file of previous results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+        help="fail if an action's median is over tolerance times the one of the baseline")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    handler = generate_database(args.database, args.table, args.rows)
+    print(f"Generated {args.database} in {perf_counter() - start:.1f}s")
+
+    import gi
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gtk
+    initialized, _ = Gtk.init_check(argv)
+    if not initialized:
+        print("GTK couldn't be initialized, without a display, run with xvfb-run -a")
+        exit(1)
+
+    table = handler.data_model.get_table(args.table)
+    nth = args.rows // 2 if args.nth is None else args.nth
+    results = [measure(action, args.repeat) for action in get_actions(handler, table, nth)]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file: baseline = load(file)
+    all_ok = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as file:
+            dump({result.name: result.to_dict() for result in results}, file, indent=4)
+    exit(0 if all_ok else 1)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Import time budget check
+Imports the entry points of the program in fresh interpreters with python -X importtime, reports
+the slowest imports and fails if an entry point goes over its budget or imports a heavy module
+that it's supposed to leave for later
+Times are net of the interpreter startup: the modules a bare python -c pass imports aren't
+counted, and each entry point is measured several times, the fastest run is the one reported:
+noise, e.g. other processes or a cold disk cache, only ever makes imports slower
+Usage, from the root of the project: python -m src.import_budget [--top N] [--runs N] """
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from os.path import abspath, dirname
+from subprocess import run
+from sys import executable, exit
+from typing import List, Optional, Set
+
+
+project_root = dirname(dirname(abspath(__file__)))
+
+
+@dataclass
+class EntryPoint:
+    """ Code to time, with its budget in milliseconds and the modules it shouldn't import """
+    name:str
+    code:str
+    budget_ms:float
+    forbidden_modules:List[str]
+
+
+@dataclass
+class ImportTime:
+    """ One line of the -X importtime output, times in microseconds """
+    module:str
+    self_us:int
+    cumulative_us:int
+    level:int
+
+
+# Budgets leave about twice the time measured, fastest of 5 runs net of the startup, so that
+# they catch a heavy import coming back and not the noise of a busy machine: the headless
+# handler measured 57 to 86 ms over repeated runs, and importing pandas alone takes about 700 ms
+entry_points = [
+    EntryPoint(
+        "headless handler", "import db.handler",
+        budget_ms=150, forbidden_modules=["pandas", "numpy", "multiprocessing"]),
+    EntryPoint(
+        "GUI",
+        "import gi; gi.require_version('Gtk', '3.0'); import gui.workflows.application",
+        budget_ms=1000, forbidden_modules=["pandas", "numpy", "multiprocessing"]),
+]
+startup_code = "pass"
+
+
+def parse_importtime(output:str) -> List[ImportTime]:
+    """ Parse the stderr output of python -X importtime """
+    times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line: continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level
+        level = (len(module) - len(module.lstrip()) - 1) // 2
+        times.append(ImportTime(module.strip(), int(self_us), int(cumulative_us), level))
+    return times
+
+
+def run_importtime(code:str) -> Optional[List[ImportTime]]:
+    result = run(
+        [executable, "-X", "importtime", "-c", code],
+        cwd=project_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"couldn't run {code}: {result.stderr.strip().splitlines()[-1]}")
+        return None
+    return parse_importtime(result.stderr)
+
+
+def get_startup_modules() -> Set[str]:
+    """ Modules imported by the interpreter itself, e.g. site and encodings """
+    return {t.module for t in run_importtime(startup_code) or []}
+
+
+def get_total_ms(times:List[ImportTime]) -> float:
+    return sum(t.cumulative_us for t in times if t.level == 0) / 1000
+
+
+def measure(
+        entry_point:EntryPoint, startup_modules:Set[str], runs:int) -> Optional[List[ImportTime]]:
+    """ Import times of the entry point, net of the startup, of the fastest run, None if it
+    couldn't be imported """
+    all_times = []
+    for _ in range(runs):
+        times = run_importtime(entry_point.code)
+        if times is None: return None
+        all_times.append([t for t in times if t.module not in startup_modules])
+    return min(all_times, key=get_total_ms)
+
+
+def report(entry_point:EntryPoint, times:List[ImportTime], top:int) -> bool:
+    """ Print the report for one entry point, return whether it respects its budget """
+    total_ms = get_total_ms(times)
+    imported = {t.module for t in times}
+    forbidden = [m for m in entry_point.forbidden_modules if m in imported]
+    ok = total_ms <= entry_point.budget_ms and not forbidden
+    print(f"{entry_point.name}: {total_ms:.1f} ms for a budget of {entry_point.budget_ms} ms" +\
+        f" -> {'OK' if ok else 'KO'}")
+    if forbidden: print(f"    imports modules that should be imported later: {forbidden}")
+    print(f"    slowest top-level imports (cumulative):")
+    for t in sorted([t for t in times if t.level == 0], key=lambda t: -t.cumulative_us)[:top]:
+        print(f"    {t.cumulative_us/1000:8.1f} ms  {t.module}")
+    print(f"    slowest modules (self):")
+    for t in sorted(times, key=lambda t: -t.self_us)[:top]:
+        print(f"    {t.self_us/1000:8.1f} ms  {t.module}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Check the import time of the entry points")
+    parser.add_argument("--top", type=int, default=10, help="number of imports to list")
+    parser.add_argument("--runs", type=int, default=5, help="number of runs per entry point")
+    args = parser.parse_args()
+    startup_modules = get_startup_modules()
+    all_ok = True
+    for entry_point in entry_points:
+        times = measure(entry_point, startup_modules, args.runs)
+        all_ok = times is not None and report(entry_point, times, args.top) and all_ok
+    exit(0 if all_ok else 1)
@@ -0,0 +1,37 @@
+from os.path import abspath, dirname
+from time import perf_counter, sleep
+from typing import Callable
+
+import pytest
+
+from src.gui_benchmark import generate_database
+
+
+project_root = dirname(dirname(abspath(__file__)))
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    """ The handler, on a generated database with 50 project sections and 8 records in the other
+    tables; the data model is read relative to the root of the project """
+    monkeypatch.chdir(project_root)
+    return generate_database(str(tmp_path / "test.db"), "project_section", 50)
+
+
+@pytest.fixture
+def run_main_loop():
+    """ run_main_loop(until) iterates the GLib main loop until until() is true, or until it has
+    nothing left to do without a condition """
+    GLib = pytest.importorskip("gi.repository.GLib")
+    context = GLib.MainContext.default()
+
+    def run(until:Callable[[], bool]|None=None, timeout:float=5.) -> None:
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            if until is None:
+                if not context.pending(): return
+                context.iteration(False)
+            elif until(): return
+            elif not context.iteration(False): sleep(0.001)  # Waiting for another thread
+        raise TimeoutError(f"The main loop was still busy after {timeout}s")
+    return run
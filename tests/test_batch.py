@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("numeric_storage", [False, True])
+@pytest.mark.parametrize("table_name", ["project", "project_section", "project_status_by_stage"])
+def test_frame_records_are_the_records(handler, numeric_storage, table_name):
+    if numeric_storage: handler.migrate_to_numeric_storage()
+    records = handler.get_records(table_name)
+    frame_records = handler.get_frame(table_name).to_records()
+    assert [dict(r.values) for r in frame_records] == [dict(r.values) for r in records]
+
+
+def test_frame_columns(handler):
+    handler.migrate_to_numeric_storage()
+    frame = handler.get_frame("project", columns=["audio_length", "creation_date"])
+    assert [f.field_name for f in frame.fields] == ["ID", "audio_length", "creation_date"]
+    # Lengths as seconds, dates as epoch seconds
+    assert frame["audio_length"].dtype.kind in "if"
+    assert frame["creation_date"].dtype.kind in "if"
+
+
+@pytest.mark.parametrize("numeric_storage", [False, True])
+def test_get_record(handler, numeric_storage):
+    if numeric_storage: handler.migrate_to_numeric_storage()
+    batch = handler.get_frame("project_section")
+    records = handler.get_records("project_section")
+    assert len(batch) == len(records)
+    for record in records:
+        assert dict(batch.get_record(record.ID).values) == dict(record.values)
+    assert batch.get_record(max(r.ID for r in records) + 1) is None
+
+
+def test_filter_sort_group_by(handler):
+    batch = handler.get_frame("project_section")
+    records = {r.ID: r for r in handler.get_records("project_section")}
+    lengths = batch["audio_length"]
+    threshold = np.median(lengths)
+    long_sections = batch.filter(lengths > threshold)
+    assert set(long_sections["ID"].tolist()) == \
+        {ID for ID, length in zip(batch["ID"].tolist(), lengths.tolist()) if length > threshold}
+    assert [dict(r.values) for r in long_sections.to_records()] == \
+        [dict(records[ID].values) for ID in long_sections["ID"].tolist()]
+
+    by_length = batch.sort("audio_length")
+    assert by_length["audio_length"].tolist() == sorted(lengths.tolist())
+    assert batch.sort("audio_length", reverse=True)["audio_length"].tolist() == \
+        sorted(lengths.tolist(), reverse=True)
+    # Missing text last
+    by_link = batch.sort("link_to_AO3_work")["link_to_AO3_work"].tolist()
+    assert by_link == sorted(by_link, key=lambda v: (v is None, v or ""))
+
+    groups = batch.group_by("project")
+    assert sum(len(group) for group in groups.values()) == len(batch)
+    for project, group in groups.items():
+        assert {r.values["project"] for r in group.to_records()} == {project}
+
+
+def test_missing_integers(handler):
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    # Records can't hold a missing integer, the database can
+    handler.cur.execute(
+        f"UPDATE project_section SET recorded_wordcount = NULL WHERE ID IN {tuple(IDs[:3])}")
+    handler.con.commit()
+    batch = handler.get_frame(table, columns=["recorded_wordcount"])
+    assert batch["recorded_wordcount"].dtype == np.float64
+    assert [row[1] for row in batch.rows() if row[0] in IDs[:3]] == [None] * 3
+    assert all(type(row[1]) is int for row in batch.rows() if row[0] not in IDs[:3])
+
+
+@pytest.mark.parametrize("field_name", ["recorded_wordcount", "link_to_AO3_work"])
+def test_sort_missing_last(handler, field_name):
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    handler.cur.execute(
+        f"UPDATE project_section SET {field_name} = NULL WHERE ID IN {tuple(IDs[:3])}")
+    handler.con.commit()
+    batch = handler.get_frame(table)
+    values = [row[0] for row in batch.rows([table.get_field(field_name)])]
+    present = [v for v in values if v is not None]
+    missing = [None] * (len(values) - len(present))
+    for reverse in [False, True]:
+        sorted_values = [row[0] for row in batch.sort(field_name, reverse).rows(
+            [table.get_field(field_name)])]
+        assert sorted_values == sorted(present, reverse=reverse) + missing
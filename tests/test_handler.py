@@ -0,0 +1,134 @@
+from sqlite3 import IntegrityError
+
+import pytest
+
+from db.handler import SQLiteHandler
+from gui.bricks.search_index import SearchIndex
+
+
+def test_update_records_or_fail(handler):
+    records = handler.get_records("project_section")[:10]
+    rating = handler.get_records("rating")[0]
+    handler.update_records_or_fail(
+        "project_section", [r.ID for r in records],
+        {handler.data_model.get_table("project_section").get_field("link_to_AO3_work"): "link",
+        handler.data_model.get_table("project_section").get_field("rating"): rating.display_name})
+    where_condition = f"ID IN ({', '.join(str(r.ID) for r in records)})"
+    updated = handler.get_records("project_section", where_condition=where_condition)
+    assert {r.values["link_to_AO3_work"] for r in updated} == {"link"}
+    assert {r.values["rating"] for r in updated} == {rating.display_name}
+    assert handler.count_records("project_section", "link_to_AO3_work = 'link'") == 10
+
+
+def test_update_records_or_fail_chunks(handler, monkeypatch):
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    statements = []
+    handler.con.set_trace_callback(lambda sql: statements.append(sql))
+    monkeypatch.setattr(SQLiteHandler, "max_IDs_per_query", 7)
+    handler.update_records_or_fail(table, IDs, {table.get_field("link_to_AO3_work"): "link"})
+    handler.con.set_trace_callback(None)
+    assert len([sql for sql in statements if sql.startswith("UPDATE")]) == -(-len(IDs) // 7)
+    assert handler.count_records(table, "link_to_AO3_work = 'link'") == len(IDs)
+
+
+def test_update_records_or_fail_over_500_IDs(handler):
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    # Missing IDs are ignored, there are enough of them for several statements
+    handler.update_records_or_fail(
+        table, IDs + list(range(100000, 101200)), {table.get_field("link_to_AO3_work"): "link"})
+    assert handler.count_records(table, "link_to_AO3_work = 'link'") == len(IDs)
+
+
+def test_update_records_or_fail_invalid_value(handler):
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    with pytest.raises(ValueError):
+        handler.update_records_or_fail(table, IDs, {table.get_field("section_number"): "one"})
+    with pytest.raises(ValueError):
+        handler.update_records_or_fail(table, IDs, {table.get_field("ID"): 1})
+    assert handler.count_records(table, "section_number = 'one'") == 0
+
+
+def test_update_records_or_fail_rolls_back(handler, monkeypatch):
+    table = handler.data_model.get_table("project_section")
+    records = handler.get_records(table)
+    before = {r.ID: dict(r.values) for r in records}
+    # The first chunk is written before the display name of the second collides with the first
+    monkeypatch.setattr(SQLiteHandler, "max_IDs_per_query", 1)
+    project = handler.get_records("project")[0]
+    with pytest.raises(IntegrityError):
+        handler.update_records_or_fail(table, [r.ID for r in records[:2]], {
+            table.get_field("project"): project.display_name,
+            table.get_field("section_name"): "same name",
+            table.get_field("link_to_AO3_work"): "link"})
+    assert {r.ID: dict(r.values) for r in handler.get_records(table)} == before
+    assert not handler.con.in_transaction
+
+
+def get_all_values(handler):
+    return {table.table_name: [dict(r.values) for r in handler.get_records(table)] \
+        for table in handler.data_model.tables}
+
+
+def test_migrate_to_numeric_storage(handler):
+    before = get_all_values(handler)
+    handler.migrate_to_numeric_storage()
+    assert handler.numeric_storage
+    assert get_all_values(handler) == before
+    # Stored as numbers
+    assert handler.cur.execute(
+        "SELECT DISTINCT typeof(audio_length), typeof(creation_date) FROM project_section"
+        ).fetchall() == [("integer", "integer")]
+    # Still numeric once the database is opened again
+    handler.change_db(handler.database_path)
+    assert handler.numeric_storage
+    assert get_all_values(handler) == before
+
+
+def test_write_with_numeric_storage(handler):
+    handler.migrate_to_numeric_storage()
+    table = handler.data_model.get_table("project_section")
+    first, second = handler.get_records(table)[:2]
+    length = second.values[table.get_field("audio_length")]
+    handler.update_records_or_fail(table, [first.ID], {table.get_field("audio_length"): length})
+    assert handler.get_record_by_ID(table, first.ID).values[table.get_field("audio_length")] \
+        == length
+    assert handler.cur.execute(
+        f"SELECT typeof(audio_length) FROM project_section WHERE ID = {first.ID}").fetchone() \
+        == ("integer",)
+
+
+def test_migrate_to_numeric_storage_rolls_back(handler):
+    section_count = handler.count_records("project_section")
+    # A length that can't be converted, written around the validation of the handler
+    handler.cur.execute("UPDATE project SET audio_length = 'not a length' WHERE ID = 1")
+    handler.con.commit()
+    with pytest.raises(ValueError):
+        handler.migrate_to_numeric_storage()
+    assert not handler.numeric_storage
+    assert handler.cur.execute("PRAGMA user_version").fetchone() == (0,)
+    assert handler.cur.execute(
+        "SELECT DISTINCT typeof(audio_length) FROM project_section").fetchall() == [("text",)]
+    assert handler.count_records("project_section") == section_count
+
+
+@pytest.mark.parametrize("numeric_storage", [False, True])
+@pytest.mark.parametrize("query", ["ÉTÉ", "STRASSE été", "été 2", "00:", "20", "'%_"])
+def test_search_condition_is_the_search_index(handler, numeric_storage, query):
+    """ Large tables are searched by the database, small ones in memory: same rows """
+    if numeric_storage: handler.migrate_to_numeric_storage()
+    table = handler.data_model.get_table("project_section")
+    IDs = [r.ID for r in handler.get_records(table)]
+    handler.update_records_or_fail(
+        table, IDs[:5], {table.get_field("link_to_AO3_work"): "Été à la Straße '%_"})
+    handler.update_records_or_fail(table, IDs[5:8], {table.get_field("link_to_AO3_work"): "ete"})
+    index = SearchIndex()
+    for row in handler.get_rows(table, table.fields):
+        index.add(row[0], " ".join(str(value) for value, field in zip(row, table.fields) \
+            if type(field) in SQLiteHandler.searchable_field_types and value is not None))
+    where_condition = handler.get_search_condition(table.fields, query)
+    found = {r.ID for r in handler.get_records(table, where_condition=where_condition)}
+    assert found == index.search(query)
+    assert found
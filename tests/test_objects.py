@@ -0,0 +1,102 @@
+from os import stat, utime
+from os.path import abspath, dirname, join
+from pickle import dump, load
+from shutil import copyfile
+
+import pytest
+
+from db.objects import DataModel, Table, TextField
+
+
+project_root = dirname(dirname(abspath(__file__)))
+
+
+def test_table_hash_is_stable_when_fields_change():
+    table = Table("table")
+    table.fields = [TextField(table, "ID", automatic=True)]
+    tables = {table: "value"}
+    table.fields = table.fields + [TextField(table, "name")]
+    table.fields[0].field_name = "renamed"
+    table.reindex_fields()
+    assert tables[table] == "value"
+
+
+def test_table_equality():
+    table, same_table, other_table = Table("table"), Table("table"), Table("other")
+    for t in [table, same_table, other_table]: t.fields = [TextField(t, "name")]
+    assert table == same_table and hash(table) == hash(same_table)
+    assert table != other_table
+    same_table.fields = same_table.fields + [TextField(same_table, "other_name")]
+    assert table != same_table
+
+
+@pytest.fixture
+def spreadsheet(tmp_path, monkeypatch):
+    """ Copy of the data model spreadsheet, without cache; returns its path and the list of its
+    parses, which grows each time it's parsed """
+    monkeypatch.setattr(DataModel, "_interned_tables", {})
+    path = str(tmp_path / "datamodel.ods")
+    copyfile(join(project_root, "db", "datamodel.ods"), path)
+    parses = []
+    parse = DataModel.load_db_model_from_spreadsheet
+    monkeypatch.setattr(
+        DataModel, "load_db_model_from_spreadsheet", lambda self: parses.append(1) or parse(self))
+    return path, parses
+
+
+def edit_cache(path, **values):
+    with open(path + ".cache", "rb") as f: cache = load(f)
+    cache.update(values)
+    with open(path + ".cache", "wb") as f: dump(cache, f)
+
+
+def get_table_names(data_model):
+    return [table.table_name for table in data_model.tables]
+
+
+def test_data_model_cache(spreadsheet):
+    path, parses = spreadsheet
+    data_model = DataModel(path)
+    assert len(parses) == 1
+    cached = DataModel(path)
+    assert len(parses) == 1
+    assert get_table_names(cached) == get_table_names(data_model)
+    assert cached.spreadsheet_hash == data_model.spreadsheet_hash
+
+
+def test_data_model_cache_same_content(spreadsheet):
+    """ Only the modification time or the size in the cache differ, the hash is checked """
+    path, parses = spreadsheet
+    DataModel(path)
+    spreadsheet_stat = stat(path)
+    utime(path, ns=(spreadsheet_stat.st_atime_ns, spreadsheet_stat.st_mtime_ns + 10**9))
+    DataModel(path)
+    edit_cache(path, size=1)
+    DataModel(path)
+    assert len(parses) == 1
+    # The cache was updated, the hash isn't computed again
+    with open(path + ".cache", "rb") as f: cache = load(f)
+    assert (cache["mtime"], cache["size"]) == (stat(path).st_mtime_ns, stat(path).st_size)
+
+
+@pytest.mark.parametrize("values", [
+    {"mtime": 0, "sha256": "0" * 64}, {"size": 1, "sha256": "0" * 64}, {"version": 0}])
+def test_data_model_cache_invalidated(spreadsheet, values):
+    path, parses = spreadsheet
+    data_model = DataModel(path)
+    edit_cache(path, **values)
+    DataModel._interned_tables = {}
+    reloaded = DataModel(path)
+    assert len(parses) == 2
+    assert get_table_names(reloaded) == get_table_names(data_model)
+
+
+def test_data_model_cache_unreadable(spreadsheet):
+    path, parses = spreadsheet
+    DataModel(path)
+    with open(path + ".cache", "wb") as f: f.write(b"not a pickle")
+    DataModel(path)
+    assert len(parses) == 2
+    # Replaced by a usable one
+    DataModel(path)
+    assert len(parses) == 2
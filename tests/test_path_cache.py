@@ -0,0 +1,26 @@
+from os import remove
+from os.path import join
+
+from db.path_cache import PathCache
+
+
+def test_existing_and_missing_paths(tmp_path):
+    path_cache = PathCache()
+    path_cache.invalidate()
+    (tmp_path / "a").write_text("")
+    assert path_cache.exists(join(tmp_path, "a"))
+    assert not path_cache.exists(join(tmp_path, "b"))
+    assert not path_cache.exists(join(tmp_path, "missing_directory", "a"))
+
+
+def test_file_created_after_listing(tmp_path):
+    path_cache = PathCache()
+    path_cache.invalidate()
+    path = join(tmp_path, "picked")
+    path_cache.prefetch([path])
+    assert not path_cache.exists(path)
+    (tmp_path / "picked").write_text("")
+    assert path_cache.exists(path)
+    # The listing was refreshed, the other entries are still found from it
+    remove(path)
+    assert not path_cache.exists(path)
@@ -0,0 +1,23 @@
+import pytest
+
+gi = pytest.importorskip("gi")
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk
+if not Gtk.init_check([])[0]: pytest.skip("GTK needs a display", allow_module_level=True)
+from gui.bricks.forms.record_managers import RecordManagerGrid
+
+
+def test_save_mandatory_foreign_key(handler):
+    """ Foreign key form fields give records, saved as their display names """
+    table = handler.data_model.get_table("project_section")
+    project_field = table.get_field("project")
+    assert project_field.mandatory
+    section = handler.get_records(table)[0]
+    project = next(
+        p for p in handler.get_records("project") if p.display_name != section.values[project_field])
+    grid = RecordManagerGrid(init_record=section)
+    form_field = next(f for f in grid._form_fields if f.field == project_field)
+    form_field.set_value(project)
+    grid._on_button_save_clicked(None)
+    assert grid.last_change is not None and grid.last_change[0] == "updated"
+    assert handler.get_record_by_ID(table, section.ID).values[project_field] == project.display_name
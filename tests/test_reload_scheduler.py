@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip("gi")
+from gui.bricks.reload_scheduler import ReloadScheduler
+
+
+@pytest.fixture
+def reloads():
+    """ Scheduler of db -> tables -> fields, records -> form, that logs the steps it runs and
+    whether it was running during each of them """
+    log = []
+    def step(name):
+        def reload():
+            log.append((name, scheduler.running))
+            hooks.get(name, lambda: None)()
+        return reload
+    names = ["db", "tables", "fields", "records", "form"]
+    hooks = {}
+    scheduler = ReloadScheduler(
+        [(name, step(name)) for name in names],
+        {"db": ["tables"], "tables": ["fields", "records"], "records": ["form"]})
+    scheduler.log, scheduler.hooks = log, hooks
+    return scheduler
+
+
+def get_steps(reloads):
+    steps = [name for name, _ in reloads.log]
+    reloads.log.clear()
+    return steps
+
+
+def test_coalesced(reloads, run_main_loop):
+    reloads.invalidate("form")
+    reloads.invalidate("records")
+    reloads.invalidate("tables", "records")
+    assert reloads.log == []
+    run_main_loop()
+    # Each once, in order, while running
+    assert reloads.log == [(name, True) for name in ["tables", "fields", "records", "form"]]
+    assert not reloads.running
+
+
+def test_dependents(reloads, run_main_loop):
+    reloads.invalidate("db")
+    run_main_loop()
+    assert get_steps(reloads) == ["db", "tables", "fields", "records", "form"]
+    reloads.invalidate("fields")
+    run_main_loop()
+    assert get_steps(reloads) == ["fields"]
+
+
+def test_invalidated_while_running(reloads, run_main_loop):
+    # Later step: same pass; earlier step: next pass
+    reloads.hooks["fields"] = lambda: \
+        reloads.hooks.pop("fields") and reloads.invalidate("form", "tables")
+    reloads.invalidate("fields")
+    run_main_loop()
+    assert get_steps(reloads) == ["fields", "records", "form", "tables", "fields"]
+
+
+def test_flush(reloads, run_main_loop):
+    reloads.invalidate("records")
+    reloads.flush()
+    assert get_steps(reloads) == ["records", "form"]
+    run_main_loop()
+    assert get_steps(reloads) == []
+    # Flushing from a reload doesn't run the others early
+    reloads.hooks["records"] = reloads.flush
+    reloads.invalidate("records")
+    run_main_loop()
+    assert get_steps(reloads) == ["records", "form"]
@@ -0,0 +1,57 @@
+from random import Random
+
+import pytest
+
+from gui.bricks.search_index import SearchIndex
+
+
+words = ["Podfic", "audio", "fandom", "exchange", "Straße", "ao", "remix", "summer", "a b"]
+
+
+def scan(texts, query):
+    """ What the index has to find, by checking every text """
+    query_words = query.casefold().split()
+    return {ID for ID, text in texts.items() if all(w in text.casefold() for w in query_words)}
+
+
+@pytest.fixture
+def texts():
+    rng = Random(0)
+    return {ID: " ".join(rng.choice(words) + str(rng.randint(0, 20)) for _ in range(4)) \
+        for ID in range(300)}
+
+
+queries = [
+    "", "  ", "podfic", "PODFIC", "audio1", "fandom 1", "strasse", "STRASSE", "ao", "a", "a b",
+    "o1 remix", "exchange summer", "missing", "dio1", "summer20 podfic3"]
+
+
+@pytest.mark.parametrize("query", queries)
+def test_search_is_a_scan(texts, query):
+    index = SearchIndex()
+    for ID, text in texts.items(): index.add(ID, text)
+    assert index.search(query) == scan(texts, query)
+    assert all(index.matches(ID, query) == (ID in scan(texts, query)) for ID in texts)
+
+
+def test_search_after_changes(texts):
+    index = SearchIndex()
+    for ID, text in texts.items(): index.add(ID, text)
+    # Changes before and after the trigrams are built
+    for build_trigrams in [False, True]:
+        if build_trigrams: index.search("podfic")
+        rng = Random(build_trigrams)
+        for ID in rng.sample(sorted(texts), 50):
+            index.remove(ID)
+            del texts[ID]
+        for ID in rng.sample(sorted(texts), 50):
+            texts[ID] = f"replaced {rng.choice(words)}"
+            index.add(ID, texts[ID])
+        for ID in range(1000, 1020):
+            texts[ID] = f"added {rng.choice(words)}"
+            index.add(ID, texts[ID])
+        for query in queries + ["replaced", "added podfic"]:
+            assert index.search(query) == scan(texts, query)
+    index.remove(123456)  # Unknown IDs are ignored
+    index.clear()
+    assert index.search("") == set() and index.search("podfic") == set()
@@ -0,0 +1,18 @@
+from functools import cmp_to_key
+
+import pytest
+
+pytest.importorskip("gi")
+from gui.bricks.tables import _compare_lengths
+
+
+class Column:
+    """ Model of a single column, iters are the values """
+    def get_value(self, tree_iter, column): return tree_iter
+
+
+def test_lengths_sorted_by_seconds():
+    lengths = ["10:00:00", "1:02:03", "100:00:00", "99:00:00", "", "00:00:59"]
+    compare = lambda a, b: _compare_lengths(Column(), a, b, 0)
+    assert sorted(lengths, key=cmp_to_key(compare)) == \
+        ["", "00:00:59", "1:02:03", "10:00:00", "99:00:00", "100:00:00"]
@@ -0,0 +1,110 @@
+from json import dumps, loads
+from os.path import abspath
+
+import pytest
+
+pytest.importorskip("gi")
+from gui.bricks.write_queue import WriteQueue
+
+
+@pytest.fixture
+def write_queue(handler, tmp_path, monkeypatch):
+    """ A new queue journaling in tmp_path, the class is a singleton """
+    monkeypatch.setattr(WriteQueue, "batch_delay", 0.01)
+    monkeypatch.setattr(WriteQueue, "retry_delay", 0.05)
+    queue = type.__call__(WriteQueue, journal_path=str(tmp_path / "journal.jsonl"))
+    yield queue
+    queue.stop()
+
+
+def read_journal(write_queue):
+    with open(write_queue.journal_path) as journal:
+        return [loads(line) for line in journal]
+
+
+def get_section(handler, ID=None):
+    sections = handler.get_records("project_section")
+    return sections[0] if ID is None else next(r for r in sections if r.ID == ID)
+
+
+def with_link(record, link):
+    values = dict(record.values)
+    values[record.parent_table.get_field("link_to_AO3_work")] = link
+    return type(record)(record.parent_table, values)
+
+
+def test_save(handler, write_queue, run_main_loop, monkeypatch):
+    section = get_section(handler)
+    # Journaled before being written
+    journaled = []
+    write_record_updates = handler.write_record_updates
+    def write_journaled(records):
+        journaled.extend(e["values"]["link_to_AO3_work"] for e in read_journal(write_queue))
+        return write_record_updates(records)
+    monkeypatch.setattr(handler, "write_record_updates", write_journaled)
+    saved = []
+    write_queue.save(with_link(section, "first"), saved.append)
+    write_queue.save(with_link(section, "second"), saved.append)
+    run_main_loop(lambda: len(saved) == 2)
+    assert journaled == ["first", "second"]
+    # Both saves get the record as written, which is the last one
+    assert [r.values["link_to_AO3_work"] for r in saved] == ["second", "second"]
+    assert get_section(handler, section.ID).values["link_to_AO3_work"] == "second"
+    assert read_journal(write_queue) == []
+
+
+def test_invalid_update_is_dropped(handler, write_queue, run_main_loop):
+    section = get_section(handler)
+    other = get_section(handler, handler.get_records("project_section")[1].ID)
+    # Same display name as the other section
+    values = dict(section.values)
+    for field in section.parent_table.fields:
+        if field.part_of_display_name and not field.automatic: values[field] = other.values[field]
+    errors = []
+    write_queue.save(type(section)(section.parent_table, values), on_error=errors.append)
+    run_main_loop(lambda: errors)
+    assert read_journal(write_queue) == []
+    assert get_section(handler, section.ID).display_name == section.display_name
+
+
+def test_failed_transaction_is_retried(handler, write_queue, run_main_loop, monkeypatch):
+    section = get_section(handler)
+    write_record_updates = handler.write_record_updates
+    calls = []
+    def fail_once(records):
+        calls.append(records)
+        if len(calls) == 1: raise ValueError("database is locked")
+        return write_record_updates(records)
+    monkeypatch.setattr(handler, "write_record_updates", fail_once)
+    saved, errors = [], []
+    write_queue.save(with_link(section, "retried"), saved.append, errors.append)
+    run_main_loop(lambda: saved or errors)
+    # Not reported as failed, written by the retry
+    assert errors == [] and len(calls) == 2
+    assert saved[0].values["link_to_AO3_work"] == "retried"
+    assert read_journal(write_queue) == []
+
+
+def test_journal_replay(handler, write_queue, run_main_loop):
+    section = get_section(handler)
+    entry = lambda number, database, link: {
+        "database": database, "table": "project_section", "number": number,
+        "values": {**{f.field_name: v for f, v in section.values.items() if not f.automatic},
+            "ID": section.ID, "link_to_AO3_work": link}}
+    other_database = entry(0, abspath("other.db"), "other database")
+    with open(write_queue.journal_path, "w") as journal:
+        journal.write(dumps(other_database) + "\n")
+        journal.write(dumps(entry(1, abspath(handler.database_path), "replayed")) + "\n")
+        # Cut short by a crash
+        journal.write(dumps(entry(2, abspath(handler.database_path), "cut"))[:40])
+    write_queue.start()
+    # Written once the journal is rewritten without it
+    def count_lines():
+        with open(write_queue.journal_path) as journal: return len(journal.readlines())
+    run_main_loop(lambda: count_lines() == 1)
+    assert get_section(handler, section.ID).values["link_to_AO3_work"] == "replayed"
+    # The updates of other databases wait for them to be opened
+    assert read_journal(write_queue) == [other_database]
+    # New saves are numbered after the ones of the journal
+    write_queue.save(with_link(section, "new"))
+    assert max(write_queue._entries) == 2